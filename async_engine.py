@@ -0,0 +1,212 @@
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Dict, Optional
+
+from hashing import StreamHasher
+from metrics import get_metrics, Operation, OP_DOWNLOAD
+from http_client import get_http_client, SCRAPER_HEADERS, DEFAULT_POOL_SIZE, DEFAULT_RETRIES, \
+    DEFAULT_BACKOFF_FACTOR, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, DEFAULT_PER_HOST_LIMIT
+from rate_limit import backoff_delay
+from transfer_queue import file_progress_bar
+
+BACKEND_THREADS = "threads"
+BACKEND_ASYNCIO = "asyncio"
+BACKENDS = [BACKEND_THREADS, BACKEND_ASYNCIO]
+
+ASYNC_CHUNK_SIZE = 1024 * 1024
+# answers of cloudflare challenge, such picture is downloaded again with blocking cloudscraper session
+CLOUDFLARE_CHALLENGE_STATUSES = (403, 503)
+# seconds between checks of a busy host slot
+SLOT_POLL_MIN = 0.01
+SLOT_POLL_MAX = 0.2
+SCRAPER_USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                      "(KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36")
+
+
+class AsyncBackendUnavailableError(Exception):
+    pass
+
+
+class AsyncResponse:
+    """Fully read answer with requests.Response like fields used by callers."""
+
+    def __init__(self, status_code: int, headers: Dict[str, str], content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+
+class AsyncDownloadEngine:
+    """
+    aiohttp session with its own event loop in one background thread.
+    Thousands of transfers are coroutines of this loop instead of one blocked thread each.
+    Blocking callers use run(), scheduler submits coroutines with submit().
+    """
+
+    def __init__(self,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 retries: int = DEFAULT_RETRIES,
+                 backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 per_host_limit: int = DEFAULT_PER_HOST_LIMIT,
+                 chunk_size: int = ASYNC_CHUNK_SIZE):
+        try:
+            import aiohttp
+        except ImportError as e:
+            raise AsyncBackendUnavailableError("asyncio backend needs aiohttp: pip install aiohttp") from e
+        # asyncio and aiohttp are imported only for asyncio backend
+        import asyncio
+        self._aiohttp = aiohttp
+        self._asyncio = asyncio
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.per_host_limit = max(1, per_host_limit)
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.chunk_size = chunk_size
+        self._session = None
+        self._loop = self._asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-download", daemon=True)
+        self._thread.start()
+
+    def submit(self, coroutine: Awaitable) -> Future:
+        return self._asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def run(self, coroutine: Awaitable) -> Any:
+        # must not be called from the loop thread
+        return self.submit(coroutine).result()
+
+    def _get_session(self):
+        # created inside the loop, aiohttp binds session to running loop
+        if self._session is None:
+            connector = self._aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.per_host_limit)
+            self._session = self._aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def _acquire_slot(self, concurrency) -> None:
+        # adaptive limit is shared with blocking threads, the loop polls it instead of waiting on its Condition
+        delay = SLOT_POLL_MIN
+        while not concurrency.try_acquire():
+            await self._asyncio.sleep(delay)
+            delay = min(delay * 2, SLOT_POLL_MAX)
+
+    async def _request(self, url: str, headers: Optional[Dict[str, str]] = None):
+        # same retry policy and host rate limiter (adaptive slot, token bucket, Retry-After pause)
+        # as blocking HttpClient.stream: the slot is held until headers arrived
+        http_client = get_http_client()
+        limiter = http_client.limiter(url)
+        attempt = 0
+        while True:
+            await self._acquire_slot(limiter.concurrency)
+            try:
+                wait = limiter.bucket.reserve()
+                if wait > 0:
+                    await self._asyncio.sleep(wait)
+                resp = await self._get_session().get(url, headers=headers)
+            except (self._aiohttp.ClientConnectionError, self._asyncio.TimeoutError):
+                if attempt >= self.retries:
+                    raise
+                delay = backoff_delay(attempt, self.backoff_factor)
+            else:
+                delay = http_client.retry_delay(url, resp.status, resp.headers.get("Retry-After"), attempt, limiter)
+                if delay is None:
+                    return resp
+                resp.release()
+            finally:
+                limiter.concurrency.release()
+            await self._asyncio.sleep(delay)
+            attempt += 1
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> AsyncResponse:
+        resp = await self._request(url, headers=headers)
+        async with resp:
+            content = await resp.read()
+            return AsyncResponse(resp.status, dict(resp.headers), content)
+
+    async def download(self, url: str, fname: str, use_cloudscraper: bool = False,
+                       hasher: Optional[StreamHasher] = None, progress: bool = True) -> None:
+        headers = dict(SCRAPER_HEADERS, **{"user-agent": SCRAPER_USER_AGENT}) if use_cloudscraper else None
+        with get_metrics().operation(OP_DOWNLOAD, url=url, path=fname, backend="asyncio") as op:
+            resp = await self._request(url, headers=headers)
+            async with resp:
+                if use_cloudscraper and resp.status in CLOUDFLARE_CHALLENGE_STATUSES:
+                    resp.release()
+                    await self._download_with_cloudscraper(url, fname, hasher)
+                    return
+                await self._write_response(resp, fname, hasher, progress, op)
+
+    async def _write_response(self, resp, fname: str, hasher: Optional[StreamHasher], progress: bool,
+                              op: Operation) -> None:
+        # error page must not be saved as model file or image
+        resp.raise_for_status()
+        total = int(resp.headers.get('content-length', 0))
+        loop = self._asyncio.get_running_loop()
+        throttle = get_http_client().bandwidth.for_url(str(resp.url))
+        with open(fname, 'wb') as file, file_progress_bar(fname, total, enabled=progress) as bar:
+            async for data in resp.content.iter_chunked(self.chunk_size):
+                # chunks go to page cache, only hashing is moved out of the loop
+                size = file.write(data)
+                if hasher is not None:
+                    await loop.run_in_executor(None, hasher.update, data)
+                bar.update(size)
+                op.bytes += size
+                wait = throttle.wait_seconds(size)
+                if wait > 0:
+                    await self._asyncio.sleep(wait)
+
+    async def _download_with_cloudscraper(self, url: str, fname: str, hasher: Optional[StreamHasher]) -> None:
+        def blocking_download():
+            http_client = get_http_client()
+            with http_client.stream(url, use_cloudscraper=True) as resp:
+                resp.raise_for_status()
+                throttle = http_client.bandwidth.for_url(resp.url)
+                with open(fname, 'wb') as file:
+                    for data in resp.iter_content(chunk_size=self.chunk_size):
+                        file.write(data)
+                        if hasher is not None:
+                            hasher.update(data)
+                        throttle.throttle(len(data))
+
+        await self._asyncio.get_running_loop().run_in_executor(None, blocking_download)
+
+    async def _close_session(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def close(self) -> None:
+        self.run(self._close_session())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+_async_engine: Optional[AsyncDownloadEngine] = None
+_async_engine_lock = threading.Lock()
+
+
+def configure_async_engine(**kwargs) -> AsyncDownloadEngine:
+    global _async_engine
+    with _async_engine_lock:
+        _async_engine = AsyncDownloadEngine(**kwargs)
+        return _async_engine
+
+
+def get_async_engine() -> Optional[AsyncDownloadEngine]:
+    # None means blocking requests path
+    with _async_engine_lock:
+        return _async_engine
+
+
+def close_async_engine() -> None:
+    global _async_engine
+    with _async_engine_lock:
+        engine = _async_engine
+        _async_engine = None
+    if engine is not None:
+        engine.close()
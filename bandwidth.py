@@ -0,0 +1,150 @@
+import threading
+import time
+from datetime import datetime, time as day_time
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+from rate_limit import TokenBucket
+
+MB = 1024 * 1024
+
+
+class TimeWindow:
+    """Daily local time window like 22:00-06:00, it may wrap over midnight."""
+
+    def __init__(self, start: day_time, end: day_time):
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def parse(cls, text: str) -> "TimeWindow":
+        start_text, separator, end_text = text.partition("-")
+        if not separator:
+            raise ValueError(f"time window {text!r} is not like 22:00-06:00")
+        try:
+            return cls(day_time.fromisoformat(start_text.strip()), day_time.fromisoformat(end_text.strip()))
+        except ValueError as e:
+            raise ValueError(f"time window {text!r}: {e}")
+
+    def contains(self, moment: day_time) -> bool:
+        if self.start <= self.end:
+            return self.start <= moment < self.end
+        return moment >= self.start or moment < self.end
+
+    def __str__(self):
+        return f"{self.start:%H:%M}-{self.end:%H:%M}"
+
+
+def parse_host_bandwidth(text: str) -> Tuple[Optional[str], float]:
+    # "2" is a cap of every host, "host=2" of one host, MB/s
+    host, separator, value = text.rpartition("=")
+    try:
+        mb_per_second = float(value)
+    except ValueError:
+        raise ValueError(f"bandwidth {text!r} is not like 2 or host=2")
+    if mb_per_second < 0:
+        raise ValueError(f"bandwidth {text!r} is negative")
+    return (host.strip().lower() if separator else None), mb_per_second
+
+
+class TransferThrottle:
+    """Buckets of one transfer: global one and one of its host."""
+
+    def __init__(self, limiter: "BandwidthLimiter", buckets: List[TokenBucket]):
+        self.limiter = limiter
+        self.buckets = buckets
+
+    def wait_seconds(self, size: int) -> float:
+        if not self.buckets or self.limiter.in_full_speed_window():
+            return 0.0
+        # buckets are refilled at the same time, so the transfer waits for the slowest one
+        wait = max(bucket.reserve(size) for bucket in self.buckets)
+        if wait > 0:
+            self.limiter.add_throttled(wait)
+        return wait
+
+    def throttle(self, size: int) -> None:
+        wait = self.wait_seconds(size)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class BandwidthLimiter:
+    """
+    Caps of transferred bytes per second by token buckets: one of the whole run and one per host.
+    Callers take tokens for every chunk they received, so a capped transfer is slowed down by tcp flow control.
+    Inside full speed windows caps are not applied.
+    """
+
+    def __init__(self, max_bytes_per_second: float = 0, host_bytes_per_second: Optional[Dict[str, float]] = None,
+                 default_host_bytes_per_second: float = 0, full_speed_windows: Sequence[TimeWindow] = ()):
+        self.max_bytes_per_second = max_bytes_per_second
+        self.host_bytes_per_second = dict(host_bytes_per_second or {})
+        self.default_host_bytes_per_second = default_host_bytes_per_second
+        self.full_speed_windows = list(full_speed_windows)
+        self._global_bucket = self._new_bucket(max_bytes_per_second)
+        self._lock = threading.Lock()
+        self._host_buckets: Dict[str, Optional[TokenBucket]] = {}
+        self.throttled_seconds = 0.0
+
+    @classmethod
+    def from_options(cls, max_bandwidth: float = 0, host_bandwidth: Sequence[str] = (),
+                     full_speed_windows: Sequence[str] = ()) -> "BandwidthLimiter":
+        # MB/s of command line
+        host_bytes_per_second = {}
+        default_host_bytes_per_second = 0.0
+        for text in host_bandwidth:
+            host, mb_per_second = parse_host_bandwidth(text)
+            if host is None:
+                default_host_bytes_per_second = mb_per_second * MB
+            else:
+                host_bytes_per_second[host] = mb_per_second * MB
+        return cls(max_bytes_per_second=max_bandwidth * MB, host_bytes_per_second=host_bytes_per_second,
+                   default_host_bytes_per_second=default_host_bytes_per_second,
+                   full_speed_windows=[TimeWindow.parse(text) for text in full_speed_windows])
+
+    @staticmethod
+    def _new_bucket(bytes_per_second: float) -> Optional[TokenBucket]:
+        # burst of one second
+        return TokenBucket(bytes_per_second, int(bytes_per_second)) if bytes_per_second > 0 else None
+
+    @property
+    def is_limited(self) -> bool:
+        return self._global_bucket is not None or self.default_host_bytes_per_second > 0 \
+            or any(rate > 0 for rate in self.host_bytes_per_second.values())
+
+    def _host_bucket(self, host: str) -> Optional[TokenBucket]:
+        with self._lock:
+            if host not in self._host_buckets:
+                self._host_buckets[host] = self._new_bucket(
+                    self.host_bytes_per_second.get(host, self.default_host_bytes_per_second))
+            return self._host_buckets[host]
+
+    def for_url(self, url: str) -> TransferThrottle:
+        buckets = [self._global_bucket, self._host_bucket((urlsplit(url).hostname or "").lower())]
+        return TransferThrottle(self, [bucket for bucket in buckets if bucket is not None])
+
+    def in_full_speed_window(self) -> bool:
+        if not self.full_speed_windows:
+            return False
+        now = datetime.now().time()
+        return any(window.contains(now) for window in self.full_speed_windows)
+
+    def add_throttled(self, seconds: float) -> None:
+        with self._lock:
+            self.throttled_seconds += seconds
+
+    def summary(self) -> Optional[str]:
+        if not self.is_limited:
+            return None
+        caps = []
+        if self.max_bytes_per_second > 0:
+            caps.append(f"total {self.max_bytes_per_second / MB:g} MB/s")
+        if self.default_host_bytes_per_second > 0:
+            caps.append(f"every host {self.default_host_bytes_per_second / MB:g} MB/s")
+        caps.extend(f"{host} {rate / MB:g} MB/s" for host, rate in self.host_bytes_per_second.items() if rate > 0)
+        text = f"bandwidth caps: {', '.join(caps)}"
+        if self.full_speed_windows:
+            text += f", full speed {', '.join(str(window) for window in self.full_speed_windows)}"
+        with self._lock:
+            return text + f", transfers waited {self.throttled_seconds:.1f} s"
@@ -0,0 +1,109 @@
+import argparse
+import contextlib
+import io
+import multiprocessing
+import re
+import sys
+import tempfile
+import time
+import uuid
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+from bench_download_backends import serve_images  # noqa: E402
+from description_pics import rewrite_description_pics, REGEX_CIVITAI_IMAGE_FROM_CACHE_PATTERN  # noqa: E402
+from download_scheduler import DownloadScheduler  # noqa: E402
+from http_client import configure_http_client  # noqa: E402
+from main import simple_download, download_description_pic  # noqa: E402
+
+
+def make_description(pics: int, paragraphs_per_pic: int) -> str:
+    parts = []
+    for _ in range(pics):
+        unc, image_uuid = uuid.uuid4().hex[:20], str(uuid.uuid4())
+        for _ in range(paragraphs_per_pic):
+            parts.append("<p>Use <strong>trigger word</strong> with weight 0.7, <em>cfg 7</em>, "
+                         "<a href=\"https://civitai.com/models/1\" target=\"_blank\">base model</a>.</p>")
+        parts.append(f'<p><img src="https://imagecache.civitai.com/{unc}/{uuid.uuid4()}/width=525/{image_uuid}" '
+                     f'alt="sample" width="525"></p>')
+    return "\n".join(parts)
+
+
+def rewrite_with_beautifulsoup(description_html: str):
+    # rewrite of download_pics before the pipeline, without downloads
+    soup = BeautifulSoup(description_html, 'html.parser')
+    pics = []
+    for img_tag in soup.find_all('img'):
+        img_url = img_tag['src']
+        civitai_image_match = re.fullmatch(REGEX_CIVITAI_IMAGE_FROM_CACHE_PATTERN, img_url)
+        if civitai_image_match is None:
+            continue
+        uuid_image_name = civitai_image_match.group("uuid_image2")
+        pics.append(img_url.replace("width=" + civitai_image_match.group("image_width"), 'width=0'))
+        img_tag['src'] = "pics/" + uuid_image_name
+    return str(soup), pics
+
+
+def bench_rewrite(pics: int, paragraphs_per_pic: int, repeats: int) -> None:
+    description_html = make_description(pics, paragraphs_per_pic)
+    for name, rewrite in [("beautifulsoup html.parser", rewrite_with_beautifulsoup),
+                          ("src rewrite", rewrite_description_pics)]:
+        started = time.perf_counter()
+        for _ in range(repeats):
+            rewrite(description_html)
+        elapsed = (time.perf_counter() - started) / repeats
+        print(f"rewrite {name:28}: {elapsed * 1000:8.2f} ms per description "
+              f"({len(description_html) / 1024:.0f} KB, {pics} pics)")
+
+
+def fetch_serial(urls, target_dir: str, concurrency: int) -> None:
+    for index, url in enumerate(urls):
+        simple_download(url, path.join(target_dir, str(index)), use_cloudscraper=True)
+
+
+def fetch_scheduler(urls, target_dir: str, concurrency: int) -> None:
+    scheduler = DownloadScheduler(max_image_downloads=concurrency)
+    for index, url in enumerate(urls):
+        scheduler.submit_image(url, download_description_pic, url, path.join(target_dir, str(index)))
+    scheduler.wait()
+    scheduler.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Description pictures: html rewrite and fetch, before and now")
+    parser.add_argument("--pics", type=int, default=40, help="pictures per description")
+    parser.add_argument("--paragraphs-per-pic", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--image-size-kb", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=80, help="server think time per picture")
+    parser.add_argument("--concurrency", type=int, default=8, help="--max-image-downloads of the pipeline")
+    args = parser.parse_args()
+
+    bench_rewrite(args.pics, args.paragraphs_per_pic, args.repeats)
+
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=serve_images,
+                                             args=(port_queue, args.image_size_kb * 1024, args.latency_ms),
+                                             daemon=True)
+    server_process.start()
+    port = port_queue.get()
+    urls = [f"http://127.0.0.1:{port}/pic/{index}" for index in range(args.pics)]
+    configure_http_client(pool_size=args.concurrency, per_host_limit=args.concurrency)
+    try:
+        for name, fetch in [("serial", fetch_serial), (f"scheduler x{args.concurrency}", fetch_scheduler)]:
+            with tempfile.TemporaryDirectory(prefix="bench_pics_") as target_dir:
+                started = time.perf_counter()
+                with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(io.StringIO()):
+                    fetch(urls, target_dir, args.concurrency)
+                elapsed = time.perf_counter() - started
+            print(f"fetch {name:30}: {elapsed:7.2f} s for {args.pics} pics, latency = {args.latency_ms} ms")
+    finally:
+        server_process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import argparse
+import contextlib
+import http.server
+import importlib
+import io
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from async_engine import configure_async_engine, close_async_engine  # noqa: E402
+from download_scheduler import DownloadScheduler  # noqa: E402
+from http_client import configure_http_client  # noqa: E402
+from main import simple_download  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def serve_images(port_queue, image_size: int, latency_ms: float) -> None:
+    # stub of image cache: every path answers image_size bytes after latency_ms
+    body = os.urandom(image_size)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(http.server.ThreadingHTTPServer):
+        daemon_threads = True
+        # default backlog of 5 drops connects of wide bursts and measures tcp retransmit timeout
+        request_queue_size = 1024
+
+    server = Server(("127.0.0.1", 0), Handler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def run_threads(urls, target_dir: str, concurrency: int) -> int:
+    scheduler = DownloadScheduler(max_image_downloads=concurrency)
+    for index, url in enumerate(urls):
+        scheduler.submit_image(url, simple_download, url, path.join(target_dir, f"{index}.jpeg"))
+    peak_threads = threading.active_count()
+    scheduler.wait()
+    scheduler.shutdown()
+    return peak_threads
+
+
+def run_asyncio(urls, target_dir: str, concurrency: int) -> int:
+    async_engine = configure_async_engine(pool_size=concurrency, per_host_limit=concurrency)
+    scheduler = DownloadScheduler(max_image_downloads=concurrency, async_engine=async_engine)
+    for index, url in enumerate(urls):
+        scheduler.submit_image_coroutine(url, async_engine.download, url, path.join(target_dir, f"{index}.jpeg"),
+                                         progress=False)
+    peak_threads = threading.active_count()
+    scheduler.wait()
+    scheduler.shutdown()
+    close_async_engine()
+    return peak_threads
+
+
+BACKEND_RUNNERS = {"threads": run_threads, "asyncio": run_asyncio}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sample image download throughput of threads vs asyncio backend")
+    parser.add_argument("--images", type=int, default=2000)
+    parser.add_argument("--image-size-kb", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=50, help="server think time per request")
+    parser.add_argument("--concurrency", type=int, action="append",
+                        help="parallel downloads, can be repeated (default 8 and 64)")
+    parser.add_argument("--backend", action="append", choices=list(BACKEND_RUNNERS.keys()))
+    args = parser.parse_args()
+
+    # aiohttp import is not part of measured time, missing aiohttp fails before the server is started
+    importlib.import_module("aiohttp")
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=serve_images,
+                                             args=(port_queue, args.image_size_kb * 1024, args.latency_ms),
+                                             daemon=True)
+    server_process.start()
+    port = port_queue.get()
+    urls = [f"http://127.0.0.1:{port}/img/{index}" for index in range(args.images)]
+    total_mb = args.images * args.image_size_kb / 1024
+    print(f"images = {args.images}, size = {args.image_size_kb} KB, latency = {args.latency_ms} ms")
+
+    try:
+        for concurrency in args.concurrency or [8, 64]:
+            configure_http_client(pool_size=concurrency, per_host_limit=concurrency)
+            for backend in args.backend or BACKEND_RUNNERS.keys():
+                with tempfile.TemporaryDirectory(prefix="bench_download_") as target_dir:
+                    started = time.perf_counter()
+                    # progress bars of every image are noise here
+                    with contextlib.redirect_stderr(io.StringIO()):
+                        peak_threads = BACKEND_RUNNERS[backend](urls, target_dir, concurrency)
+                    elapsed = time.perf_counter() - started
+                print(f"{backend:8} concurrency = {concurrency:4}: {elapsed:7.2f} s, "
+                      f"{args.images / elapsed:8.1f} images/s, {total_mb / elapsed:7.1f} MB/s, "
+                      f"threads = {peak_threads}")
+    finally:
+        server_process.terminate()
+
+
+if __name__ == "__main__":
+    main()
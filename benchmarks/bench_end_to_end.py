@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from os import path
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from civitai_stub import StubLibrary, start_stub_server, add_library_arguments, library_from_arguments  # noqa: E402
+
+MAIN_PY = path.join(path.dirname(path.dirname(path.abspath(__file__))), "main.py")
+
+# synthetic libraries of growing size: (users, models per user, versions, files per version, file MB, images)
+PRESETS = {
+    "small": dict(users=1, models_per_user=3, versions_per_model=2, files_per_version=1, file_size_mb=4,
+                  images_per_version=4),
+    "medium": dict(users=1, models_per_user=12, versions_per_model=2, files_per_version=1, file_size_mb=16,
+                   images_per_version=8),
+    "large": dict(users=1, models_per_user=40, versions_per_model=3, files_per_version=2, file_size_mb=32,
+                  images_per_version=10),
+}
+
+
+def stub_stats(base_url: str) -> dict:
+    with urllib.request.urlopen(f"{base_url}/__stats") as r:
+        return json.load(r)
+
+
+def run_step(name: str, command_args, env, base_url: str, verbose: bool) -> dict:
+    # every step is own process: peak rss is of this step only, imports and startup are counted
+    stats_before = stub_stats(base_url)
+    output = None if verbose else subprocess.DEVNULL
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, MAIN_PY] + command_args, env=env, stdout=output, stderr=output)
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    stats_after = stub_stats(base_url)
+    transferred = stats_after["bytes_sent"] - stats_before["bytes_sent"]
+    requests = {kind: count - stats_before["requests"].get(kind, 0)
+                for kind, count in stats_after["requests"].items()
+                if count != stats_before["requests"].get(kind, 0) and kind != "stats"}
+    return {"step": name,
+            "exit_code": process.returncode,
+            "seconds": elapsed,
+            "mb": transferred / 1024 / 1024,
+            "mb_per_s": transferred / 1024 / 1024 / elapsed if elapsed > 0 else 0.0,
+            # ru_maxrss is KB on linux
+            "peak_rss_mb": rusage.ru_maxrss / 1024,
+            "user_cpu_s": rusage.ru_utime,
+            "system_cpu_s": rusage.ru_stime,
+            "requests": requests}
+
+
+def run_scenario(name: str, library: StubLibrary, latency_ms: float, bandwidth_mbps: float,
+                 extra_args, verbose: bool) -> list:
+    print(f"{name}: hash synthetic files ({library.total_file_bytes / 1024 / 1024:.0f} MB of models, "
+          f"{library.total_image_bytes / 1024 / 1024:.0f} MB of images)", file=sys.stderr)
+    library.compute_hashes()
+    server, _ = start_stub_server(library, latency_ms=latency_ms, bandwidth_mbps=bandwidth_mbps)
+    env = dict(os.environ, CIVITAI_BASE_URL=library.base_url)
+    user_name = next(iter(library.user_models))
+    model_id = library.user_models[user_name][0]
+    root_dir = tempfile.mkdtemp(prefix=f"bench_e2e_{name}_")
+    root_args = ["--sd-webui-root-dir", root_dir]
+    steps = [
+        ("download_model cold", ["download-model-command"] + root_args + extra_args
+         + [f"https://civitai.com/models/{model_id}"]),
+        ("download_models_for_user cold", ["download-models-for-user-command"] + root_args + extra_args
+         + [f"https://civitai.com/user/{user_name}"]),
+        # everything exists, files are verified by hash
+        ("download_models_for_user warm", ["download-models-for-user-command"] + root_args + extra_args
+         + [f"https://civitai.com/user/{user_name}"]),
+        ("verify_library", ["verify-library-command"] + root_args + ["--report", path.join(root_dir, "report.json")]),
+    ]
+    results = []
+    try:
+        for step_name, command_args in steps:
+            result = run_step(step_name, command_args, env, library.base_url, verbose)
+            result["scenario"] = name
+            results.append(result)
+            print(f"{name:8} {step_name:32} exit = {result['exit_code']}, {result['seconds']:7.2f} s, "
+                  f"{result['mb']:8.1f} MB, {result['mb_per_s']:7.1f} MB/s, "
+                  f"peak rss = {result['peak_rss_mb']:6.1f} MB")
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(root_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end runs of main.py against local civitai stub")
+    parser.add_argument("--scenario", choices=list(PRESETS) + ["custom"], action="append",
+                        help="Library presets, by default small and medium. custom uses library options below")
+    add_library_arguments(parser)
+    parser.add_argument("--main-args", type=str, default="",
+                        help="Extra options of download commands, like '--backend asyncio --download-segments 4'")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json to compare runs")
+    parser.add_argument("--verbose", action="store_true", help="Show output of main.py")
+    args = parser.parse_args()
+
+    if not hasattr(os, "wait4"):
+        parser.error("peak rss of steps is measured by os.wait4, available on unix only")
+
+    results = []
+    for name in args.scenario or ["small", "medium"]:
+        if name == "custom":
+            library = library_from_arguments(args)
+        else:
+            library = StubLibrary(page_size=args.page_size, image_size_kb=args.image_size_kb, **PRESETS[name])
+        results.extend(run_scenario(name, library, args.latency_ms, args.bandwidth_mbps,
+                                    shlex.split(args.main_args), args.verbose))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"main_args": args.main_args,
+                       "latency_ms": args.latency_ms,
+                       "bandwidth_mbps": args.bandwidth_mbps,
+                       "python": sys.version.split()[0],
+                       "results": results}, f, indent=2)
+        print(f"results saved to {args.output}", file=sys.stderr)
+    if any(result["exit_code"] != 0 for result in results):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
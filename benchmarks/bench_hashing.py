@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from hashing import hash_file, HASH_STRATEGY_BUFFERED, HASH_STRATEGY_MMAP, HASH_READ_BUFFER_SIZE  # noqa: E402
+
+MB = 1024 * 1024
+
+# name -> (algorithms, hash_file kwargs)
+STRATEGIES = {
+    "legacy_4k_blake3": (["BLAKE3"], dict(strategy=HASH_STRATEGY_BUFFERED, buffer_size=4096, blake3_max_threads=1)),
+    "buffered_blake3_1_thread": (["BLAKE3"], dict(strategy=HASH_STRATEGY_BUFFERED, blake3_max_threads=1)),
+    "buffered_blake3": (["BLAKE3"], dict(strategy=HASH_STRATEGY_BUFFERED)),
+    "mmap_blake3": (["BLAKE3"], dict(strategy=HASH_STRATEGY_MMAP)),
+    "mmap_blake3_64m": (["BLAKE3"], dict(strategy=HASH_STRATEGY_MMAP, buffer_size=64 * MB)),
+    "buffered_sha256": (["SHA256"], dict(strategy=HASH_STRATEGY_BUFFERED)),
+    "buffered_all_sequential": (["SHA256", "BLAKE3", "CRC32", "AutoV2"],
+                                dict(strategy=HASH_STRATEGY_BUFFERED, parallel_algorithms=False)),
+    "buffered_all_parallel": (["SHA256", "BLAKE3", "CRC32", "AutoV2"], dict(strategy=HASH_STRATEGY_BUFFERED)),
+    "mmap_all_parallel": (["SHA256", "BLAKE3", "CRC32", "AutoV2"], dict(strategy=HASH_STRATEGY_MMAP)),
+}
+
+
+def create_synthetic_file(file_path: str, size_mb: int) -> None:
+    block = os.urandom(MB)
+    with open(file_path, "wb") as f:
+        for index in range(size_mb):
+            # cheap variation of block, so file is not the same megabyte repeated
+            f.write(index.to_bytes(8, "little") + block[8:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hashing throughput per strategy (MB/s)")
+    parser.add_argument("--size-mb", type=int, default=2048, help="size of synthetic file")
+    parser.add_argument("--file", type=str, default=None, help="hash existing file instead of synthetic one")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--strategy", action="append", choices=list(STRATEGIES.keys()),
+                        help="run only this strategy, can be repeated")
+    args = parser.parse_args()
+
+    temp_dir = None
+    file_path = args.file
+    if file_path is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="bench_hashing_")
+        file_path = path.join(temp_dir.name, "synthetic.bin")
+        print(f"create synthetic file {args.size_mb} MB")
+        create_synthetic_file(file_path, args.size_mb)
+
+    size_mb = os.path.getsize(file_path) / MB
+    print(f"file = {file_path}, size = {size_mb:.0f} MB, default buffer = {HASH_READ_BUFFER_SIZE // MB} MB")
+    print("note: file is in page cache after the first pass, numbers show cpu bound hashing speed")
+    for name in args.strategy or STRATEGIES.keys():
+        algorithms, kwargs = STRATEGIES[name]
+        best = None
+        for _ in range(args.repeat):
+            begin = time.perf_counter()
+            hash_file(file_path, algorithms, **kwargs)
+            elapsed = time.perf_counter() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{name:28s} {size_mb / best:10.1f} MB/s  ({best:.2f} s)")
+
+    if temp_dir is not None:
+        temp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import contextlib
+import http.server
+import io
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from download_scheduler import DownloadScheduler  # noqa: E402
+from http_client import configure_http_client  # noqa: E402
+from main import simple_download  # noqa: E402
+
+
+def serve_throttled(port_queue, counters, image_size: int, max_parallel: int, latency_ms: float,
+                    throttle_status: int, retry_after: str) -> None:
+    # stub of civitai cdn: above max_parallel requests in flight answers throttle_status with Retry-After
+    body = os.urandom(image_size)
+    in_flight = [0]
+    lock = threading.Lock()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            with lock:
+                throttled = in_flight[0] >= max_parallel
+                if not throttled:
+                    in_flight[0] += 1
+            if throttled:
+                with counters.get_lock():
+                    counters[1] += 1
+                self.send_response(throttle_status)
+                if retry_after:
+                    self.send_header("Retry-After", retry_after)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            try:
+                time.sleep(latency_ms / 1000)
+                with counters.get_lock():
+                    counters[0] += 1
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            finally:
+                with lock:
+                    in_flight[0] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    class Server(http.server.ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 1024
+
+    server = Server(("127.0.0.1", 0), Handler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def run(urls, concurrency: int, **http_client_options):
+    configure_http_client(pool_size=concurrency, per_host_limit=concurrency, **http_client_options)
+    scheduler = DownloadScheduler(max_image_downloads=concurrency)
+    with tempfile.TemporaryDirectory(prefix="bench_rate_limit_") as target_dir:
+        for index, url in enumerate(urls):
+            scheduler.submit_image(url, simple_download, url, path.join(target_dir, f"{index}.jpeg"))
+        scheduler.wait()
+        scheduler.shutdown()
+    return len(scheduler.failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Downloads against a stub which throttles above N parallel requests")
+    parser.add_argument("--images", type=int, default=400)
+    parser.add_argument("--image-size-kb", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--server-max-parallel", type=int, default=6)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--throttle-status", type=int, choices=[429, 503], default=429)
+    parser.add_argument("--retry-after", type=str, default="1", help="Retry-After header, empty to omit")
+    args = parser.parse_args()
+
+    counters = multiprocessing.Array("l", 2)
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=serve_throttled,
+        args=(port_queue, counters, args.image_size_kb * 1024, args.server_max_parallel, args.latency_ms,
+              args.throttle_status, args.retry_after),
+        daemon=True)
+    server_process.start()
+    port = port_queue.get()
+    urls = [f"http://127.0.0.1:{port}/img/{index}" for index in range(args.images)]
+    print(f"images = {args.images}, concurrency = {args.concurrency}, server allows {args.server_max_parallel} "
+          f"parallel, answers {args.throttle_status} with Retry-After = {args.retry_after or 'none'}")
+
+    variants = {
+        "no retries": dict(retries=0, adaptive_concurrency=False),
+        "retries, fixed concurrency": dict(retries=8, adaptive_concurrency=False, max_backoff=5),
+        "retries, adaptive concurrency": dict(retries=8, adaptive_concurrency=True, max_backoff=5),
+        "adaptive and token bucket 100/s": dict(retries=8, adaptive_concurrency=True, max_backoff=5,
+                                                rate_limit=100, rate_burst=8),
+    }
+    try:
+        for name, options in variants.items():
+            with counters.get_lock():
+                counters[0] = counters[1] = 0
+            started = time.perf_counter()
+            with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(io.StringIO()):
+                failures = run(urls, args.concurrency, **options)
+            elapsed = time.perf_counter() - started
+            print(f"{name:32}: {elapsed:6.2f} s, ok answers = {counters[0]:5}, "
+                  f"throttled answers = {counters[1]:5}, failed images = {failures}")
+    finally:
+        server_process.terminate()
+
+
+if __name__ == "__main__":
+    main()
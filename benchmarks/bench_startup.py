@@ -0,0 +1,107 @@
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+import time
+from os import path
+
+ROOT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+MAIN_PY = path.join(ROOT_DIR, "main.py")
+
+COMMANDS = [
+    ["--help"],
+    ["download-model-command", "--help"],
+    ["verify-library-command", "--help"],
+]
+# modules what only network or asyncio backend code paths need, they must not be imported by main.py itself
+DEFAULT_FORBIDDEN_MODULES = ["requests", "urllib3", "cloudscraper", "asyncio", "aiohttp", "tqdm", "bs4",
+                             "email.utils", "multiprocessing"]
+
+IMPORTTIME_LINE_REGEX_PATTERN = re.compile(r"^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<name>.*)$")
+
+
+def wall_times(args, runs: int):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def top_imports(top: int):
+    # first level imports of main.py by cumulative time, from python -X importtime
+    stderr = subprocess.run([sys.executable, "-X", "importtime", MAIN_PY, "--help"], cwd=ROOT_DIR,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE_REGEX_PATTERN.match(line)
+        if match is None:
+            continue
+        name = match.group("name")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(match.group("cumulative")), depth, name.strip()))
+    total_us = sum(cumulative for cumulative, depth, _ in rows if depth == 0)
+    return total_us, sorted([row for row in rows if row[1] <= 1], reverse=True)[:top]
+
+
+def loaded_modules(modules):
+    code = ("import sys; sys.argv = ['main.py']; sys.path.insert(0, '.'); import main; "
+            f"print(' '.join(m for m in {modules!r} if m in sys.modules))")
+    stdout = subprocess.run([sys.executable, "-c", code], cwd=ROOT_DIR, stdout=subprocess.PIPE, text=True,
+                            check=True).stdout
+    return stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time of main.py commands, with -X importtime breakdown")
+    parser.add_argument("--runs", type=int, default=15)
+    parser.add_argument("--top", type=int, default=15, help="slowest imports to show")
+    parser.add_argument("--budget-ms", type=float, default=None,
+                        help="fail when median startup above bare interpreter exceeds this")
+    parser.add_argument("--forbid", action="append", default=None,
+                        help=f"module what must not be imported by main.py (default {DEFAULT_FORBIDDEN_MODULES})")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json to compare runs")
+    args = parser.parse_args()
+
+    interpreter_ms = statistics.median(wall_times(["-c", "pass"], args.runs)) * 1000
+    print(f"{'python -c pass':45}: median {interpreter_ms:7.1f} ms")
+    results = {"interpreter_ms": interpreter_ms, "commands": {}}
+    failed = False
+    for command in COMMANDS:
+        times = wall_times([MAIN_PY] + command, args.runs)
+        median_ms = statistics.median(times) * 1000
+        name = "main.py " + " ".join(command)
+        results["commands"][name] = {"median_ms": median_ms, "min_ms": min(times) * 1000,
+                                     "above_interpreter_ms": median_ms - interpreter_ms}
+        print(f"{name:45}: median {median_ms:7.1f} ms, min {min(times) * 1000:7.1f} ms, "
+              f"above interpreter {median_ms - interpreter_ms:7.1f} ms")
+        if args.budget_ms is not None and median_ms - interpreter_ms > args.budget_ms:
+            print(f"\tover budget of {args.budget_ms} ms")
+            failed = True
+
+    total_us, rows = top_imports(args.top)
+    print(f"\n-X importtime of main.py --help: {total_us / 1000:.1f} ms in imports, slowest:")
+    for cumulative, depth, name in rows:
+        print(f"\t{cumulative / 1000:7.1f} ms  {'  ' * depth}{name}")
+    results["imports_ms"] = total_us / 1000
+
+    forbidden = args.forbid or DEFAULT_FORBIDDEN_MODULES
+    loaded = loaded_modules(forbidden)
+    results["forbidden_loaded"] = loaded
+    if loaded:
+        print(f"\nimported at startup, but should be lazy: {', '.join(loaded)}")
+        failed = True
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
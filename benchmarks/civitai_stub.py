@@ -0,0 +1,338 @@
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+from blake3 import blake3
+
+MB = 1024 * 1024
+BLOCK_SIZE = MB
+BLOCK_HEADER_SIZE = 16
+WRITE_CHUNK_SIZE = 64 * 1024
+# width of synthetic sample images, smaller widths of imagecache url are served with fewer bytes
+IMAGE_WIDTH = 1024
+# account and uuid segments of imagecache urls
+IMAGE_URL_PREFIX = "/images/xG1nkqKTMzGDvpLrqFT7WA/00000000-0000-0000-0000-000000000000"
+
+# one random block shared by all synthetic files, every block of a file gets its own header,
+# so files are distinct (different hashes) without keeping their content in memory
+_BASE_BLOCK = os.urandom(BLOCK_SIZE)
+
+
+class SyntheticBlob:
+    def __init__(self, key: str, size: int):
+        self.key = key
+        self.size = size
+        self._key_digest = hashlib.sha256(key.encode("utf-8")).digest()[:8]
+        self.blake3 = None
+
+    def _block(self, index: int) -> bytes:
+        header = self._key_digest + index.to_bytes(BLOCK_HEADER_SIZE - 8, "little")
+        return header + _BASE_BLOCK[BLOCK_HEADER_SIZE:]
+
+    def read(self, start: int, end: int):
+        # yields content of [start, end)
+        position = start
+        while position < end:
+            index, offset = divmod(position, BLOCK_SIZE)
+            block = self._block(index)
+            piece = block[offset:min(BLOCK_SIZE, offset + end - position)]
+            yield piece
+            position += len(piece)
+
+    def compute_blake3(self) -> str:
+        hasher = blake3(max_threads=blake3.AUTO)
+        for piece in self.read(0, self.size):
+            hasher.update(piece)
+        self.blake3 = hasher.hexdigest().upper()
+        return self.blake3
+
+
+class StubLibrary:
+    """Synthetic civitai models of one or more users, with files and sample images served by StubServer."""
+
+    def __init__(self, users: int = 1, models_per_user: int = 5, versions_per_model: int = 2,
+                 files_per_version: int = 1, file_size_mb: float = 8, images_per_version: int = 5,
+                 image_size_kb: int = 200, page_size: int = 20):
+        self.page_size = page_size
+        self.base_url = ""
+        self.models: Dict[int, dict] = {}
+        self.user_models: Dict[str, List[int]] = {}
+        self.blobs: Dict[str, SyntheticBlob] = {}
+        self._variants: Dict[str, SyntheticBlob] = {}
+        self._variants_lock = threading.Lock()
+        model_id = 1000
+        for user_index in range(users):
+            user_name = f"user{user_index}"
+            self.user_models[user_name] = []
+            for _ in range(models_per_user):
+                model_id += 1
+                self.user_models[user_name].append(model_id)
+                self.models[model_id] = self._create_model(model_id, user_name, versions_per_model,
+                                                           files_per_version, int(file_size_mb * MB),
+                                                           images_per_version, image_size_kb * 1024)
+
+    def _create_model(self, model_id: int, user_name: str, versions: int, files: int, file_size: int,
+                      images: int, image_size: int) -> dict:
+        model_versions = []
+        for version_index in range(versions):
+            version_id = model_id * 100 + version_index
+            version_files = []
+            for file_index in range(files):
+                key = f"file-{version_id}-{file_index}"
+                self.blobs[key] = SyntheticBlob(key, file_size)
+                version_files.append({"name": f"model_{version_id}_{file_index}.safetensors",
+                                      "type": "Model",
+                                      "sizeKB": file_size / 1024,
+                                      "pickleScanResult": "Success",
+                                      "virusScanResult": "Success",
+                                      "downloadUrl": f"/api/download/models/{version_id}?file={file_index}",
+                                      "hashes": {}})
+            version_images = []
+            for image_index in range(images):
+                key = f"image-{version_id}-{image_index}"
+                self.blobs[key] = SyntheticBlob(key, image_size)
+                version_images.append({"url": f"{IMAGE_URL_PREFIX}/width={IMAGE_WIDTH}/{key}.jpeg",
+                                       "width": IMAGE_WIDTH,
+                                       "height": IMAGE_WIDTH,
+                                       "hash": f"U{hashlib.sha256(key.encode()).hexdigest()[:30]}",
+                                       "meta": {"seed": image_index, "prompt": f"synthetic {key}"}})
+            model_versions.append({"id": version_id,
+                                   "name": f"v{version_index}.0",
+                                   "updatedAt": "2023-04-01T00:00:00.000Z",
+                                   "baseModel": "SD 1.5",
+                                   "files": version_files,
+                                   "images": version_images})
+        return {"id": model_id,
+                "name": f"Synthetic model {model_id}",
+                "type": "LORA",
+                "nsfw": False,
+                "description": None,
+                "creator": {"username": user_name},
+                "stats": {"downloadCount": 0},
+                "modelVersions": model_versions}
+
+    def compute_hashes(self) -> None:
+        for model in self.models.values():
+            for version in model["modelVersions"]:
+                for file_index, version_file in enumerate(version["files"]):
+                    blob = self.blobs[f"file-{version['id']}-{file_index}"]
+                    version_file["hashes"] = {"BLAKE3": blob.blake3 or blob.compute_blake3()}
+
+    @property
+    def total_file_bytes(self) -> int:
+        return sum(blob.size for key, blob in self.blobs.items() if key.startswith("file-"))
+
+    @property
+    def total_image_bytes(self) -> int:
+        return sum(blob.size for key, blob in self.blobs.items() if key.startswith("image-"))
+
+    def _absolute(self, model: dict) -> dict:
+        # urls of library are relative, server port is known only after start
+        model = json.loads(json.dumps(model))
+        for version in model["modelVersions"]:
+            for version_file in version["files"]:
+                version_file["downloadUrl"] = self.base_url + version_file["downloadUrl"]
+            for image in version["images"]:
+                image["url"] = self.base_url + image["url"]
+        return model
+
+    def image_variant(self, key: str, options: str) -> Optional[SyntheticBlob]:
+        # bytes scale with pixels of requested width, like resized jpeg of imagecache
+        blob = self.blobs.get(key)
+        widths = re.findall(r"width=(\d+)", options)
+        width = int(widths[0]) if widths else 0
+        if blob is None or width == 0 or width >= IMAGE_WIDTH:
+            return blob
+        variant_key = f"{key}/{options}"
+        with self._variants_lock:
+            if variant_key not in self._variants:
+                self._variants[variant_key] = SyntheticBlob(variant_key,
+                                                            max(1024, int(blob.size * (width / IMAGE_WIDTH) ** 2)))
+            return self._variants[variant_key]
+
+    def model_json(self, model_id: int) -> Optional[dict]:
+        model = self.models.get(model_id)
+        return self._absolute(model) if model is not None else None
+
+    def user_page_json(self, query: dict) -> dict:
+        # like civitai: filters of query are applied on server and kept in nextPage
+        user_name = query.get("username", [""])[0]
+        page = int(query.get("page", ["1"])[0])
+        limit = int(query.get("limit", [str(self.page_size)])[0])
+        types = query.get("types")
+        model_ids = [model_id for model_id in self.user_models.get(user_name, [])
+                     if not types or self.models[model_id]["type"] in types]
+        items = [self._absolute(self.models[model_id]) for model_id in model_ids[(page - 1) * limit:page * limit]]
+        metadata = {"totalItems": len(model_ids), "currentPage": page, "pageSize": limit}
+        if page * limit < len(model_ids):
+            next_query = dict(query, page=[str(page + 1)], limit=[str(limit)])
+            metadata["nextPage"] = f"{self.base_url}/api/v1/models?{urlencode(next_query, doseq=True)}"
+        return {"items": items, "metadata": metadata}
+
+
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.bytes_sent = 0
+
+    def count(self, kind: str, sent: int = 0) -> None:
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.bytes_sent += sent
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {"requests": dict(self.requests), "bytes_sent": self.bytes_sent}
+
+
+def make_handler(library: StubLibrary, stats: StubStats, latency_ms: float, bandwidth_mbps: float):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, kind: str, data: dict) -> None:
+            body = json.dumps(data).encode("utf-8")
+            etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                stats.count(kind + "_304")
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            stats.count(kind, len(body))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_not_found(self) -> None:
+            stats.count("not_found")
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def _send_blob(self, kind: str, blob: SyntheticBlob) -> None:
+            start, end = 0, blob.size
+            range_match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if range_match:
+                start = int(range_match.group(1))
+                end = int(range_match.group(2)) + 1 if range_match.group(2) else blob.size
+                end = min(end, blob.size)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{blob.size}")
+            else:
+                self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", f'"{blob.key}"')
+            self.send_header("Content-Length", str(end - start))
+            self.end_headers()
+            # bandwidth is limited per connection, like a cdn edge
+            bytes_per_second = bandwidth_mbps * MB if bandwidth_mbps > 0 else 0
+            started = time.perf_counter()
+            sent = 0
+            for piece in blob.read(start, end):
+                for offset in range(0, len(piece), WRITE_CHUNK_SIZE):
+                    chunk = piece[offset:offset + WRITE_CHUNK_SIZE]
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                    if bytes_per_second:
+                        ahead = sent / bytes_per_second - (time.perf_counter() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            stats.count(kind, sent)
+
+        def do_GET(self):
+            if latency_ms > 0:
+                time.sleep(latency_ms / 1000)
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            model_match = re.fullmatch(r"/api/v1/models/(\d+)", url.path)
+            download_match = re.fullmatch(r"/api/download/models/(\d+)", url.path)
+            image_match = re.fullmatch(r"/images/(?:\w+/[\w-]+/(?P<options>[^/]+)/)?(?P<key>[\w-]+)\.jpeg", url.path)
+            if model_match:
+                model = library.model_json(int(model_match.group(1)))
+                return self._send_json("api_model", model) if model is not None else self._send_not_found()
+            if url.path == "/api/v1/models":
+                return self._send_json("api_user_page", library.user_page_json(query))
+            if download_match:
+                blob = library.blobs.get(f"file-{download_match.group(1)}-{query.get('file', ['0'])[0]}")
+                return self._send_blob("file", blob) if blob is not None else self._send_not_found()
+            if image_match:
+                blob = library.image_variant(image_match.group("key"), image_match.group("options") or "")
+                return self._send_blob("image", blob) if blob is not None else self._send_not_found()
+            if url.path == "/__stats":
+                return self._send_json("stats", stats.to_json())
+            self._send_not_found()
+
+    return Handler
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # default backlog of 5 drops connects of wide bursts
+    request_queue_size = 1024
+
+
+def start_stub_server(library: StubLibrary, port: int = 0, latency_ms: float = 0,
+                      bandwidth_mbps: float = 0) -> Tuple[StubServer, StubStats]:
+    stats = StubStats()
+    server = StubServer(("127.0.0.1", port), make_handler(library, stats, latency_ms, bandwidth_mbps))
+    library.base_url = f"http://127.0.0.1:{server.server_port}"
+    threading.Thread(target=server.serve_forever, name="civitai-stub", daemon=True).start()
+    return server, stats
+
+
+def add_library_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--models-per-user", type=int, default=5)
+    parser.add_argument("--versions-per-model", type=int, default=2)
+    parser.add_argument("--files-per-version", type=int, default=1)
+    parser.add_argument("--file-size-mb", type=float, default=8)
+    parser.add_argument("--images-per-version", type=int, default=5)
+    parser.add_argument("--image-size-kb", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay before every answer")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0, help="MB/s per connection, 0 is unlimited")
+
+
+def library_from_arguments(args) -> StubLibrary:
+    return StubLibrary(users=args.users, models_per_user=args.models_per_user,
+                       versions_per_model=args.versions_per_model, files_per_version=args.files_per_version,
+                       file_size_mb=args.file_size_mb, images_per_version=args.images_per_version,
+                       image_size_kb=args.image_size_kb, page_size=args.page_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in of civitai api, downloads and image cache")
+    parser.add_argument("--port", type=int, default=8777)
+    add_library_arguments(parser)
+    args = parser.parse_args()
+    library = library_from_arguments(args)
+    print("hash synthetic files")
+    library.compute_hashes()
+    server, _ = start_stub_server(library, args.port, args.latency_ms, args.bandwidth_mbps)
+    print(f"serving {library.base_url}, set CIVITAI_BASE_URL={library.base_url}")
+    print(f"users: {', '.join(library.user_models)}, first model: {library.base_url}/api/v1/models/"
+          f"{next(iter(library.models))}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os import path
+from typing import Optional, Any, Dict, Iterator, List, Tuple
+from urllib.parse import urlencode
+
+from async_engine import get_async_engine
+from http_client import get_http_client
+from library_layout import unique_tmp_path
+from metrics import get_metrics, Operation, OP_API_FETCH
+
+# overridable for tests against a local stub server
+CIVITAI_BASE_URL = os.environ.get("CIVITAI_BASE_URL", "https://civitai.com").rstrip("/")
+
+API_CACHE_FOLDER_NAME = ".civitai_api_cache"
+# digests of synced models written by older versions, read only
+SYNCED_DIGESTS_FILE_NAME = "synced_digests.json"
+# one file per synced key: workers of a shared root do not overwrite digests of each other
+SYNCED_FOLDER_NAME = "synced"
+DEFAULT_API_CACHE_TTL_SECONDS = 0
+
+CIVITAI_MODEL_REGEX_PATTERN = re.compile(r"^((http|https)://)civitai[.]com/models/(?P<model_id>\d+)")
+CIVITAI_USER_REGEX_PATTERN = re.compile(r"^((http|https)://)civitai[.]com/user/(?P<user_name>\w+)$")
+
+# limit of /api/v1/models is 1..100
+MAX_LISTING_PAGE_LIMIT = 100
+DEFAULT_LISTING_PAGE_LIMIT = 100
+# values of "types" query parameter, other model type filters are checked only on client
+LISTING_TYPES = ["Checkpoint", "TextualInversion", "Hypernetwork", "AestheticGradient", "LORA", "LoCon", "Controlnet",
+                 "Poses"]
+VERSION_DATE_KEYS = ["updatedAt", "publishedAt", "createdAt"]
+
+# counters, likes and ratings change all the time and do not mean anything for downloaded files
+VOLATILE_KEYS = {"stats"}
+
+
+def model_api_url(model_id: Any) -> str:
+    return f"{CIVITAI_BASE_URL}/api/v1/models/{model_id}"
+
+
+class ListingFilters:
+    """
+    Filters of model listing. Supported ones are sent as query parameters, so the server sends less metadata,
+    and every item is checked again on client (updated_since has no api parameter).
+    """
+
+    def __init__(self, model_type: Optional[str] = None, base_models: Optional[List[str]] = None,
+                 nsfw: Optional[bool] = None, updated_since: Optional[datetime] = None,
+                 limit: int = DEFAULT_LISTING_PAGE_LIMIT):
+        self.model_type = model_type if model_type is not None and model_type.upper() != "NONE" else None
+        self.base_models = list(base_models or [])
+        self.nsfw = nsfw
+        self.updated_since = updated_since
+        self.limit = min(limit, MAX_LISTING_PAGE_LIMIT)
+
+    def query_params(self) -> List[Tuple[str, str]]:
+        params = [("limit", str(self.limit))]
+        if self.model_type in LISTING_TYPES:
+            params.append(("types", self.model_type))
+        params.extend(("baseModels", base_model) for base_model in self.base_models)
+        if self.nsfw is not None:
+            params.append(("nsfw", "true" if self.nsfw else "false"))
+        return params
+
+    def skip_reason(self, item: Dict[str, Any]) -> Optional[str]:
+        if self.model_type is not None and item["type"] != self.model_type:
+            return f"filter enabled to download {self.model_type} only"
+        versions = item.get("modelVersions") or []
+        if self.base_models and not any(version.get("baseModel") in self.base_models for version in versions):
+            return f"no version with base model {', '.join(self.base_models)}"
+        if self.nsfw is not None and bool(item.get("nsfw")) != self.nsfw:
+            return "nsfw filter"
+        if self.updated_since is not None:
+            # iso dates of civitai compare as strings
+            since = self.updated_since.strftime("%Y-%m-%dT%H:%M:%S")
+            if not any((version.get(key) or "") >= since for version in versions for key in VERSION_DATE_KEYS):
+                return f"no version updated since {since}"
+        return None
+
+
+def version_timestamp(model_version_json: Dict[str, Any]) -> Optional[float]:
+    # the latest of update, publish and create dates of civitai version
+    timestamps = []
+    for key in VERSION_DATE_KEYS:
+        try:
+            timestamps.append(datetime.fromisoformat(model_version_json[key].replace("Z", "+00:00")).timestamp())
+        except (KeyError, AttributeError, ValueError):
+            pass
+    return max(timestamps) if timestamps else None
+
+
+def user_models_api_url(user_name: str, listing_filters: Optional[ListingFilters] = None) -> str:
+    if listing_filters is None:
+        return f"{CIVITAI_BASE_URL}/api/v1/models?username={user_name}"
+    return f"{CIVITAI_BASE_URL}/api/v1/models?" + urlencode([("username", user_name)] + listing_filters.query_params())
+
+
+def _without_volatile_keys(data: Any) -> Any:
+    if isinstance(data, dict):
+        return {key: _without_volatile_keys(value) for key, value in data.items() if key not in VOLATILE_KEYS}
+    if isinstance(data, list):
+        return [_without_volatile_keys(value) for value in data]
+    return data
+
+
+def content_digest(data: Any) -> str:
+    canonical = json.dumps(_without_volatile_keys(data), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ApiResponse:
+    def __init__(self, status_code: int, data: Any = None, from_cache: bool = False, not_modified: bool = False):
+        self.status_code = status_code
+        self.data = data
+        # from_cache: served without request because entry is younger than ttl
+        self.from_cache = from_cache
+        # not_modified: server answered 304 for conditional request
+        self.not_modified = not_modified
+
+    def json(self) -> Any:
+        return self.data
+
+
+class CivitaiApiClient:
+    """
+    GET of civitai api json with on-disk response store.
+    Stored entries younger than ttl are returned without request, older ones are revalidated
+    with If-None-Match / If-Modified-Since. Digests of synced models let callers skip unchanged models.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, ttl_seconds: float = DEFAULT_API_CACHE_TTL_SECONDS):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._synced_digests: Dict[str, str] = {}
+        if cache_dir is not None:
+            os.makedirs(path.join(cache_dir, SYNCED_FOLDER_NAME), exist_ok=True)
+            synced_digests_path = path.join(cache_dir, SYNCED_DIGESTS_FILE_NAME)
+            if path.isfile(synced_digests_path):
+                with open(synced_digests_path, "r") as f:
+                    self._synced_digests = json.load(f)
+
+    @classmethod
+    def for_sd_webui_root(cls, sd_webui_root_dir: str,
+                          ttl_seconds: float = DEFAULT_API_CACHE_TTL_SECONDS) -> "CivitaiApiClient":
+        return cls(cache_dir=path.join(path.abspath(sd_webui_root_dir), API_CACHE_FOLDER_NAME),
+                   ttl_seconds=ttl_seconds)
+
+    def _entry_path(self, url: str) -> Optional[str]:
+        if self.cache_dir is None:
+            return None
+        return path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _load_entry(self, url: str) -> Optional[Dict[str, Any]]:
+        entry_path = self._entry_path(url)
+        if entry_path is None or not path.isfile(entry_path):
+            return None
+        try:
+            with open(entry_path, "r") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    def _save_entry(self, url: str, entry: Dict[str, Any]) -> None:
+        entry_path = self._entry_path(url)
+        if entry_path is None:
+            return
+        tmp_entry_path = unique_tmp_path(entry_path)
+        with open(tmp_entry_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_entry_path, entry_path)
+
+    def get_json(self, url: str) -> ApiResponse:
+        with get_metrics().operation(OP_API_FETCH, url=url) as op:
+            api_response = self._get_json(url, op)
+            op.cache_hit = api_response.from_cache or api_response.not_modified
+            op.fields["status"] = api_response.status_code
+            return api_response
+
+    def _get_json(self, url: str, op: Operation) -> ApiResponse:
+        entry = self._load_entry(url)
+        now = time.time()
+        if entry is not None and now - entry["fetched_at"] < self.ttl_seconds:
+            return ApiResponse(200, entry["body"], from_cache=True)
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        async_engine = get_async_engine()
+        if async_engine is not None:
+            r = async_engine.run(async_engine.get(url, headers=headers))
+        else:
+            r = get_http_client().get(url, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            entry["fetched_at"] = now
+            self._save_entry(url, entry)
+            return ApiResponse(200, entry["body"], not_modified=True)
+        if r.status_code != 200:
+            return ApiResponse(r.status_code)
+
+        op.bytes = len(r.content)
+        body = r.json()
+        self._save_entry(url, {"url": url,
+                               "etag": r.headers.get("etag"),
+                               "last_modified": r.headers.get("last-modified"),
+                               "fetched_at": now,
+                               "body": body})
+        return ApiResponse(200, body)
+
+    def _synced_path(self, key: str) -> str:
+        return path.join(self.cache_dir, SYNCED_FOLDER_NAME, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _synced_digest(self, key: str) -> Optional[str]:
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._synced_path(key), "r") as f:
+                return json.load(f).get("digest")
+        except FileNotFoundError:
+            with self._lock:
+                return self._synced_digests.get(key)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def is_synced(self, key: str, data: Any) -> bool:
+        return self._synced_digest(key) == content_digest(data)
+
+    def mark_synced(self, key: str, data: Any) -> None:
+        if self.cache_dir is None:
+            return
+        synced_path = self._synced_path(key)
+        tmp_synced_path = unique_tmp_path(synced_path)
+        with open(tmp_synced_path, "w") as f:
+            json.dump({"key": key, "digest": content_digest(data)}, f)
+        os.replace(tmp_synced_path, synced_path)
+
+
+def iter_listing_pages(api_client: CivitaiApiClient, first_page_url: str) -> Iterator[ApiResponse]:
+    """
+    Pages of a paginated listing. nextPage is fetched in background while the caller processes the current page.
+    Iteration stops after a page with error status.
+    """
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="listing-prefetch") as executor:
+        pending_page = executor.submit(api_client.get_json, first_page_url)
+        while pending_page is not None:
+            r = pending_page.result()
+            pending_page = None
+            if r.status_code == 200:
+                next_page = r.json()["metadata"].get("nextPage")
+                if next_page:
+                    pending_page = executor.submit(api_client.get_json, next_page)
+            yield r
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+from os import path
+from typing import Optional, Dict
+
+from hash_cache import HashCache
+from hashing import compute_file_hash
+from library_layout import unique_tmp_path, write_json_atomic
+
+CONTENT_STORE_FOLDER_NAME = ".civitai_content_store"
+CONTENT_STORE_STATS_FILE_NAME = "stats.json"
+# namespace of sample images, keyed by "hash" field of civitai image json
+IMAGE_NAMESPACE = "image"
+
+LINK_AUTO = "auto"
+LINK_REFLINK = "reflink"
+LINK_HARDLINK = "hardlink"
+LINK_COPY = "copy"
+LINK_MODES = [LINK_AUTO, LINK_REFLINK, LINK_HARDLINK, LINK_COPY]
+
+# linux ioctl for copy on write clone (btrfs, xfs, bcachefs)
+FICLONE = 0x40049409
+
+
+def reflink(src: str, dst: str) -> None:
+    if not sys.platform.startswith("linux"):
+        raise OSError("reflink is supported on linux only")
+    import fcntl
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+
+
+def _blob_key(namespace: str, key: str) -> str:
+    if namespace == IMAGE_NAMESPACE:
+        # image hash is not file name safe and has no fixed length
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return key.upper()
+
+
+class ContentStore:
+    """
+    Blobs of verified files in sd-webui root, addressed by civitai hash (BLAKE3, SHA256, ...) or image hash.
+    A file which is present in the store is placed with reflink or hardlink instead of a new download.
+    Store and library must be on one file system for links, otherwise only copy mode saves traffic.
+    """
+
+    def __init__(self, sd_webui_root_dir: str, link_mode: str = LINK_AUTO):
+        self.store_dir = path.join(path.abspath(sd_webui_root_dir), CONTENT_STORE_FOLDER_NAME)
+        self.link_mode = link_mode
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # counters of current run
+        self.placed_files = 0
+        self.saved_download_bytes = 0
+        self.saved_disk_bytes = 0
+        self.placed_by_method: Dict[str, int] = {}
+
+    def blob_path(self, namespace: str, key: str) -> str:
+        blob_key = _blob_key(namespace, key)
+        return path.join(self.store_dir, namespace.lower(), blob_key[:2], blob_key)
+
+    def has(self, namespace: str, key: str) -> bool:
+        return path.isfile(self.blob_path(namespace, key))
+
+    def _link_methods(self):
+        if self.link_mode == LINK_AUTO:
+            return [LINK_REFLINK, LINK_HARDLINK, LINK_COPY]
+        return [self.link_mode]
+
+    @staticmethod
+    def _link(method: str, src: str, dst: str) -> None:
+        if method == LINK_REFLINK:
+            reflink(src, dst)
+        elif method == LINK_HARDLINK:
+            os.link(src, dst)
+        else:
+            shutil.copyfile(src, dst)
+
+    @staticmethod
+    def _remove_leftover(tmp_path: str) -> None:
+        # tmp file of a crashed run (or of a failed link method), os.link does not overwrite it
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def _blob_digest_matches(self, namespace: str, key: str, blob_path: str,
+                             hash_cache: Optional[HashCache] = None) -> bool:
+        # image hash of civitai is not a digest of the bytes, it can not be checked
+        if namespace == IMAGE_NAMESPACE:
+            return True
+        # blob is a hardlink of a library file, which may be changed in place after it was verified.
+        # hash cache keeps the digest while size, mtime and inode of the blob are the same
+        digest = hash_cache.compute(blob_path, namespace) if hash_cache is not None \
+            else compute_file_hash(blob_path, namespace)
+        if digest == _blob_key(namespace, key):
+            return True
+        print(f"content store blob {blob_path} has {namespace} {digest}, not {key}. Remove it")
+        self._remove_leftover(blob_path)
+        return False
+
+    def place(self, namespace: str, key: str, dest_path: str,
+              hash_cache: Optional[HashCache] = None) -> Optional[str]:
+        """
+        Creates dest_path from stored blob, returns link method or None when blob is absent, its digest does
+        not match the key or link fails.
+        """
+        blob_path = self.blob_path(namespace, key)
+        if not path.isfile(blob_path) or not self._blob_digest_matches(namespace, key, blob_path, hash_cache):
+            return None
+        tmp_dest_path = unique_tmp_path(dest_path)
+        for method in self._link_methods():
+            try:
+                self._remove_leftover(tmp_dest_path)
+                self._link(method, blob_path, tmp_dest_path)
+            except OSError:
+                self._remove_leftover(tmp_dest_path)
+                continue
+            os.replace(tmp_dest_path, dest_path)
+            size = path.getsize(dest_path)
+            with self._lock:
+                self.placed_files += 1
+                self.saved_download_bytes += size
+                if method != LINK_COPY:
+                    self.saved_disk_bytes += size
+                self.placed_by_method[method] = self.placed_by_method.get(method, 0) + 1
+            return method
+        return None
+
+    def ingest(self, file_path: str, namespace: str, key: str,
+               hash_cache: Optional[HashCache] = None) -> bool:
+        """
+        Adds verified file to the store as hardlink or reflink, a full copy is never made.
+        Digest of the blob is put into hash_cache, so place does not read it again.
+        """
+        blob_path = self.blob_path(namespace, key)
+        if path.isfile(blob_path):
+            return True
+        os.makedirs(path.dirname(blob_path), exist_ok=True)
+        tmp_blob_path = unique_tmp_path(blob_path)
+        for method in [LINK_HARDLINK, LINK_REFLINK]:
+            try:
+                self._remove_leftover(tmp_blob_path)
+                self._link(method, file_path, tmp_blob_path)
+            except OSError:
+                self._remove_leftover(tmp_blob_path)
+                continue
+            os.replace(tmp_blob_path, blob_path)
+            if hash_cache is not None and namespace != IMAGE_NAMESPACE:
+                hash_cache.put(blob_path, namespace, _blob_key(namespace, key))
+            return True
+        return False
+
+    def _iter_blobs(self):
+        for dir_path, _, file_names in os.walk(self.store_dir):
+            for file_name in file_names:
+                if dir_path != self.store_dir:
+                    yield path.join(dir_path, file_name)
+
+    def stats(self) -> Dict[str, int]:
+        # hardlinked copies in library are visible by link count, reflinks are not
+        blobs = 0
+        blob_bytes = 0
+        hardlinked_bytes = 0
+        for blob_path in self._iter_blobs():
+            stat = os.stat(blob_path)
+            blobs += 1
+            blob_bytes += stat.st_size
+            hardlinked_bytes += max(0, stat.st_nlink - 2) * stat.st_size
+        totals = self._load_totals()
+        return {"blobs": blobs,
+                "blob_bytes": blob_bytes,
+                "hardlink_saved_disk_bytes": hardlinked_bytes,
+                "total_placed_files": totals.get("placed_files", 0),
+                "total_saved_download_bytes": totals.get("saved_download_bytes", 0),
+                "total_saved_disk_bytes": totals.get("saved_disk_bytes", 0)}
+
+    def prune(self) -> int:
+        # blob without any hardlink in library: its files were removed or replaced, or it was reflinked
+        # (such blob is added again when its file is verified next time)
+        removed = 0
+        for blob_path in self._iter_blobs():
+            if os.stat(blob_path).st_nlink == 1:
+                os.remove(blob_path)
+                removed += 1
+        return removed
+
+    def _load_totals(self) -> Dict[str, int]:
+        stats_path = path.join(self.store_dir, CONTENT_STORE_STATS_FILE_NAME)
+        try:
+            with open(stats_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_totals(self) -> None:
+        with self._lock:
+            totals = self._load_totals()
+            totals["placed_files"] = totals.get("placed_files", 0) + self.placed_files
+            totals["saved_download_bytes"] = totals.get("saved_download_bytes", 0) + self.saved_download_bytes
+            totals["saved_disk_bytes"] = totals.get("saved_disk_bytes", 0) + self.saved_disk_bytes
+            stats_path = path.join(self.store_dir, CONTENT_STORE_STATS_FILE_NAME)
+            write_json_atomic(stats_path, totals)
+
+    def summary(self) -> str:
+        with self._lock:
+            methods = ", ".join(f"{method} = {count}" for method, count in sorted(self.placed_by_method.items()))
+            return (f"content store: placed {self.placed_files} files ({methods or 'none'}), "
+                    f"saved download = {self.saved_download_bytes / 1024 / 1024:.1f} MB, "
+                    f"saved disk = {self.saved_disk_bytes / 1024 / 1024:.1f} MB")
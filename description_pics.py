@@ -0,0 +1,51 @@
+import html
+import re
+from re import Match
+from typing import Dict, List, Optional, Tuple
+
+import click
+
+PICS_URL_PREFIX = "pics/"
+
+REGEX_CIVITAI_IMAGE_FROM_CACHE_PATTERN = re.compile(r"^((https)://)imagecache[.]civitai[.]com/(?P<unc1>\w+)/(?P<uuid_image1>\w+-\w+-\w+-\w+-\w+)/width=(?P<image_width>\d+)/(?P<uuid_image2>\w+-\w+-\w+-\w+-\w+)$")
+# quoted attribute values may contain ">"
+IMG_TAG_REGEX_PATTERN = re.compile(r"""<img\b(?:[^>"']|"[^"]*"|'[^']*')*>""", re.IGNORECASE)
+# not data-src and friends
+SRC_ATTRIBUTE_REGEX_PATTERN = re.compile(r"""(?<![\w-])(src\s*=\s*)(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""",
+                                         re.IGNORECASE)
+
+
+class DescriptionPic:
+    def __init__(self, url: str, file_name: str):
+        # url of full size picture (width=0)
+        self.url = url
+        self.file_name = file_name
+
+
+def rewrite_description_pics(description_html: str) -> Tuple[str, List[DescriptionPic]]:
+    """
+    Points src of imagecache pictures in model description to pics folder.
+    Only src values are replaced, the rest of html is kept as is (no parse and serialize of the whole document).
+    Returns new html and pictures of description without duplicates.
+    """
+    pics: Dict[str, DescriptionPic] = {}
+
+    def rewrite_img_tag(img_tag_match: Match) -> str:
+        img_tag = img_tag_match.group(0)
+        src_match = SRC_ATTRIBUTE_REGEX_PATTERN.search(img_tag)
+        if src_match is None:
+            return img_tag
+        img_url = html.unescape(next(value for value in src_match.groups()[1:] if value is not None))
+        civitai_image_match: Optional[Match] = re.fullmatch(REGEX_CIVITAI_IMAGE_FROM_CACHE_PATTERN, img_url)
+        if civitai_image_match is None:
+            click.echo("Invalid cache url. go to next img")
+            return img_tag
+        uuid_image_name = civitai_image_match.group("uuid_image2")
+        image_width = civitai_image_match.group("image_width")
+        if uuid_image_name not in pics:
+            pics[uuid_image_name] = DescriptionPic(img_url.replace("width=" + image_width, 'width=0'),
+                                                   uuid_image_name)
+        return (img_tag[:src_match.start()] + src_match.group(1) + f'"{PICS_URL_PREFIX}{uuid_image_name}"'
+                + img_tag[src_match.end():])
+
+    return IMG_TAG_REGEX_PATTERN.sub(rewrite_img_tag, description_html), list(pics.values())
@@ -0,0 +1,172 @@
+import errno
+import os
+import shutil
+import threading
+from os import path
+from typing import Dict, List, Tuple, Optional
+
+from segmented_download import part_path_for, has_resumable_journal
+
+DEFAULT_MIN_FREE_SPACE_MB = 1024
+MB = 1024 * 1024
+
+
+class InsufficientDiskSpaceError(OSError):
+    def __init__(self, message: str):
+        super().__init__(errno.ENOSPC, message)
+
+
+def allocated_bytes(file_path: str) -> int:
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return 0
+    # sparse .part file of segmented download has its full size from the start
+    blocks = getattr(stat, "st_blocks", None)
+    return min(stat.st_size, blocks * 512) if blocks is not None else stat.st_size
+
+
+def file_identity(file_path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def resumable_bytes(file_path: str) -> int:
+    # .part without journal is written again from the start
+    return allocated_bytes(part_path_for(file_path)) if has_resumable_journal(file_path) else 0
+
+
+def existing_dir(dir_path: str) -> str:
+    # target folder of the model may be created later
+    dir_path = path.abspath(dir_path)
+    while not path.isdir(dir_path):
+        parent = path.dirname(dir_path)
+        if parent == dir_path:
+            break
+        dir_path = parent
+    return dir_path
+
+
+class DiskPlanRow:
+    def __init__(self, folder: str, files: int, need_bytes: int, free_bytes: int):
+        self.folder = folder
+        self.files = files
+        self.need_bytes = need_bytes
+        self.free_bytes = free_bytes
+
+    @property
+    def fits(self) -> bool:
+        return self.need_bytes <= self.free_bytes
+
+    def __str__(self):
+        return (f"{self.files} files, {self.need_bytes / MB:.1f} MB to download into {self.folder}, "
+                f"available {self.free_bytes / MB:.1f} MB")
+
+
+class DiskSpaceBudget:
+    """
+    Free space per file system for scheduled model files.
+    A scheduled file reserves its size minus bytes of a resumable .part (with journal). A complete file needs
+    nothing, a file of other size is renamed to .inc (kept) by download_file and downloaded in full.
+    Reservation shrinks while the new file is written, so free space of the file system is counted once.
+    min_free_bytes are always left free.
+    """
+
+    def __init__(self, min_free_bytes: int = DEFAULT_MIN_FREE_SPACE_MB * MB):
+        self.min_free_bytes = min_free_bytes
+        self._lock = threading.Lock()
+        # file path -> (device, size, pending bytes at reservation, identity of the file replaced by download)
+        self._reservations: Dict[str, Tuple[int, int, int, Optional[Tuple[int, int]]]] = {}
+        self.scheduled_files = 0
+        self.scheduled_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+
+    @staticmethod
+    def _device(file_path: str) -> Tuple[int, str]:
+        dir_path = existing_dir(path.dirname(path.abspath(file_path)))
+        return os.stat(dir_path).st_dev, dir_path
+
+    @staticmethod
+    def pending_bytes(file_path: str, size: int) -> int:
+        try:
+            existing_size = os.stat(file_path).st_size
+        except OSError:
+            return max(0, size - resumable_bytes(file_path))
+        # size of civitai is float KB, one byte of rounding
+        return 0 if abs(existing_size - size) <= 1 else size
+
+    @staticmethod
+    def _reserved_pending_bytes(file_path: str, size: int, need: int,
+                                replaced_file: Optional[Tuple[int, int]]) -> int:
+        written = resumable_bytes(file_path)
+        identity = file_identity(file_path)
+        if identity is not None and identity != replaced_file:
+            # new file of single stream download, or .part renamed to the file
+            written = max(written, allocated_bytes(file_path))
+        return min(need, max(0, size - written))
+
+    def _reserved_bytes(self, device: int) -> int:
+        return sum(self._reserved_pending_bytes(file_path, size, need, replaced_file)
+                   for file_path, (file_device, size, need, replaced_file) in self._reservations.items()
+                   if file_device == device)
+
+    def available_bytes(self, file_path: str) -> int:
+        device, dir_path = self._device(file_path)
+        with self._lock:
+            return self._available_bytes(device, dir_path)
+
+    def _available_bytes(self, device: int, dir_path: str) -> int:
+        return max(0, shutil.disk_usage(dir_path).free - self._reserved_bytes(device) - self.min_free_bytes)
+
+    def try_reserve(self, file_path: str, size: int) -> bool:
+        device, dir_path = self._device(file_path)
+        need = self.pending_bytes(file_path, size)
+        with self._lock:
+            if need > self._available_bytes(device, dir_path):
+                return False
+            self._reservations[file_path] = (device, size, need, file_identity(file_path))
+            self.scheduled_files += 1
+            self.scheduled_bytes += need
+            return True
+
+    def release(self, file_path: str) -> None:
+        with self._lock:
+            self._reservations.pop(file_path, None)
+
+    def fits_without_reservations(self, file_path: str, size: int) -> bool:
+        # file may fit after running downloads finish, when they need less space than reserved
+        _, dir_path = self._device(file_path)
+        return self.pending_bytes(file_path, size) <= shutil.disk_usage(dir_path).free - self.min_free_bytes
+
+    def skipped(self, file_path: str, size: int) -> None:
+        with self._lock:
+            self.skipped_files += 1
+            self.skipped_bytes += self.pending_bytes(file_path, size)
+
+    def plan(self, files: List[Tuple[str, int]]) -> List[DiskPlanRow]:
+        """Totals pending bytes of (file path, size) per file system, against space available for new files."""
+        rows: Dict[int, DiskPlanRow] = {}
+        for file_path, size in files:
+            need = self.pending_bytes(file_path, size)
+            if need == 0:
+                continue
+            device, dir_path = self._device(file_path)
+            row = rows.get(device)
+            if row is None:
+                with self._lock:
+                    available = self._available_bytes(device, dir_path)
+                row = rows[device] = DiskPlanRow(path.dirname(path.abspath(file_path)), 0, 0, available)
+            row.files += 1
+            row.need_bytes += need
+        return list(rows.values())
+
+    def summary(self) -> Optional[str]:
+        with self._lock:
+            if not self.scheduled_files and not self.skipped_files:
+                return None
+            return (f"disk: scheduled {self.scheduled_files} files ({self.scheduled_bytes / MB:.1f} MB), "
+                    f"skipped for free space {self.skipped_files} files ({self.skipped_bytes / MB:.1f} MB)")
@@ -0,0 +1,309 @@
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import click
+
+from async_engine import configure_async_engine, close_async_engine, AsyncBackendUnavailableError, \
+    BACKENDS, BACKEND_THREADS, BACKEND_ASYNCIO
+from bandwidth import BandwidthLimiter
+from civitai_api import CivitaiApiClient, DEFAULT_API_CACHE_TTL_SECONDS
+from download_scheduler import DownloadScheduler, DEFAULT_MAX_MODEL_DOWNLOADS, DEFAULT_MAX_IMAGE_DOWNLOADS
+from disk_space import DiskSpaceBudget, DEFAULT_MIN_FREE_SPACE_MB, MB
+from content_store import ContentStore, LINK_MODES, LINK_AUTO
+from hash_cache import HashCache
+from image_variants import ImageVariant, PreviewSavings, IMAGE_FORMATS
+from http_client import configure_http_client, get_http_client, DEFAULT_POOL_SIZE, DEFAULT_RETRIES, \
+    DEFAULT_READ_TIMEOUT, DEFAULT_PER_HOST_LIMIT, DEFAULT_RATE_LIMIT, DEFAULT_RATE_BURST
+from metrics import configure_metrics, get_metrics
+from rate_limit import DEFAULT_MAX_BACKOFF
+from segmented_download import DEFAULT_SEGMENT_COUNT
+from sync_plan import record_transfer_stats
+from sync_state import SyncState
+from transfer_queue import configure_transfer_progress, close_transfer_progress, POLICIES, POLICY_DISCOVERY, \
+    PROGRESS_MODES, PROGRESS_AGGREGATE
+from library_layout import worker_state_dir
+from work_leases import LeaseManager, DEFAULT_LEASE_TTL_SECONDS
+
+
+class DownloadContext:
+    """Services and tuning shared by all models of one run."""
+
+    def __init__(self,
+                 scheduler: Optional[DownloadScheduler] = None,
+                 api_client: Optional[CivitaiApiClient] = None,
+                 hash_cache: Optional[HashCache] = None,
+                 download_segments: int = DEFAULT_SEGMENT_COUNT,
+                 skip_unchanged_models: bool = False,
+                 sync_state: Optional[SyncState] = None,
+                 content_store: Optional[ContentStore] = None,
+                 metrics_prometheus: Optional[str] = None,
+                 metrics_summary: bool = False,
+                 sd_webui_root_dir: Optional[str] = None,
+                 leases: Optional[LeaseManager] = None,
+                 compact_samples: bool = False,
+                 image_variant: Optional[ImageVariant] = None):
+        self.scheduler = scheduler if scheduler is not None else DownloadScheduler()
+        self.api_client = api_client if api_client is not None else CivitaiApiClient()
+        self.hash_cache = hash_cache
+        self.download_segments = download_segments
+        self.skip_unchanged_models = skip_unchanged_models
+        self.sync_state = sync_state
+        self.content_store = content_store
+        self.metrics_prometheus = metrics_prometheus
+        self.metrics_summary = metrics_summary
+        # measured bandwidth is kept there for eta of plan-command
+        self.sd_webui_root_dir = sd_webui_root_dir
+        # several workers share sd-webui root, models are claimed by leases
+        self.leases = leases
+        self.compact_samples = compact_samples
+        # None: sample images and description pictures at full size
+        self.image_variant = image_variant
+        self.preview_savings = PreviewSavings()
+        # models leased by other workers of --shared-run: lease key and download_model call to claim them again
+        self.busy_models: List[Tuple[str, Callable[[], List[Future]]]] = []
+
+    @classmethod
+    def from_options(cls, sd_webui_root_dir: str,
+                     max_model_downloads: int = DEFAULT_MAX_MODEL_DOWNLOADS,
+                     max_image_downloads: int = DEFAULT_MAX_IMAGE_DOWNLOADS,
+                     download_segments: int = DEFAULT_SEGMENT_COUNT,
+                     hash_cache: bool = True,
+                     api_cache: bool = True,
+                     api_cache_ttl: float = DEFAULT_API_CACHE_TTL_SECONDS,
+                     skip_unchanged_models: bool = False,
+                     incremental: bool = False,
+                     http_pool_size: int = DEFAULT_POOL_SIZE,
+                     http_retries: int = DEFAULT_RETRIES,
+                     http_timeout: float = DEFAULT_READ_TIMEOUT,
+                     http_per_host_limit: int = DEFAULT_PER_HOST_LIMIT,
+                     backend: str = BACKEND_THREADS,
+                     content_store: bool = False,
+                     content_store_link: str = LINK_AUTO,
+                     rate_limit: float = DEFAULT_RATE_LIMIT,
+                     rate_burst: int = DEFAULT_RATE_BURST,
+                     adaptive_concurrency: bool = True,
+                     max_backoff: float = DEFAULT_MAX_BACKOFF,
+                     metrics_log: Optional[str] = None,
+                     metrics_prometheus: Optional[str] = None,
+                     metrics_summary: bool = True,
+                     disk_preflight: bool = True,
+                     min_free_space: float = DEFAULT_MIN_FREE_SPACE_MB,
+                     shared_run: Optional[str] = None,
+                     worker_id: Optional[str] = None,
+                     lease_ttl: float = DEFAULT_LEASE_TTL_SECONDS,
+                     compact_samples: bool = False,
+                     preview_width: Optional[int] = None,
+                     preview_format: Optional[str] = None,
+                     transfer_policy: str = POLICY_DISCOVERY,
+                     max_bandwidth: float = 0,
+                     max_host_bandwidth: Sequence[str] = (),
+                     full_speed_window: Sequence[str] = (),
+                     progress: str = PROGRESS_AGGREGATE) -> "DownloadContext":
+        if compact_samples and shared_run is not None:
+            raise click.UsageError("--compact-samples can not be used with --shared-run: appends to samples.jsonl "
+                                   "are not atomic on network file systems")
+        try:
+            bandwidth = BandwidthLimiter.from_options(max_bandwidth, max_host_bandwidth, full_speed_window)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        configure_metrics(event_log_path=metrics_log)
+        configure_http_client(pool_size=http_pool_size, retries=http_retries, read_timeout=http_timeout,
+                              per_host_limit=http_per_host_limit, rate_limit=rate_limit, rate_burst=rate_burst,
+                              adaptive_concurrency=adaptive_concurrency, max_backoff=max_backoff,
+                              bandwidth=bandwidth)
+        transfer_progress = configure_transfer_progress(progress)
+        # sqlite databases of a worker of shared root are local, the root keeps plain files only
+        db_dir = worker_state_dir(sd_webui_root_dir) if shared_run is not None else None
+        async_engine = None
+        if backend == BACKEND_ASYNCIO:
+            try:
+                async_engine = configure_async_engine(pool_size=http_pool_size, retries=http_retries,
+                                                      read_timeout=http_timeout, per_host_limit=http_per_host_limit)
+            except AsyncBackendUnavailableError as e:
+                raise click.UsageError(str(e))
+        return cls(scheduler=DownloadScheduler(max_model_downloads=max_model_downloads,
+                                               max_image_downloads=max_image_downloads,
+                                               async_engine=async_engine,
+                                               disk_budget=DiskSpaceBudget(int(min_free_space * MB))
+                                               if disk_preflight else None,
+                                               policy=transfer_policy,
+                                               progress=transfer_progress),
+                   api_client=CivitaiApiClient.for_sd_webui_root(sd_webui_root_dir, ttl_seconds=api_cache_ttl)
+                   if api_cache else CivitaiApiClient(),
+                   hash_cache=HashCache(sd_webui_root_dir, db_dir=db_dir) if hash_cache else None,
+                   download_segments=download_segments,
+                   skip_unchanged_models=skip_unchanged_models,
+                   sync_state=SyncState(sd_webui_root_dir, db_dir=db_dir) if incremental else None,
+                   content_store=ContentStore(sd_webui_root_dir, link_mode=content_store_link)
+                   if content_store else None,
+                   metrics_prometheus=metrics_prometheus,
+                   metrics_summary=metrics_summary,
+                   sd_webui_root_dir=sd_webui_root_dir,
+                   leases=LeaseManager(sd_webui_root_dir, shared_run, worker_id=worker_id, ttl_seconds=lease_ttl)
+                   if shared_run is not None else None,
+                   compact_samples=compact_samples,
+                   image_variant=ImageVariant(preview_width, preview_format)
+                   if preview_width is not None or preview_format is not None else None)
+
+    def add_busy_model(self, lease_key: str, retry: Callable[[], List[Future]]) -> None:
+        self.busy_models.append((lease_key, retry))
+
+    def retry_busy_models(self) -> Dict[str, List[Future]]:
+        """
+        Models leased by other workers while the listing was walked are claimed again when own jobs are finished:
+        a lease released after a failure or expired after a crash is picked up here, not only by a worker what
+        did not reach the model yet. Stops when every model is done or a pass claims none of the leased ones.
+        Returns jobs of claimed models by lease key.
+        """
+        retried_jobs: Dict[str, List[Future]] = {}
+        while self.busy_models and self.leases is not None:
+            self.scheduler.wait()
+            busy_models, self.busy_models = self.busy_models, []
+            claimed_before = self.leases.claimed
+            click.echo(f"try again {len(busy_models)} models leased by other workers")
+            for lease_key, retry in busy_models:
+                try:
+                    jobs = retry()
+                except Exception as e:
+                    click.echo(f"{lease_key} error: {e}")
+                    continue
+                if jobs:
+                    retried_jobs[lease_key] = jobs
+            if self.leases.claimed == claimed_before:
+                # the rest is leased by live workers, they finish them
+                self.busy_models = []
+        return retried_jobs
+
+    def close(self) -> None:
+        self.retry_busy_models()
+        # wait all scheduled jobs of the run
+        self.scheduler.wait()
+        self.scheduler.shutdown()
+        close_transfer_progress()
+        self.scheduler.print_summary()
+        close_async_engine()
+        if self.scheduler.disk_budget is not None:
+            disk_summary = self.scheduler.disk_budget.summary()
+            if disk_summary is not None:
+                click.echo(disk_summary)
+        throttling_summary = get_http_client().rate_limiters.summary()
+        if throttling_summary:
+            click.echo(f"throttled hosts: {throttling_summary}")
+        bandwidth_summary = get_http_client().bandwidth.summary()
+        if bandwidth_summary is not None:
+            click.echo(bandwidth_summary)
+        if self.hash_cache is not None:
+            self.hash_cache.close()
+        if self.sync_state is not None:
+            self.sync_state.close()
+        preview_summary = self.preview_savings.summary()
+        if preview_summary is not None:
+            click.echo(preview_summary)
+        if self.leases is not None:
+            self.leases.close()
+            click.echo(self.leases.summary())
+        if self.content_store is not None:
+            self.content_store.save_totals()
+            click.echo(self.content_store.summary())
+        metrics = get_metrics()
+        if self.sd_webui_root_dir is not None:
+            record_transfer_stats(self.sd_webui_root_dir, metrics)
+        if self.metrics_summary:
+            click.echo(metrics.format_summary())
+        if self.metrics_prometheus is not None:
+            metrics.write_prometheus(self.metrics_prometheus)
+        metrics.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def download_context_options(command):
+    """Click options of DownloadContext.from_options, shared by download commands."""
+    options = [
+        click.option('--max-model-downloads', type=click.IntRange(min=1), default=DEFAULT_MAX_MODEL_DOWNLOADS),
+        click.option('--max-image-downloads', type=click.IntRange(min=1), default=DEFAULT_MAX_IMAGE_DOWNLOADS),
+        click.option('--download-segments', type=click.IntRange(min=0), default=DEFAULT_SEGMENT_COUNT,
+                     help='Parallel range requests per model file. 0 disables segmented download'),
+        click.option('--hash-cache/--no-hash-cache', default=True,
+                     help='Keep hashes of existing files in sd-webui root, so unchanged files are not hashed again'),
+        click.option('--api-cache/--no-api-cache', default=True,
+                     help='Store civitai api responses in sd-webui root and revalidate them with conditional requests'),
+        click.option('--api-cache-ttl', type=click.FloatRange(min=0), default=DEFAULT_API_CACHE_TTL_SECONDS,
+                     help='Seconds while stored api response is used without any request'),
+        click.option('--skip-unchanged-models', is_flag=True, default=False,
+                     help='Skip models whose metadata did not change since the last complete sync'),
+        click.option('--incremental', is_flag=True, default=False,
+                     help='Touch only model versions what are new or updated since they were completely synced'),
+        click.option('--http-pool-size', type=click.IntRange(min=1), default=DEFAULT_POOL_SIZE,
+                     help='Keep-alive connections kept per host'),
+        click.option('--http-retries', type=click.IntRange(min=0), default=DEFAULT_RETRIES,
+                     help='Retries of connect errors and 5xx answers with exponential backoff'),
+        click.option('--http-timeout', type=click.FloatRange(min=1), default=DEFAULT_READ_TIMEOUT,
+                     help='Seconds without received data before request fails'),
+        click.option('--http-per-host-limit', type=click.IntRange(min=1), default=DEFAULT_PER_HOST_LIMIT,
+                     help='Max parallel requests to one host'),
+        click.option('--rate-limit', type=click.FloatRange(min=0), default=DEFAULT_RATE_LIMIT,
+                     help='Requests per second to one host, 0 is unlimited'),
+        click.option('--rate-burst', type=click.IntRange(min=1), default=DEFAULT_RATE_BURST,
+                     help='Requests what may be sent at once above --rate-limit'),
+        click.option('--adaptive-concurrency/--fixed-concurrency', default=True,
+                     help='Halve parallel requests of a host on 429/503 and grow them back on success, '
+                          'up to --http-per-host-limit'),
+        click.option('--max-backoff', type=click.FloatRange(min=0), default=DEFAULT_MAX_BACKOFF,
+                     help='Max seconds between retries, also caps Retry-After of server'),
+        click.option('--metrics-log', type=click.Path(dir_okay=False), default=None,
+                     help='Append json line per api fetch, download, hash and retry to file'),
+        click.option('--metrics-prometheus', type=click.Path(dir_okay=False), default=None,
+                     help='Write run metrics in prometheus text format (for node exporter textfile collector)'),
+        click.option('--metrics-summary/--no-metrics-summary', default=True,
+                     help='Print timings, bytes and cache hits per operation at the end of run'),
+        click.option('--backend', type=click.Choice(BACKENDS), default=BACKEND_THREADS,
+                     help='asyncio runs api requests, sample images and description pictures as coroutines '
+                          'of one event loop (needs aiohttp), model files stay on threads'),
+        click.option('--content-store', is_flag=True, default=False,
+                     help='Keep verified files by hash in sd-webui root and link identical files '
+                          'of other models instead of downloading them again'),
+        click.option('--content-store-link', type=click.Choice(LINK_MODES), default=LINK_AUTO,
+                     help='How file is placed from content store, auto tries reflink, hardlink, copy'),
+        click.option('--disk-preflight/--no-disk-preflight', default=True,
+                     help='Check free space before model files are downloaded: files what do not fit are deferred '
+                          'until running downloads finish or skipped'),
+        click.option('--min-free-space', type=click.FloatRange(min=0), default=DEFAULT_MIN_FREE_SPACE_MB,
+                     help='MB always left free on disk by model downloads'),
+        click.option('--shared-run', type=str, default=None,
+                     help='Name of a sync run shared by several workers (hosts or processes) of one sd-webui root. '
+                          'Every model is claimed by a lease, models done or leased by other workers are skipped'),
+        click.option('--worker-id', type=str, default=None,
+                     help='Name of this worker in leases of --shared-run, by default host name and pid'),
+        click.option('--lease-ttl', type=click.FloatRange(min=10), default=DEFAULT_LEASE_TTL_SECONDS,
+                     help='Seconds without heartbeat after which a lease of a crashed worker is reclaimed'),
+        click.option('--compact-samples', is_flag=True, default=False,
+                     help='Keep metadata of new samples folders in one samples.jsonl instead of N.json and N.meta '
+                          'per image. Existing folders are converted by samples-store-command migrate. '
+                          'Not with --shared-run'),
+        click.option('--preview-width', type=click.IntRange(min=1), default=None,
+                     help='Download sample images and description pictures at this width (imagecache urls only). '
+                          'upgrade-previews-command downloads them at full size later'),
+        click.option('--preview-format', type=click.Choice(IMAGE_FORMATS), default=None,
+                     help='Image format of sample images and description pictures from imagecache'),
+        click.option('--transfer-policy', type=click.Choice(POLICIES), default=POLICY_DISCOVERY,
+                     help='Order of queued downloads: smallest-first, newest-version-first, or metadata-first '
+                          '(model files wait while sample images and description pictures are pending)'),
+        click.option('--max-bandwidth', type=click.FloatRange(min=0), default=0,
+                     help='MB/s of all downloads together, 0 is unlimited'),
+        click.option('--max-host-bandwidth', type=str, multiple=True,
+                     help='MB/s of downloads from one host: "2" for every host or "host=2" for one host. '
+                          'May be repeated'),
+        click.option('--full-speed-window', type=str, multiple=True,
+                     help='Local time window like 22:00-06:00 when bandwidth caps are not applied. May be repeated'),
+        click.option('--progress', type=click.Choice(PROGRESS_MODES), default=PROGRESS_AGGREGATE,
+                     help='One progress bar of all downloads, a bar per file, or none'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
@@ -0,0 +1,311 @@
+import functools
+import itertools
+import threading
+from concurrent.futures import Future, wait
+from typing import Callable, List, Tuple, Any, Awaitable, Optional
+
+import click
+from colorama import Fore, Style
+
+from async_engine import AsyncDownloadEngine
+from disk_space import DiskSpaceBudget, InsufficientDiskSpaceError, MB
+from transfer_queue import PriorityExecutor, AsyncPrioritySlots, TransferInfo, TransferProgress, policy_key, POLICY_DISCOVERY, \
+    POLICY_METADATA_FIRST, KIND_MODEL_FILE, KIND_IMAGE
+
+# large model files and small sample images are limited separately:
+# a few parallel multi-GB transfers saturate the link, while images are
+# dominated by round trips and need many more workers
+DEFAULT_MAX_MODEL_DOWNLOADS = 2
+DEFAULT_MAX_IMAGE_DOWNLOADS = 8
+# backpressure for the producer (api pages walk), so we do not queue whole user in memory
+DEFAULT_MAX_PENDING_JOBS = 512
+
+
+def _copy_future_result(target: Future, source: Future) -> None:
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class DownloadJobFailure:
+    def __init__(self, description: str, error: BaseException):
+        self.description = description
+        self.error = error
+
+    def __str__(self):
+        return f"{self.description}: {self.error!r}"
+
+
+class DownloadScheduler:
+    """
+    Model files and images run in separate pools. Queued jobs of a pool start in order of policy:
+    discovery order, smallest first, newest version first, or metadata first, where model files wait
+    while sample images and description pictures are pending.
+    """
+
+    def __init__(self,
+                 max_model_downloads: int = DEFAULT_MAX_MODEL_DOWNLOADS,
+                 max_image_downloads: int = DEFAULT_MAX_IMAGE_DOWNLOADS,
+                 max_pending_jobs: int = DEFAULT_MAX_PENDING_JOBS,
+                 async_engine: Optional[AsyncDownloadEngine] = None,
+                 disk_budget: Optional[DiskSpaceBudget] = None,
+                 policy: str = POLICY_DISCOVERY,
+                 progress: Optional[TransferProgress] = None):
+        self.policy = policy
+        self.progress = progress
+        self._sequence = itertools.count()
+        self._image_jobs = 0
+        self._model_pool = PriorityExecutor(max_model_downloads, "model-download",
+                                            hold=self._images_pending if policy == POLICY_METADATA_FIRST else None)
+        self._image_pool = PriorityExecutor(max_image_downloads, "image-download")
+        self._pending = threading.BoundedSemaphore(max(1, max_pending_jobs))
+        # image coroutines of asyncio backend are limited and ordered like image pool workers
+        self._async_engine = async_engine
+        self._async_image_slots = AsyncPrioritySlots(max_image_downloads) if async_engine is not None else None
+        self._lock = threading.Lock()
+        self._futures: List[Future] = []
+        self._failures: List[DownloadJobFailure] = []
+        self._completed = 0
+        self.disk_budget = disk_budget
+        # model files what did not fit free space while other downloads were running
+        self._deferred: List[Tuple[Future, str, int, Callable[..., Any], Tuple, dict, TransferInfo]] = []
+
+    def submit_model_file(self, description: str, fn: Callable[..., Any], *args,
+                          transfer: Optional[TransferInfo] = None, **kwargs) -> Future:
+        return self._submit(self._model_pool, description, fn, args, kwargs,
+                            transfer if transfer is not None else TransferInfo(KIND_MODEL_FILE))
+
+    def submit_model_file_when_fits(self, file_path: str, size: int, fn: Callable[..., Any], *args,
+                                    transfer: Optional[TransferInfo] = None, **kwargs) -> Future:
+        """
+        Like submit_model_file, but free space for size bytes of file_path is reserved first.
+        File what does not fit is deferred until running downloads finish (their reservation is an upper bound),
+        or failed with InsufficientDiskSpaceError when it does not fit even without them.
+        """
+        if transfer is None:
+            transfer = TransferInfo(KIND_MODEL_FILE, size=size)
+        if self.disk_budget is None:
+            return self.submit_model_file(file_path, fn, *args, transfer=transfer, **kwargs)
+        if self.disk_budget.try_reserve(file_path, size):
+            return self._submit(self._model_pool, file_path, self._run_reserved, (file_path, fn, args, kwargs), {},
+                                transfer)
+        future = Future()
+        if self.disk_budget.fits_without_reservations(file_path, size):
+            click.echo(Fore.YELLOW + f"Defer {file_path}: {size / MB:.1f} MB do not fit free space "
+                                     f"while other downloads run" + Style.RESET_ALL)
+            with self._lock:
+                self._deferred.append((future, file_path, size, fn, args, kwargs, transfer))
+        else:
+            self._skip_for_space(future, file_path, size)
+        return future
+
+    def _run_reserved(self, file_path: str, fn: Callable[..., Any], args: Tuple, kwargs: dict) -> Any:
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.disk_budget.release(file_path)
+
+    def _skip_for_space(self, future: Future, file_path: str, size: int) -> None:
+        self.disk_budget.skipped(file_path, size)
+        error = InsufficientDiskSpaceError(
+            f"{size / MB:.1f} MB do not fit, available {self.disk_budget.available_bytes(file_path) / MB:.1f} MB "
+            f"(keeping {self.disk_budget.min_free_bytes / MB:.0f} MB free)")
+        self._record_failure(file_path, error)
+        future.set_exception(error)
+
+    def _submit_deferred(self) -> bool:
+        # called when all running jobs are finished, returns False when nothing was deferred
+        with self._lock:
+            deferred = self._deferred
+            self._deferred = []
+        for future, file_path, size, fn, args, kwargs, transfer in deferred:
+            if not self.disk_budget.try_reserve(file_path, size):
+                self._skip_for_space(future, file_path, size)
+                continue
+            click.echo(f"Start deferred {file_path}")
+            job = self._submit(self._model_pool, file_path, self._run_reserved, (file_path, fn, args, kwargs), {},
+                               transfer)
+            job.add_done_callback(functools.partial(_copy_future_result, future))
+        return bool(deferred)
+
+    def submit_image(self, description: str, fn: Callable[..., Any], *args,
+                     transfer: Optional[TransferInfo] = None, **kwargs) -> Future:
+        return self._submit(self._image_pool, description, fn, args, kwargs,
+                            transfer if transfer is not None else TransferInfo(KIND_IMAGE))
+
+    @property
+    def is_async(self) -> bool:
+        return self._async_engine is not None
+
+    def submit_image_coroutine(self, description: str, coroutine_fn: Callable[..., Awaitable], *args,
+                               transfer: Optional[TransferInfo] = None, **kwargs) -> Future:
+        # job runs in event loop of async engine, no thread is blocked while it waits for network,
+        # queued coroutines start in order of policy like jobs of image pool
+        if transfer is None:
+            transfer = TransferInfo(KIND_IMAGE)
+        key = policy_key(self.policy, transfer, next(self._sequence))
+        self._pending.acquire()
+        self._job_submitted(transfer)
+        try:
+            future = self._async_engine.submit(self._run_async_job(description, coroutine_fn, args, kwargs,
+                                                                   transfer, key))
+        except BaseException:
+            self._job_finished(transfer, failed=True)
+            raise
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def _submit(self, pool: PriorityExecutor, description: str,
+                fn: Callable[..., Any], args: Tuple, kwargs: dict, transfer: TransferInfo) -> Future:
+        self._pending.acquire()
+        self._job_submitted(transfer)
+        try:
+            future = pool.submit(policy_key(self.policy, transfer, next(self._sequence)),
+                                 self._run_job, description, fn, args, kwargs, transfer)
+        except BaseException:
+            self._job_finished(transfer, failed=True)
+            raise
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def _images_pending(self) -> bool:
+        with self._lock:
+            return self._image_jobs > 0
+
+    def _job_submitted(self, transfer: TransferInfo) -> None:
+        if transfer.kind == KIND_IMAGE:
+            with self._lock:
+                self._image_jobs += 1
+        if self.progress is not None:
+            self.progress.add_job()
+
+    def _job_finished(self, transfer: TransferInfo, failed: bool) -> None:
+        images_done = False
+        with self._lock:
+            if transfer.kind == KIND_IMAGE:
+                self._image_jobs -= 1
+                images_done = self._image_jobs == 0
+        if self.progress is not None:
+            self.progress.finish_job(failed)
+        if images_done and self.policy == POLICY_METADATA_FIRST:
+            self._model_pool.wake()
+        self._pending.release()
+
+    def _run_job(self, description: str, fn: Callable[..., Any], args: Tuple, kwargs: dict,
+                 transfer: TransferInfo) -> Any:
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        except (Exception, SystemExit) as e:
+            # one broken file or image must not stop the others
+            self._record_failure(description, e)
+            raise
+        finally:
+            with self._lock:
+                self._completed += 1
+            self._job_finished(transfer, failed)
+
+    async def _run_async_job(self, description: str, coroutine_fn: Callable[..., Awaitable], args: Tuple,
+                             kwargs: dict, transfer: TransferInfo, key: Tuple) -> Any:
+        failed = True
+        try:
+            async with self._async_image_slots.slot(key):
+                result = await coroutine_fn(*args, **kwargs)
+            failed = False
+            return result
+        except Exception as e:
+            self._record_failure(description, e)
+            raise
+        finally:
+            with self._lock:
+                self._completed += 1
+            self._job_finished(transfer, failed)
+
+    def _record_failure(self, description: str, error: BaseException) -> None:
+        with self._lock:
+            self._failures.append(DownloadJobFailure(description, error))
+        click.echo(Fore.RED + f"Job {description} failed: {error!r}" + Style.RESET_ALL)
+
+    @property
+    def failures(self) -> List[DownloadJobFailure]:
+        with self._lock:
+            return list(self._failures)
+
+    def wait(self) -> List[DownloadJobFailure]:
+        # jobs may be submitted while we wait (from other threads), so loop until drained
+        while True:
+            with self._lock:
+                futures = self._futures
+                self._futures = []
+            if not futures:
+                if self.disk_budget is None or not self._submit_deferred():
+                    break
+                continue
+            # failures are already recorded by _run_job
+            wait(futures)
+        return self.failures
+
+    @staticmethod
+    def when_all_succeed(futures: List[Future], callback: Callable[[], Any]) -> None:
+        # callback runs in the thread of the last finished job, only when no job of the group failed
+        if not futures:
+            callback()
+            return
+        state_lock = threading.Lock()
+        state = {"left": len(futures), "failed": False}
+
+        def on_done(future: Future) -> None:
+            with state_lock:
+                state["left"] -= 1
+                if future.exception() is not None:
+                    state["failed"] = True
+                run_callback = state["left"] == 0 and not state["failed"]
+            if run_callback:
+                callback()
+
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    @staticmethod
+    def when_all_done(futures: List[Future], callback: Callable[[bool], Any]) -> None:
+        # callback gets True when no job of the group failed
+        if not futures:
+            callback(True)
+            return
+        state_lock = threading.Lock()
+        state = {"left": len(futures), "failed": False}
+
+        def on_done(future: Future) -> None:
+            with state_lock:
+                state["left"] -= 1
+                if future.exception() is not None:
+                    state["failed"] = True
+                run_callback = state["left"] == 0
+            if run_callback:
+                callback(not state["failed"])
+
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def shutdown(self) -> None:
+        self._model_pool.shutdown(wait=True)
+        self._image_pool.shutdown(wait=True)
+
+    def print_summary(self) -> None:
+        failures = self.failures
+        click.echo(f"jobs completed = {self._completed}, failed = {len(failures)}")
+        for failure in failures:
+            click.echo(Fore.RED + f"\tfailed: {failure}" + Style.RESET_ALL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.wait()
+        self.shutdown()
+        return False
@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import threading
+import time
+from os import path
+from typing import Optional, Tuple
+
+from hashing import compute_file_hash
+from metrics import get_metrics, OP_HASH_CACHE
+
+HASH_CACHE_FILE_NAME = ".civitai_hash_cache.sqlite3"
+
+
+class HashCache:
+    """
+    Persistent digests of local files, stored in sd-webui root or in db_dir (local folder of a shared root worker).
+    Entry is valid while path, size, mtime and inode of the file are the same as when it was hashed.
+    """
+
+    def __init__(self, sd_webui_root_dir: str, db_dir: Optional[str] = None):
+        self.db_path = path.join(db_dir or path.abspath(sd_webui_root_dir), HASH_CACHE_FILE_NAME)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS file_hashes (
+                    path TEXT NOT NULL,
+                    algorithm TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    digest TEXT NOT NULL,
+                    hashed_at REAL NOT NULL,
+                    PRIMARY KEY (path, algorithm)
+                )""")
+            self._conn.commit()
+
+    @staticmethod
+    def _file_key(file_path: str) -> Optional[Tuple[str, int, int, int]]:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return path.abspath(file_path), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(self, file_path: str, algorithm: str) -> Optional[str]:
+        file_key = self._file_key(file_path)
+        if file_key is None:
+            return None
+        abs_path, size, mtime_ns, inode = file_key
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest FROM file_hashes "
+                "WHERE path = ? AND algorithm = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                (abs_path, algorithm, size, mtime_ns, inode)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, file_path: str, algorithm: str, digest: str) -> None:
+        file_key = self._file_key(file_path)
+        if file_key is None:
+            return
+        abs_path, size, mtime_ns, inode = file_key
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO file_hashes (path, algorithm, size, mtime_ns, inode, digest, hashed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (abs_path, algorithm, size, mtime_ns, inode, digest, time.time()))
+            self._conn.commit()
+
+    def compute(self, file_path: str, algorithm: str) -> str:
+        with get_metrics().operation(OP_HASH_CACHE, path=file_path, algorithm=algorithm) as op:
+            digest = self.get(file_path, algorithm)
+            # hits are counted by metrics only, a line per file would flood the log of a big library
+            op.cache_hit = digest is not None
+            if digest is not None:
+                return digest
+            digest = compute_file_hash(file_path, algorithm)
+            self.put(file_path, algorithm, digest)
+            return digest
+
+    def _all_entries(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT path, algorithm, size, mtime_ns, inode FROM file_hashes").fetchall()
+
+    def _delete(self, abs_path: str, algorithm: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM file_hashes WHERE path = ? AND algorithm = ?", (abs_path, algorithm))
+            self._conn.commit()
+
+    def prune(self) -> int:
+        # remove entries of deleted or changed files
+        removed = 0
+        for abs_path, algorithm, size, mtime_ns, inode in self._all_entries():
+            if self._file_key(abs_path) != (abs_path, size, mtime_ns, inode):
+                self._delete(abs_path, algorithm)
+                removed += 1
+        return removed
+
+    def rebuild(self) -> int:
+        # hash again every cached file what still exists on disk
+        rehashed = 0
+        for abs_path, algorithm, _, _, _ in self._all_entries():
+            if not path.isfile(abs_path):
+                self._delete(abs_path, algorithm)
+                continue
+            print(f"rehash {abs_path}")
+            self.put(abs_path, algorithm, compute_file_hash(abs_path, algorithm))
+            rehashed += 1
+        return rehashed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM file_hashes")
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM file_hashes").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,172 @@
+import hashlib
+import mmap
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Iterable
+
+from blake3 import blake3
+
+from metrics import get_metrics, OP_HASH
+
+# big reads: python loop overhead per chunk is negligible and blake3 can split the chunk across threads
+HASH_READ_BUFFER_SIZE = 8 * 1024 * 1024
+BLAKE3_MAX_THREADS = blake3.AUTO
+
+HASH_STRATEGY_BUFFERED = "buffered"
+HASH_STRATEGY_MMAP = "mmap"
+HASH_STRATEGIES = [HASH_STRATEGY_BUFFERED, HASH_STRATEGY_MMAP]
+
+# civitai "hashes" keys we can verify, the first present one is used
+SUPPORTED_CIVITAI_HASHES = ["BLAKE3", "SHA256", "AutoV2"]
+ALL_HASH_ALGORITHMS = ["SHA256", "BLAKE3", "CRC32", "AutoV2"]
+
+# AutoV2 is first 10 hex chars of sha256 of the whole file
+AUTOV2_LENGTH = 10
+
+
+class _Crc32:
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data) -> None:
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self) -> str:
+        return f"{self._value:08x}"
+
+
+class MultiHasher:
+    """
+    Several civitai hash algorithms computed in one pass over the data.
+    SHA256 and AutoV2 share one sha256 state.
+    """
+
+    def __init__(self, algorithms: Iterable[str], blake3_max_threads: int = BLAKE3_MAX_THREADS):
+        self.algorithms = list(algorithms)
+        self._states = {}
+        for algorithm in self.algorithms:
+            base_algorithm = self._base_algorithm(algorithm)
+            if base_algorithm in self._states:
+                continue
+            if base_algorithm == "BLAKE3":
+                self._states[base_algorithm] = blake3(max_threads=blake3_max_threads)
+            elif base_algorithm == "SHA256":
+                self._states[base_algorithm] = hashlib.sha256()
+            else:
+                self._states[base_algorithm] = _Crc32()
+
+    @staticmethod
+    def _base_algorithm(algorithm: str) -> str:
+        if algorithm in ("SHA256", "AutoV2"):
+            return "SHA256"
+        if algorithm in ("BLAKE3", "CRC32"):
+            return algorithm
+        raise ValueError(f"Not supported hash algorithm {algorithm}")
+
+    def update(self, data, pool: Optional[ThreadPoolExecutor] = None) -> None:
+        # hashlib, blake3 and zlib release GIL on big buffers, so states can be updated in parallel
+        if pool is None or len(self._states) == 1:
+            for state in self._states.values():
+                state.update(data)
+        else:
+            for future in [pool.submit(state.update, data) for state in self._states.values()]:
+                future.result()
+
+    def hexdigests(self) -> Dict[str, str]:
+        result = {}
+        for algorithm in self.algorithms:
+            digest = self._states[self._base_algorithm(algorithm)].hexdigest().upper()
+            if algorithm == "AutoV2":
+                digest = digest[:AUTOV2_LENGTH]
+            result[algorithm] = digest
+        return result
+
+
+class StreamHasher:
+    """Incremental hash of a civitai hash algorithm, fed with the bytes as they are written."""
+
+    def __init__(self, algorithm: str):
+        self.algorithm = algorithm
+        self._hasher = MultiHasher([algorithm])
+
+    def update(self, data: bytes) -> None:
+        self._hasher.update(data)
+
+    def hexdigest(self) -> str:
+        return self._hasher.hexdigests()[self.algorithm]
+
+
+class ExpectedHash:
+    def __init__(self, algorithm: str, value: str):
+        self.algorithm = algorithm
+        self.value = value.upper()
+
+    def __str__(self):
+        return f"{self.algorithm} {self.value}"
+
+
+def select_civitai_hash(hashes_from_civitai: Optional[Dict[str, str]]) -> Optional[ExpectedHash]:
+    if not hashes_from_civitai:
+        return None
+    for algorithm in SUPPORTED_CIVITAI_HASHES:
+        value = hashes_from_civitai.get(algorithm)
+        if value:
+            return ExpectedHash(algorithm, value)
+    return None
+
+
+def _feed_buffered(hasher: MultiHasher, file_path: str, buffer_size: int,
+                   pool: Optional[ThreadPoolExecutor]) -> None:
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            hasher.update(view[:size], pool=pool)
+
+
+def _feed_mmap(hasher: MultiHasher, file_path: str, buffer_size: int,
+               pool: Optional[ThreadPoolExecutor]) -> None:
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            for offset in range(0, len(mapped), buffer_size):
+                hasher.update(view[offset:offset + buffer_size], pool=pool)
+        finally:
+            view.release()
+
+
+def hash_file(file_path: str,
+              algorithms: List[str],
+              strategy: str = HASH_STRATEGY_BUFFERED,
+              buffer_size: int = HASH_READ_BUFFER_SIZE,
+              blake3_max_threads: int = BLAKE3_MAX_THREADS,
+              parallel_algorithms: bool = True) -> Dict[str, str]:
+    """Compute all algorithms in one read of the file. Returns dict algorithm -> upper hex digest."""
+    hasher = MultiHasher(algorithms, blake3_max_threads=blake3_max_threads)
+    if strategy == HASH_STRATEGY_MMAP and os.path.getsize(file_path) == 0:
+        # empty file can not be mapped
+        strategy = HASH_STRATEGY_BUFFERED
+
+    use_pool = parallel_algorithms and len(algorithms) > 1 and (os.cpu_count() or 1) > 1
+    pool = ThreadPoolExecutor(max_workers=len(algorithms), thread_name_prefix="hash") if use_pool else None
+    with get_metrics().operation(OP_HASH, path=file_path, algorithms=algorithms, strategy=strategy) as op:
+        try:
+            if strategy == HASH_STRATEGY_MMAP:
+                _feed_mmap(hasher, file_path, buffer_size, pool)
+            elif strategy == HASH_STRATEGY_BUFFERED:
+                _feed_buffered(hasher, file_path, buffer_size, pool)
+            else:
+                raise ValueError(f"Not supported hash strategy {strategy}")
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        op.bytes = os.path.getsize(file_path)
+    return hasher.hexdigests()
+
+
+def compute_file_hash(file_path: str, algorithm: str) -> str:
+    return hash_file(file_path, [algorithm])[algorithm]
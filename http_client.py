@@ -0,0 +1,176 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Iterator, TYPE_CHECKING
+from urllib.parse import urlsplit
+
+from bandwidth import BandwidthLimiter
+from metrics import get_metrics, OP_HTTP_RETRY
+from rate_limit import RateLimiterRegistry, HostRateLimiter, parse_retry_after, backoff_delay, RETRY_STATUSES, \
+    DEFAULT_MAX_BACKOFF
+
+if TYPE_CHECKING:
+    import cloudscraper
+    import requests
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_CONNECT_TIMEOUT = 15.0
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_PER_HOST_LIMIT = 8
+DEFAULT_RATE_LIMIT = 0
+DEFAULT_RATE_BURST = 4
+
+# headers of description pictures session (imagecache checks referer)
+SCRAPER_HEADERS = {
+    'referer': 'imagecache.civitai.com',
+    'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8'
+}
+
+
+class HttpClient:
+    """
+    Pooled keep-alive sessions for every network path: api, model files, sample images and description pictures.
+    Requests to one host go through its rate limiter: token bucket of rate_limit requests per second and
+    up to per_host_limit parallel requests, lowered automatically when the host answers 429/503.
+    Bytes of transfers are capped by bandwidth limiter, callers take its tokens for every received chunk.
+    """
+
+    def __init__(self,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 retries: int = DEFAULT_RETRIES,
+                 backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 per_host_limit: int = DEFAULT_PER_HOST_LIMIT,
+                 rate_limit: float = DEFAULT_RATE_LIMIT,
+                 rate_burst: int = DEFAULT_RATE_BURST,
+                 adaptive_concurrency: bool = True,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF,
+                 bandwidth: Optional[BandwidthLimiter] = None):
+        # requests is imported by the first client, commands without network do not pay for it
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.rate_limiters = RateLimiterRegistry(rate=rate_limit, burst=rate_burst,
+                                                 max_concurrency=max(1, per_host_limit),
+                                                 adaptive=adaptive_concurrency)
+        self.bandwidth = bandwidth if bandwidth is not None else BandwidthLimiter()
+        # urllib3 retries connect errors only, answers are retried by _retry_delay with rate limiter feedback
+        self.retry = Retry(total=retries,
+                           backoff_factor=backoff_factor,
+                           status=0,
+                           allowed_methods=frozenset(["GET", "HEAD"]),
+                           raise_on_status=False)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=self.retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._scraper: Optional["cloudscraper.CloudScraper"] = None
+        self._lock = threading.Lock()
+
+    @property
+    def scraper(self) -> "cloudscraper.CloudScraper":
+        with self._lock:
+            if self._scraper is None:
+                import cloudscraper
+                import requests
+                scraper_sess = requests.Session()
+                scraper_sess.headers = dict(SCRAPER_HEADERS)
+                scraper = cloudscraper.create_scraper(
+                    browser={
+                        'browser': 'chrome',
+                        'platform': 'windows',
+                        'desktop': True
+                    },
+                    sess=scraper_sess
+                )
+                # keep cloudscraper tls settings, only pool and retries are changed
+                scraper.mount("https://", cloudscraper.CipherSuiteAdapter(
+                    cipherSuite=scraper.cipherSuite,
+                    ecdhCurve=scraper.ecdhCurve,
+                    server_hostname=scraper.server_hostname,
+                    source_address=scraper.source_address,
+                    ssl_context=scraper.ssl_context,
+                    pool_connections=self.pool_size,
+                    pool_maxsize=self.pool_size,
+                    max_retries=self.retry))
+                self._scraper = scraper
+            return self._scraper
+
+    def limiter(self, url: str) -> HostRateLimiter:
+        return self.rate_limiters.for_host(urlsplit(url).netloc.lower())
+
+    def retry_delay(self, url: str, status_code: int, retry_after_header: Optional[str], attempt: int,
+                    limiter: HostRateLimiter) -> Optional[float]:
+        # reports answer to limiter, returns seconds before next attempt or None when answer is final
+        retry_after = parse_retry_after(retry_after_header)
+        limiter.on_answer(status_code, retry_after)
+        if status_code not in RETRY_STATUSES or attempt >= self.retries:
+            return None
+        delay = backoff_delay(attempt, self.backoff_factor, retry_after, self.max_backoff)
+        get_metrics().event(OP_HTTP_RETRY, url=url, status=status_code, attempt=attempt + 1, delay=round(delay, 3))
+        print(f"{url} answered {status_code}, retry {attempt + 1}/{self.retries} in {delay:.1f} s")
+        return delay
+
+    def get(self, url: str, use_cloudscraper: bool = False, **kwargs) -> "requests.Response":
+        # whole body is read while host slot is held
+        kwargs.setdefault("timeout", self.timeout)
+        session = self.scraper if use_cloudscraper else self.session
+        limiter = self.limiter(url)
+        attempt = 0
+        while True:
+            with limiter.slot():
+                resp = session.get(url, **kwargs)
+            delay = self.retry_delay(url, resp.status_code, resp.headers.get("retry-after"), attempt, limiter)
+            if delay is None:
+                return resp
+            time.sleep(delay)
+            attempt += 1
+
+    @contextmanager
+    def stream(self, url: str, use_cloudscraper: bool = False, **kwargs) -> Iterator["requests.Response"]:
+        # host slot is held until headers arrived: a multi-GB body does not block api requests of the host,
+        # its bytes are capped by bandwidth limiter. connection is released when the with block ends
+        kwargs.setdefault("timeout", self.timeout)
+        session = self.scraper if use_cloudscraper else self.session
+        limiter = self.limiter(url)
+        attempt = 0
+        while True:
+            with limiter.slot():
+                resp = session.get(url, stream=True, **kwargs)
+            try:
+                delay = self.retry_delay(url, resp.status_code, resp.headers.get("retry-after"), attempt, limiter)
+                if delay is None:
+                    yield resp
+                    return
+            finally:
+                resp.close()
+            time.sleep(delay)
+            attempt += 1
+
+
+_http_client: Optional[HttpClient] = None
+_http_client_lock = threading.Lock()
+
+
+def configure_http_client(**kwargs) -> HttpClient:
+    global _http_client
+    with _http_client_lock:
+        _http_client = HttpClient(**kwargs)
+        return _http_client
+
+
+def get_http_client() -> HttpClient:
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient()
+        return _http_client
@@ -0,0 +1,81 @@
+import re
+import threading
+from typing import Any, Dict, Optional
+
+IMAGE_FORMATS = ["jpeg", "webp", "avif"]
+# <image host>/<account>/<uuid>/<options like width=450 or width=0,format=webp>/<name>
+IMAGE_OPTIONS_REGEX_PATTERN = re.compile(
+    r"^(?P<prefix>.*/\w+/\w+-\w+-\w+-\w+-\w+/)(?P<options>[\w.=,-]*\b(?:width|original)=[\w.=,-]*)(?P<suffix>/[^/]+)$")
+# sample metadata key of images saved as preview, the upgrade pass downloads them at full size
+VARIANT_KEY = "_variant"
+PREVIEWS_FILE_NAME = ".previews.json"
+MB = 1024 * 1024
+
+
+class ImageVariant:
+    """Width and format of sample images and description pictures, set by options segment of imagecache url."""
+
+    def __init__(self, width: Optional[int] = None, image_format: Optional[str] = None):
+        self.width = width
+        self.image_format = image_format
+
+    def url(self, url: str) -> str:
+        # urls of other form are returned as is
+        url_match = IMAGE_OPTIONS_REGEX_PATTERN.match(url)
+        if url_match is None:
+            return url
+        options: Dict[str, str] = {}
+        for option in url_match.group("options").split(","):
+            key, _, value = option.partition("=")
+            options[key] = value
+        if self.width is not None:
+            options.pop("original", None)
+            options["width"] = str(self.width)
+        if self.image_format is not None:
+            options["format"] = self.image_format
+        return (url_match.group("prefix") + ",".join(f"{key}={value}" for key, value in options.items())
+                + url_match.group("suffix"))
+
+    def full_size_ratio(self, image_json: Dict[str, Any]) -> Optional[float]:
+        # pixels of full image per pixel of preview, from image size of civitai api
+        width = image_json.get("width")
+        if self.width is None or not width or self.width >= width:
+            return None
+        return (width / self.width) ** 2
+
+    def __str__(self):
+        return ",".join(f"{key}={value}" for key, value in (("width", self.width), ("format", self.image_format))
+                        if value is not None)
+
+
+class PreviewSavings:
+    """Bytes of images downloaded as previews, with estimate of the same images at full size."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.downloaded_bytes = 0
+        # only images with known size at civitai
+        self.estimated_images = 0
+        self.estimated_downloaded_bytes = 0
+        self.estimated_full_bytes = 0.0
+
+    def add(self, downloaded_bytes: int, full_size_ratio: Optional[float]) -> None:
+        with self._lock:
+            self.images += 1
+            self.downloaded_bytes += downloaded_bytes
+            if full_size_ratio is not None:
+                self.estimated_images += 1
+                self.estimated_downloaded_bytes += downloaded_bytes
+                self.estimated_full_bytes += downloaded_bytes * full_size_ratio
+
+    def summary(self) -> Optional[str]:
+        with self._lock:
+            if not self.images:
+                return None
+            text = f"previews: {self.images} images, {self.downloaded_bytes / MB:.1f} MB"
+            if self.estimated_images:
+                saved = self.estimated_full_bytes - self.estimated_downloaded_bytes
+                text += (f", about {saved / MB:.1f} MB saved against full size "
+                         f"({self.estimated_images} images with known size)")
+            return text
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import re
+import platform
+import threading
+from os import path
+from typing import Any, Dict, Iterator, List, Optional
+
+CIVITAI_MODEL_ORIGINAL_NAME_JSON = "civitai_model.original.json"
+CIVITAI_MODEL_DESC_NAME_HTML = "civitai_model_desc.html"
+SAMPLES_FOLDER_NAME = "samples"
+PICS_FOLDER_NAME = "pics"
+
+CIVITAI_MODEL_TYPES = ["Checkpoint", "LORA", "Poses", "LoCon", "TextualInversion", "Hypernetwork", "Other", "Wildcards"]
+
+remove_non_english_with_dots = lambda s: re.sub(r'[^a-zA-Z\d\s\n\.]', ' ', s)
+remove_non_english_without_dots = lambda s: re.sub(r'[^a-zA-Z\d\s\n\.]', ' ', s)
+
+
+def remove_multiple_underscores(text):
+    result = []
+    prev_char = None
+    for char in text:
+        if char == "_" and prev_char == "_":
+            continue
+        result.append(char)
+        prev_char = char
+    return "".join(result)
+
+
+def process_str_string(input: str, with_dots: bool) -> str:
+    if with_dots:
+        first_step = remove_non_english_with_dots(input).rstrip().lstrip().replace(" ", "_")
+    else:
+        first_step = remove_non_english_without_dots(input).rstrip().lstrip().replace(" ", "_")
+    return remove_multiple_underscores(first_step)
+
+
+# types of civitai resources
+# 'Checkpoint' -> 'models\Stable-diffusion'
+# LORA -> 'models\LoRA'
+# Poses -> models\Poses
+# -> extensions\sd-webui-additional-networks\models\lora\Locon
+def get_web_ui_folder_by_type(base_path: str, type_str: str) -> str:
+    if type_str == "Checkpoint":
+        return path.join(base_path, "models", "Stable-diffusion")
+    elif type_str == "LORA":
+        return path.join(base_path, "models", "LoRA")
+    elif type_str == "Poses":
+        return path.join(base_path, "models", "Poses")
+    elif type_str == "LoCon":
+        return path.join(base_path, "extensions", "sd-webui-additional-networks", "models", "lora", "Locon")
+    elif type_str == "TextualInversion":
+        return path.join(base_path, "embeddings")
+    elif type_str == "Hypernetwork":
+        return path.join(base_path, "models", "hypernetworks")
+    elif type_str == "Other":
+        return path.join(base_path, "models", "Other")
+    elif type_str == "Wildcards":
+        return path.join(base_path, "Wildcards")
+    else:
+        raise Exception("Not supported type yet?")
+
+
+def get_model_folder(sd_webui_root_dir: str, model_data_json: Any) -> str:
+    model_page_name_procesed = process_str_string(model_data_json['name'], with_dots=False)
+    return path.join(get_web_ui_folder_by_type(sd_webui_root_dir, model_data_json["type"]),
+                     f"{model_data_json['id']}_" + model_page_name_procesed)
+
+
+def get_model_version_folder(folder_for_current_model: str, model_version_json_data: Any) -> str:
+    return path.join(folder_for_current_model, process_str_string(model_version_json_data['name'], with_dots=True))
+
+
+def get_all_web_ui_model_folders(base_path: str) -> List[str]:
+    return [get_web_ui_folder_by_type(base_path, type_str) for type_str in CIVITAI_MODEL_TYPES]
+
+
+def skip_file_name_ext_by_skip_list(skip_download_file_exts: List[str], file_name_with_ext: str) -> bool:
+    for skip_download_file_ext in skip_download_file_exts:
+        if file_name_with_ext.endswith(f".{skip_download_file_ext}"):
+            return True
+    return False
+
+
+def file_skip_reason(current_file: Dict[str, Any], disable_sec_checks: bool,
+                     skip_download_file_ext_list: List[str]) -> Optional[str]:
+    # rules of download_model, files what are not downloaded with these options
+    file_model_is_safe = current_file.get('pickleScanResult') == "Success" \
+        and current_file.get('virusScanResult') == "Success"
+    if not file_model_is_safe and not disable_sec_checks:
+        return "security scans not passed"
+    if skip_file_name_ext_by_skip_list(skip_download_file_ext_list, current_file['name']):
+        return "skipped by extension"
+    return None
+
+
+def iter_model_folders(sd_webui_root_dir: str) -> Iterator[str]:
+    # <type folder>/<model id>_<name> of downloaded models
+    for type_folder in get_all_web_ui_model_folders(path.abspath(sd_webui_root_dir)):
+        if not path.isdir(type_folder):
+            continue
+        for model_folder in sorted(os.scandir(type_folder), key=lambda entry: entry.name):
+            if model_folder.is_dir():
+                yield model_folder.path
+
+
+def worker_state_dir(sd_webui_root_dir: str) -> str:
+    """
+    Local folder of sqlite databases of one sd-webui root. Shared root (--shared-run on a NAS) keeps only plain files
+    written atomically or with O_EXCL, sqlite locking and WAL shared memory do not work on NFS/SMB.
+    """
+    root_dir = path.abspath(sd_webui_root_dir)
+    cache_home = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") \
+        or path.join(path.expanduser("~"), ".cache")
+    root_name = re.sub(r"[^\w.-]", "_", path.basename(root_dir)) or "root"
+    state_dir = path.join(cache_home, "civitai_downloader",
+                          f"{root_name}-{hashlib.sha1(root_dir.encode('utf-8')).hexdigest()[:12]}")
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def unique_tmp_path(file_path: str) -> str:
+    # tmp file of atomic write, unique also between hosts of shared library
+    host_name = re.sub(r"[^\w.-]", "_", platform.node())
+    return f"{file_path}.{host_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def write_json_atomic(file_path: str, data) -> None:
+    """Readers (and other workers) see the old or the new file, never a partial one."""
+    tmp_file_path = unique_tmp_path(file_path)
+    try:
+        with open(tmp_file_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        if path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        raise
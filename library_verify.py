@@ -0,0 +1,192 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import path
+from typing import List, Dict, Any, Optional, Set, Tuple
+
+from hash_cache import HashCache
+from hashing import select_civitai_hash, hash_file
+from library_layout import get_all_web_ui_model_folders, process_str_string, file_skip_reason, \
+    CIVITAI_MODEL_ORIGINAL_NAME_JSON, SAMPLES_FOLDER_NAME, PICS_FOLDER_NAME
+
+STATUS_OK = "ok"
+STATUS_MISMATCHED = "mismatched"
+STATUS_MISSING = "missing"
+STATUS_NO_HASH = "no_hash"
+STATUS_ORPHANED = "orphaned"
+# absent file what download_model does not download with given options, it is not a failure
+STATUS_NOT_SELECTED = "not_selected"
+ALL_STATUSES = [STATUS_OK, STATUS_MISMATCHED, STATUS_MISSING, STATUS_NO_HASH, STATUS_ORPHANED, STATUS_NOT_SELECTED]
+
+# files in version folders what looks like model data, used to detect orphans
+MODEL_FILE_EXTENSIONS = {".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".zip", ".yaml", ".inc", ".part"}
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+
+
+class LibraryFile:
+    def __init__(self, file_path: str, model_id: Optional[int], model_version_id: Optional[int],
+                 algorithm: Optional[str] = None, expected: Optional[str] = None, skip_reason: Optional[str] = None):
+        self.file_path = file_path
+        self.model_id = model_id
+        self.model_version_id = model_version_id
+        self.algorithm = algorithm
+        self.expected = expected
+        # why download_model skips the file, it is still verified when it exists
+        self.skip_reason = skip_reason
+        self.actual: Optional[str] = None
+        self.status: Optional[str] = None
+        self.error: Optional[str] = None
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"path": self.file_path,
+                "status": self.status,
+                "model_id": self.model_id,
+                "model_version_id": self.model_version_id,
+                "algorithm": self.algorithm,
+                "expected": self.expected,
+                "actual": self.actual,
+                "skip_reason": self.skip_reason,
+                "error": self.error}
+
+
+def discover_library(sd_webui_root_dir: str, disable_sec_checks: bool = False,
+                     skip_download_file_ext_list: Optional[List[str]] = None) -> List[LibraryFile]:
+    """
+    Expected files come from civitai_model.original.json saved in every model folder,
+    any other model-like file in version folders is orphaned.
+    Files what download_model skips with the same options, and files of versions without folder (not selected
+    by manifest ?modelVersionId=), are not expected.
+    """
+    library_files: List[LibraryFile] = []
+    for folder_for_model_type in sorted(set(get_all_web_ui_model_folders(sd_webui_root_dir))):
+        if not path.isdir(folder_for_model_type):
+            continue
+        for model_folder_name in sorted(os.listdir(folder_for_model_type)):
+            folder_for_current_model = path.join(folder_for_model_type, model_folder_name)
+            path_for_model_original_json = path.join(folder_for_current_model, CIVITAI_MODEL_ORIGINAL_NAME_JSON)
+            if not path.isfile(path_for_model_original_json):
+                continue
+            with open(path_for_model_original_json, "r") as f:
+                model_data_json = json.load(f)
+            library_files.extend(_discover_model(folder_for_current_model, model_data_json, disable_sec_checks,
+                                                 skip_download_file_ext_list or []))
+    return library_files
+
+
+def _discover_model(folder_for_current_model: str, model_data_json: Any, disable_sec_checks: bool,
+                    skip_download_file_ext_list: List[str]) -> List[LibraryFile]:
+    library_files: List[LibraryFile] = []
+    version_folders: Set[str] = set()
+    expected_paths: Set[str] = set()
+    for model_version_json_data in model_data_json.get("modelVersions", []):
+        model_version_folder = path.join(folder_for_current_model,
+                                         process_str_string(model_version_json_data['name'], with_dots=True))
+        version_folders.add(model_version_folder)
+        # download_model creates folders of selected versions only
+        version_selected = path.isdir(model_version_folder)
+        for current_file in model_version_json_data.get("files", []):
+            file_path = path.join(model_version_folder, current_file['name'])
+            expected_paths.add(path.normcase(file_path))
+            expected_hash = select_civitai_hash(current_file.get('hashes'))
+            skip_reason = file_skip_reason(current_file, disable_sec_checks, skip_download_file_ext_list) \
+                if version_selected else "version not selected"
+            library_files.append(LibraryFile(file_path, model_data_json.get("id"), model_version_json_data.get("id"),
+                                             algorithm=expected_hash.algorithm if expected_hash else None,
+                                             expected=expected_hash.value if expected_hash else None,
+                                             skip_reason=skip_reason))
+
+    for model_version_folder in sorted(version_folders):
+        if not path.isdir(model_version_folder):
+            continue
+        for file_name in sorted(os.listdir(model_version_folder)):
+            file_path = path.join(model_version_folder, file_name)
+            if file_name in (SAMPLES_FOLDER_NAME, PICS_FOLDER_NAME) or not path.isfile(file_path):
+                continue
+            if path.splitext(file_name)[1].lower() not in MODEL_FILE_EXTENSIONS:
+                continue
+            if path.normcase(file_path) in expected_paths:
+                continue
+            orphan = LibraryFile(file_path, model_data_json.get("id"), None)
+            orphan.status = STATUS_ORPHANED
+            library_files.append(orphan)
+    return library_files
+
+
+def _hash_one(file_path: str, algorithm: str) -> str:
+    return hash_file(file_path, [algorithm])[algorithm]
+
+
+def verify_library(sd_webui_root_dir: str,
+                   io_concurrency: int = 2,
+                   executor: str = EXECUTOR_THREAD,
+                   hash_cache: Optional[HashCache] = None,
+                   on_result=None,
+                   disable_sec_checks: bool = False,
+                   skip_download_file_ext_list: Optional[List[str]] = None) -> List[LibraryFile]:
+    """
+    Hash all discovered files, at most io_concurrency files are read at the same time.
+    When hash_cache is passed, unchanged files are trusted from cache and new digests are stored.
+    """
+    library_files = discover_library(sd_webui_root_dir, disable_sec_checks=disable_sec_checks,
+                                     skip_download_file_ext_list=skip_download_file_ext_list)
+    # sizes are taken by the scan, so the sort does not stat files what may be removed meanwhile
+    to_hash: List[Tuple[int, LibraryFile]] = []
+    for library_file in library_files:
+        if library_file.status is not None:
+            pass
+        elif not path.isfile(library_file.file_path):
+            library_file.status = STATUS_MISSING if library_file.skip_reason is None else STATUS_NOT_SELECTED
+        elif library_file.algorithm is None:
+            library_file.status = STATUS_NO_HASH
+        else:
+            cached = hash_cache.get(library_file.file_path, library_file.algorithm) if hash_cache else None
+            if cached is not None:
+                _set_actual(library_file, cached)
+            else:
+                try:
+                    to_hash.append((path.getsize(library_file.file_path), library_file))
+                except OSError as e:
+                    library_file.status = STATUS_MISSING
+                    library_file.error = str(e)
+        if library_file.status is not None and on_result is not None:
+            on_result(library_file)
+
+    # biggest first, so one huge checkpoint does not start last and keep the run alive alone
+    to_hash.sort(key=lambda item: item[0], reverse=True)
+    pool_class = ThreadPoolExecutor
+    if executor == EXECUTOR_PROCESS:
+        # process pool pulls multiprocessing, it is imported only when used
+        from concurrent.futures import ProcessPoolExecutor
+        pool_class = ProcessPoolExecutor
+    with pool_class(max_workers=max(1, io_concurrency)) as pool:
+        futures = {pool.submit(_hash_one, f.file_path, f.algorithm): f for _, f in to_hash}
+        for future in as_completed(futures):
+            library_file = futures[future]
+            try:
+                actual = future.result()
+            except OSError as e:
+                library_file.status = STATUS_MISSING
+                library_file.error = str(e)
+            else:
+                _set_actual(library_file, actual)
+                if hash_cache is not None:
+                    hash_cache.put(library_file.file_path, library_file.algorithm, actual)
+            if on_result is not None:
+                on_result(library_file)
+    return library_files
+
+
+def _set_actual(library_file: LibraryFile, actual: str) -> None:
+    library_file.actual = actual
+    library_file.status = STATUS_OK if actual == library_file.expected else STATUS_MISMATCHED
+
+
+def build_report(sd_webui_root_dir: str, library_files: List[LibraryFile]) -> Dict[str, Any]:
+    summary = {status: 0 for status in ALL_STATUSES}
+    for library_file in library_files:
+        summary[library_file.status] += 1
+    return {"sd_webui_root_dir": path.abspath(sd_webui_root_dir),
+            "summary": summary,
+            "files": [library_file.to_json() for library_file in library_files]}
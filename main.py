@@ -1,67 +1,51 @@
 import datetime as dt
+import functools
 import json
 import math
 import os
 import platform
 import re
-from json import dump, JSONDecodeError
+from json import dump
 from os import path
 from os.path import abspath
 from pathlib import Path
 from re import Match
-from typing import Optional, Dict, Any, List
+from concurrent.futures import Future
+from typing import Optional, Dict, Any, List, Callable, Tuple, Set
 from datetime import datetime
 
 import click
-import cloudscraper as cloudscraper
-import requests
-from blake3 import blake3
-from bs4 import BeautifulSoup
 from colorama import Fore, Style
-from requests import get
-from tqdm import tqdm
 
-sess = requests.Session()
-
-sess.headers = {
-    'referer': 'imagecache.civitai.com',
-    'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8'
-}
-
-scraper = cloudscraper.create_scraper(
-    browser={
-        'browser': 'chrome',
-        'platform': 'windows',
-        'desktop': True
-    },
-    sess=sess
-)
+from hashing import StreamHasher, ExpectedHash, select_civitai_hash, compute_file_hash
+from async_engine import get_async_engine
+from content_store import ContentStore, IMAGE_NAMESPACE
+from disk_space import DiskSpaceBudget
+from hash_cache import HashCache
+from metrics import get_metrics, OP_DOWNLOAD
+from http_client import get_http_client
+from library_verify import verify_library, build_report, EXECUTOR_THREAD, EXECUTOR_PROCESS, \
+    STATUS_MISMATCHED, STATUS_MISSING, STATUS_NOT_SELECTED, STATUS_OK
+from library_layout import process_str_string, get_web_ui_folder_by_type, get_model_folder, get_model_version_folder, \
+    write_json_atomic, unique_tmp_path, iter_model_folders, skip_file_name_ext_by_skip_list, file_skip_reason, \
+    PICS_FOLDER_NAME, CIVITAI_MODEL_ORIGINAL_NAME_JSON, CIVITAI_MODEL_DESC_NAME_HTML
+from samples_store import open_samples, iter_samples_folders, migrate_samples_folder, export_samples_folder, \
+    Samples, SAMPLES_STORE_FILE_NAME
+from segmented_download import segmented_download, has_resumable_journal, DEFAULT_SEGMENT_COUNT, SEGMENT_CHUNK_SIZE
+from civitai_api import CivitaiApiClient, ListingFilters, iter_listing_pages, model_api_url, user_models_api_url, \
+    version_timestamp, MAX_LISTING_PAGE_LIMIT, DEFAULT_LISTING_PAGE_LIMIT, CIVITAI_MODEL_REGEX_PATTERN, \
+    CIVITAI_USER_REGEX_PATTERN
+from manifest import ManifestEntry, load_manifest, resolve_manifest, entry_result, MANIFEST_FORMATS, RESULT_OK
+from download_context import DownloadContext, download_context_options
+from download_scheduler import DownloadScheduler, DEFAULT_MAX_IMAGE_DOWNLOADS
+from description_pics import rewrite_description_pics
+from image_variants import ImageVariant, PreviewSavings, VARIANT_KEY, PREVIEWS_FILE_NAME
+from sync_plan import plan_model, build_plan, split_plan, format_plan_summary, load_measured_bandwidth
+from sync_state import SyncState
+from transfer_queue import TransferInfo, file_progress_bar, KIND_MODEL_FILE, KIND_IMAGE
 
 # some code from https://gist.github.com/tobiasraabe/58adee67de619ce621464c1a6511d7d9
-# resume download not supported on civitai
-
-remove_non_english_with_dots = lambda s: re.sub(r'[^a-zA-Z\d\s\n\.]', ' ', s)
-remove_non_english_without_dots = lambda s: re.sub(r'[^a-zA-Z\d\s\n\.]', ' ', s)
-
-
-def remove_multiple_underscores(text):
-    result = []
-    prev_char = None
-    for char in text:
-        if char == "_" and prev_char == "_":
-            continue
-        result.append(char)
-        prev_char = char
-    return "".join(result)
-
-
-def process_str_string(input: str, with_dots: bool) -> str:
-    if with_dots:
-        first_step = remove_non_english_with_dots(input).rstrip().lstrip().replace(" ", "_")
-    else:
-        first_step = remove_non_english_without_dots(input).rstrip().lstrip().replace(" ", "_")
-    return remove_multiple_underscores(first_step)
-
+# resume is done by range requests in segmented_download, when server supports it
 
 def creation_date(path_to_file):
     """
@@ -81,18 +65,16 @@ def creation_date(path_to_file):
             return stat.st_mtime
 
 
-def compute_blake3(file_path: str) -> str:
-    hash_blake3 = blake3()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_blake3.update(chunk)
-    return hash_blake3.hexdigest().upper()
-
-
-def check_blake3_hash_and_print(file_path: str, blake3_hash_from_civitai: str) -> bool:
-    blake3_hash_str = compute_blake3(str(file_path))
-    print(f"blake3 hash: {blake3_hash_str}")
-    if blake3_hash_from_civitai == blake3_hash_str:
+def check_hash_and_print(file_path: str, expected_hash: ExpectedHash, computed_hash: Optional[str] = None,
+                         hash_cache: Optional[HashCache] = None) -> bool:
+    # computed_hash is passed when hash was calculated on the stream while downloading
+    if computed_hash is None:
+        if hash_cache is not None:
+            computed_hash = hash_cache.compute(str(file_path), expected_hash.algorithm)
+        else:
+            computed_hash = compute_file_hash(str(file_path), expected_hash.algorithm)
+    print(f"{expected_hash.algorithm} hash: {computed_hash}")
+    if expected_hash.value == computed_hash:
         print(f"For file hash check ok")
         return True
 
@@ -101,12 +83,37 @@ def check_blake3_hash_and_print(file_path: str, blake3_hash_from_civitai: str) -
     return False
 
 
+def download_and_check_hash(url: str, file_save_path_str_path: str, download_segments: int,
+                            expected_hash: Optional[ExpectedHash],
+                            hash_cache: Optional[HashCache] = None) -> Optional[bool]:
+    hasher = StreamHasher(expected_hash.algorithm) if expected_hash is not None else None
+    download_large_file(url, file_save_path_str_path, download_segments, hasher=hasher)
+    if expected_hash is None:
+        return None
+    computed_hash = hasher.hexdigest()
+    if hash_cache is not None:
+        hash_cache.put(file_save_path_str_path, expected_hash.algorithm, computed_hash)
+    return check_hash_and_print(file_save_path_str_path, expected_hash, computed_hash=computed_hash)
+
+
 def download_file(url: str, file_save_path_str_path: str,
                   remove_incompleted_files: bool,
                   no_check_hash_for_exist: bool,
                   file_size_kb_from_civitai: Optional[float] = None,  # 6207.875
-                  blake3_hash_from_civitai: Optional[str] = None) -> None:
+                  hashes_from_civitai: Optional[Dict[str, str]] = None,
+                  download_segments: int = DEFAULT_SEGMENT_COUNT,
+                  hash_cache: Optional[HashCache] = None,
+                  content_store: Optional[ContentStore] = None) -> bool:
+    # returns False when hash of the file does not match civitai
     file_save_path = Path(file_save_path_str_path)
+    expected_hash = select_civitai_hash(hashes_from_civitai)
+
+    def verified() -> bool:
+        # only files with checked hash get into content store
+        if content_store is not None:
+            content_store.ingest(file_save_path_str_path, expected_hash.algorithm, expected_hash.value,
+                                 hash_cache=hash_cache)
+        return True
 
     if file_save_path.is_file() and file_size_kb_from_civitai is not None:
         file_size_offline = file_save_path.stat().st_size
@@ -117,12 +124,12 @@ def download_file(url: str, file_save_path_str_path: str,
         print(f"file_size_offline_in_float_civitai = {file_size_offline_converted_to_civitai}")
 
         if not math.isclose(file_size_kb_from_civitai, file_size_offline_converted_to_civitai):
-            if blake3_hash_from_civitai is not None \
-                    and check_blake3_hash_and_print(file_save_path_str_path, blake3_hash_from_civitai):
+            if expected_hash is not None \
+                    and check_hash_and_print(file_save_path_str_path, expected_hash, hash_cache=hash_cache):
                 print(Fore.GREEN + f'File {url} to {file_save_path_str_path} is downloaded yet.'
                                    f' size from civitai != offline, but hashes are equals (bug in code)?')
                 print(Style.RESET_ALL)
-                return
+                return verified()
 
             print(Fore.YELLOW + f'File {url} to {file_save_path_str_path} is incomplete or damaged '
                                 f'Start download with rename current file to file with inc extension.')
@@ -149,110 +156,103 @@ def download_file(url: str, file_save_path_str_path: str,
                 print(Fore.YELLOW + f'Remove  {inc_file_save_str_path} file ok')
                 print(Style.RESET_ALL)
 
-            simple_download(url, str(file_save_path))
-            if blake3_hash_from_civitai is not None:
-                if check_blake3_hash_and_print(file_save_path_str_path, blake3_hash_from_civitai):
+            hash_check_result = download_and_check_hash(url, str(file_save_path), download_segments, expected_hash,
+                                                        hash_cache=hash_cache)
+            if hash_check_result is not None:
+                if hash_check_result:
                     print(Fore.GREEN + 'downloaded hashes checked. All ok.')
                     print(Style.RESET_ALL)
-                    return
+                    return verified()
                 else:
                     print(Fore.RED + 'downloaded hashes check fail. bad!!!')
                     print(Style.RESET_ALL)
-                    return
+                    return False
                     # TODO remove file??? or create invalid file mark (filename + .invalid)?
         else:
             print(f'File {url} to {file_save_path_str_path} is complete. Skip download.')
-            if blake3_hash_from_civitai is not None and not no_check_hash_for_exist:
-                if check_blake3_hash_and_print(file_save_path_str_path, blake3_hash_from_civitai):
+            if expected_hash is not None and not no_check_hash_for_exist:
+                if check_hash_and_print(file_save_path_str_path, expected_hash, hash_cache=hash_cache):
                     print(Fore.GREEN + 'check exists file hash checked ok.')
                     print(Style.RESET_ALL)
-                    return
+                    return verified()
                 else:
                     print(Fore.GREEN + 'check exists file hash checked fail. bad!')
                     print(Style.RESET_ALL)
                     # TODO remove file??? or create invalid file mark (falename + .invalid)?
-                    return
+                    return False
     else:
-        print(f'File {url} to {file_save_path_str_path} does not exist. Start download.')
-        simple_download(url, str(file_save_path))
-        if blake3_hash_from_civitai is not None:
-            if check_blake3_hash_and_print(file_save_path_str_path, blake3_hash_from_civitai):
+        if has_resumable_journal(file_save_path_str_path):
+            print(f'File {url} to {file_save_path_str_path} is partially downloaded. Resume download.')
+        elif content_store is not None and expected_hash is not None:
+            link_method = content_store.place(expected_hash.algorithm, expected_hash.value, file_save_path_str_path,
+                                              hash_cache=hash_cache)
+            if link_method is not None:
+                print(Fore.GREEN + f'File {file_save_path_str_path} placed from content store ({link_method}).'
+                                   f' Skip download.')
+                print(Style.RESET_ALL)
+                if hash_cache is not None:
+                    hash_cache.put(file_save_path_str_path, expected_hash.algorithm, expected_hash.value)
+                return True
+            print(f'File {url} to {file_save_path_str_path} does not exist. Start download.')
+        else:
+            print(f'File {url} to {file_save_path_str_path} does not exist. Start download.')
+        hash_check_result = download_and_check_hash(url, str(file_save_path), download_segments, expected_hash,
+                                                        hash_cache=hash_cache)
+        if hash_check_result is not None:
+            if hash_check_result:
                 print(f"check downloaded file hash checked ok.")
-                return
+                return verified()
             else:
                 print(f"check downloaded file hash checked fail. bad!")
-                return
+                return False
                 # TODO remove file??? or create invalid file mark (falename + .invalid)?
+    return True
+
+
+def download_large_file(url: str, fname: str, download_segments: int,
+                        hasher: Optional[StreamHasher] = None) -> None:
+    # segmented download with resume when server supports ranges, single stream otherwise.
+    # journal of interrupted download is resumed also with download_segments 0, segments are kept in it
+    if (download_segments > 0 or has_resumable_journal(fname)) \
+            and segmented_download(url, fname, segment_count=max(1, download_segments), hasher=hasher):
+        return
+    simple_download(url, fname, hasher=hasher)
+
+
+def simple_download(url: str, fname: str, chunk_size: int = SEGMENT_CHUNK_SIZE, use_cloudscraper: bool = False,
+                    hasher: Optional[StreamHasher] = None):
+    async_engine = get_async_engine()
+    if async_engine is not None:
+        async_engine.run(async_engine.download(url, fname, use_cloudscraper=use_cloudscraper, hasher=hasher))
+        return
+    http_client = get_http_client()
+    with get_metrics().operation(OP_DOWNLOAD, url=url, path=fname) as op, \
+            http_client.stream(url, use_cloudscraper=use_cloudscraper) as resp:
+        # error page must not be saved as model file or image
+        resp.raise_for_status()
+        total = int(resp.headers.get('content-length', 0))
+        # civitai download url redirects to cdn, its host is capped
+        throttle = http_client.bandwidth.for_url(resp.url)
+
+        with open(fname, 'wb') as file, file_progress_bar(fname, total) as bar:
+            for data in resp.iter_content(chunk_size=chunk_size):
+                size = file.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+                bar.update(size)
+                op.bytes += size
+                throttle.throttle(size)
 
 
-def simple_download(url: str, fname: str, chunk_size=4096, use_cloudscraper: bool = False):
-    if use_cloudscraper:
-        resp = scraper.get(url, stream=True)
-    else:
-        resp = get(url, stream=True)
-    total = int(resp.headers.get('content-length', 0))
-
-    with open(fname, 'wb') as file, tqdm(
-            desc=Path(fname).name,
-            total=total,
-            unit='iB',
-            unit_scale=True,
-            unit_divisor=1024,
-    ) as bar:
-        for data in resp.iter_content(chunk_size=chunk_size):
-            size = file.write(data)
-            bar.update(size)
-
-
-CIVITAI_MODEL_REGEX_PATTERN = re.compile(r"^((http|https)://)civitai[.]com/models/(?P<model_id>\d+)")
-
 class CivitaiDownloadModelError(Exception):
     pass
 
 
-# types of civitai resources
-# 'Checkpoint' -> 'models\Stable-diffusion'
-# LORA -> 'models\LoRA'
-# Poses -> models\Poses
-# -> extensions\sd-webui-additional-networks\models\lora\Locon
-def get_web_ui_folder_by_type(base_path: str, type_str: str) -> str:
-    if type_str == "Checkpoint":
-        return path.join(base_path, "models", "Stable-diffusion")
-    elif type_str == "LORA":
-        return path.join(base_path, "models", "LoRA")
-    elif type_str == "Poses":
-        return path.join(base_path, "models", "Poses")
-    elif type_str == "LoCon":
-        return path.join(base_path, "extensions", "sd-webui-additional-networks", "models", "lora", "Locon")
-    elif type_str == "TextualInversion":
-        return path.join(base_path, "embeddings")
-    elif type_str == "Hypernetwork":
-        return path.join(base_path, "models", "hypernetworks")
-    elif type_str == "Other":
-        return path.join(base_path, "models", "Other")
-    elif type_str == "Wildcards":
-        return path.join(base_path, "Wildcards")
-    else:
-        raise Exception("Not supported type yet?")
-
-
-def find_exist_image_name_by_hash(all_names_and_hashes_dict: Dict[str, str], hash: str) -> Optional[str]:
-    for search_file_name, search_file_hash in all_names_and_hashes_dict.items():
-        if search_file_hash == hash:
-            print(f"Skip download exists image what located at name {search_file_name}")
-            return search_file_name
-    return None
-
-
 @click.group()
 def cli():
     pass
 
 
-CIVITAI_USER_REGEX_PATTERN = re.compile(r"^((http|https)://)civitai[.]com/user/(?P<user_name>\w+)$")
-
-REGEX_CIVITAI_IMAGE_FROM_CACHE_PATTERN = re.compile(r"^((https)://)imagecache[.]civitai[.]com/(?P<unc1>\w+)/(?P<uuid_image1>\w+-\w+-\w+-\w+-\w+)/width=(?P<image_width>\d+)/(?P<uuid_image2>\w+-\w+-\w+-\w+-\w+)$")
-
 @cli.command()
 @click.option('--sd-webui-root-dir', type=str, required=True)
 @click.option('--no-download', is_flag=True)
@@ -263,6 +263,14 @@ REGEX_CIVITAI_IMAGE_FROM_CACHE_PATTERN = re.compile(r"^((https)://)imagecache[.]
 @click.option('--model-type-filter', type=click.Choice(['NONE', 'LORA', 'Model'], case_sensitive=False), default="NONE")
 @click.option('--download-pics-from-desc/--no-download-pics-from_desc', default=True)
 @click.option('--write-json-and-desc_when_not_exists_only/--no-write-json-and-desc-when-not-exists-only', default=False)
+@click.option('--base-model', 'base_models', type=str, multiple=True,
+              help='Only models with a version of this base model, like "SD 1.5". May be repeated')
+@click.option('--nsfw/--no-nsfw', default=None, help='Only nsfw or only not nsfw models, by default both')
+@click.option('--updated-since', type=click.DateTime(), default=None,
+              help='Only models with a version created or updated since this date')
+@click.option('--page-limit', type=click.IntRange(min=1, max=MAX_LISTING_PAGE_LIMIT), default=DEFAULT_LISTING_PAGE_LIMIT,
+              help='Models per page of user listing')
+@download_context_options
 @click.argument('url', type=str, required=True)
 def download_models_for_user_command(sd_webui_root_dir: str,
                                      no_download: bool,
@@ -273,17 +281,29 @@ def download_models_for_user_command(sd_webui_root_dir: str,
                                      no_check_hash_for_exist: bool,
                                      download_pics_from_desc: bool,
                                      ignore_ckpt: bool,
-                                     write_json_and_desc_when_not_exists_only: bool):
-    download_models_for_user(sd_webui_root_dir=sd_webui_root_dir,
-                             no_download=no_download,
-                             disable_sec_checks=disable_sec_checks,
-                             remove_incompleted_files=remove_incompleted_files,
-                             model_type_filter=model_type_filter,
-                             no_check_hash_for_exist=no_check_hash_for_exist,
-                             url=url,
-                             download_pics_from_desc=download_pics_from_desc,
-                             write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only,
-                             ignore_ckpt=ignore_ckpt)
+                                     write_json_and_desc_when_not_exists_only: bool,
+                                     base_models: Tuple[str, ...],
+                                     nsfw: Optional[bool],
+                                     updated_since: Optional[datetime],
+                                     page_limit: int,
+                                     **context_options):
+    listing_filters = ListingFilters(model_type=model_type_filter, base_models=list(base_models), nsfw=nsfw,
+                                     updated_since=updated_since, limit=page_limit)
+    with DownloadContext.from_options(sd_webui_root_dir, **context_options) as context:
+        download_models_for_user(sd_webui_root_dir=sd_webui_root_dir,
+                                 no_download=no_download,
+                                 disable_sec_checks=disable_sec_checks,
+                                 remove_incompleted_files=remove_incompleted_files,
+                                 model_type_filter=model_type_filter,
+                                 no_check_hash_for_exist=no_check_hash_for_exist,
+                                 url=url,
+                                 download_pics_from_desc=download_pics_from_desc,
+                                 write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only,
+                                 ignore_ckpt=ignore_ckpt,
+                                 context=context,
+                                 listing_filters=listing_filters)
+
+
 def download_models_for_user(sd_webui_root_dir,
                              no_download: bool,
                              disable_sec_checks: bool,
@@ -293,7 +313,25 @@ def download_models_for_user(sd_webui_root_dir,
                              url: str,
                              download_pics_from_desc: bool,
                              write_json_and_desc_when_not_exists_only: bool,
-                             ignore_ckpt: bool):
+                             ignore_ckpt: bool,
+                             context: Optional[DownloadContext] = None,
+                             listing_filters: Optional[ListingFilters] = None):
+    if context is None:
+        with DownloadContext() as own_context:
+            download_models_for_user(sd_webui_root_dir=sd_webui_root_dir,
+                                     no_download=no_download,
+                                     disable_sec_checks=disable_sec_checks,
+                                     remove_incompleted_files=remove_incompleted_files,
+                                     model_type_filter=model_type_filter,
+                                     no_check_hash_for_exist=no_check_hash_for_exist,
+                                     url=url,
+                                     download_pics_from_desc=download_pics_from_desc,
+                                     write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only,
+                                     ignore_ckpt=ignore_ckpt,
+                                     context=own_context,
+                                     listing_filters=listing_filters)
+        return
+
     civitai_url_match: Optional[Match] = re.fullmatch(CIVITAI_USER_REGEX_PATTERN, url)
     click.echo(f"url = {url}")
     skip_download_file_ext_list = []
@@ -307,9 +345,10 @@ def download_models_for_user(sd_webui_root_dir,
     user_name_str = civitai_url_match.group("user_name")
     print(f"user_name_str = {user_name_str}")
 
-    next_page: Optional[str] = f"https://civitai.com/api/v1/models?username={user_name_str}"
-    while next_page is not None:
-        r = get(next_page)
+    if listing_filters is None:
+        listing_filters = ListingFilters(model_type=model_type_filter)
+    # pages are prefetched while models of the current page are scheduled
+    for r in iter_listing_pages(context.api_client, user_models_api_url(user_name_str, listing_filters)):
         if r.status_code != 200:
             message_error = "Get model info by civitai error!"
             raise CivitaiDownloadModelError(message_error)
@@ -317,11 +356,17 @@ def download_models_for_user(sd_webui_root_dir,
         for item in data["items"]:
             url_for_download = f"https://civitai.com/models/{item['id']}"
             click.echo(f"begin {url_for_download}")
-            if model_type_filter.upper() != "NONE":
-                click.echo(f"model_type_filter = {model_type_filter}")
-                if item["type"] != model_type_filter:
-                    click.echo(f"skip model. filter enabled to download {model_type_filter} only")
-                    continue
+            skip_reason = listing_filters.skip_reason(item)
+            if skip_reason is not None:
+                click.echo(f"skip model. {skip_reason}")
+                continue
+            listing_sync_key = f"listing:{item['id']}"
+            if context.skip_unchanged_models and context.api_client.is_synced(listing_sync_key, item):
+                click.echo("skip model. metadata not changed since last complete sync")
+                continue
+            if context.sync_state is not None and context.sync_state.is_model_complete(item):
+                click.echo("skip model. all versions are synced yet (incremental)")
+                continue
             try:
                 download_model(sd_webui_root_dir=sd_webui_root_dir,
                                no_download=no_download,
@@ -331,15 +376,16 @@ def download_models_for_user(sd_webui_root_dir,
                                url=url_for_download,
                                download_pics_from_desc=download_pics_from_desc,
                                write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only,
-                               skip_download_file_ext_list=skip_download_file_ext_list)
+                               skip_download_file_ext_list=skip_download_file_ext_list,
+                               context=context,
+                               on_model_synced=functools.partial(context.api_client.mark_synced,
+                                                                 listing_sync_key, item))
             except CivitaiDownloadModelError as e:
                 click.echo(e)
 
         if "nextPage" in data["metadata"]:
-            next_page = data["metadata"]["nextPage"]
-            click.echo(f"next page = {next_page}")
-        else:
-            next_page = None
+            click.echo(f"next page = {data['metadata']['nextPage']}")
+    context.retry_busy_models()
 
 
 @cli.command()
@@ -351,6 +397,7 @@ def download_models_for_user(sd_webui_root_dir,
 @click.option('--ignore-ckpt', is_flag=True, default=False)
 @click.option('--download-pics-from-desc/--no-download-pics-from_desc', default=True)
 @click.option('--write-json-and-desc_when_not_exists_only/--no-write-json-and-desc-when-not-exists-only', default=False)
+@download_context_options
 @click.argument('url', type=str, required=True)
 def download_model_command(sd_webui_root_dir,
                            no_download: bool,
@@ -360,44 +407,438 @@ def download_model_command(sd_webui_root_dir,
                            url: str,
                            ignore_ckpt: bool,
                            download_pics_from_desc: bool,
-                           write_json_and_desc_when_not_exists_only: bool):
+                           write_json_and_desc_when_not_exists_only: bool,
+                           **context_options):
     skip_download_file_ext_list = []
     if ignore_ckpt:
         skip_download_file_ext_list.append("ckpt")
 
-    download_model(sd_webui_root_dir=sd_webui_root_dir,
-                   no_download=no_download,
-                   disable_sec_checks=disable_sec_checks,
-                   no_check_hash_for_exist=no_check_hash_for_exist,
-                   remove_incompleted_files=remove_incompleted_files,
-                   url=url,
-                   download_pics_from_desc=download_pics_from_desc,
-                   write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only,
-                   skip_download_file_ext_list=skip_download_file_ext_list)
+    with DownloadContext.from_options(sd_webui_root_dir, **context_options) as context:
+        download_model(sd_webui_root_dir=sd_webui_root_dir,
+                       no_download=no_download,
+                       disable_sec_checks=disable_sec_checks,
+                       no_check_hash_for_exist=no_check_hash_for_exist,
+                       remove_incompleted_files=remove_incompleted_files,
+                       url=url,
+                       download_pics_from_desc=download_pics_from_desc,
+                       write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only,
+                       skip_download_file_ext_list=skip_download_file_ext_list,
+                       context=context)
+
+
+@cli.command()
+@click.option('--sd-webui-root-dir', type=str, required=True)
+@click.option('--no-download', is_flag=True)
+@click.option('--disable-sec-checks', is_flag=True)
+@click.option('--no-check-hash-for-exist', is_flag=True)
+@click.option('--remove-incompleted-files', is_flag=True)
+@click.option('--ignore-ckpt', is_flag=True, default=False)
+@click.option('--model-type-filter', type=click.Choice(['NONE', 'LORA', 'Model'], case_sensitive=False), default="NONE")
+@click.option('--download-pics-from-desc/--no-download-pics-from_desc', default=True)
+@click.option('--write-json-and-desc_when_not_exists_only/--no-write-json-and-desc-when-not-exists-only', default=False)
+@click.option('--manifest-format', type=click.Choice(MANIFEST_FORMATS), default=None,
+              help='Format of manifest, by default detected by extension (.json, .csv, otherwise text)')
+@click.option('--report', type=click.Path(dir_okay=False), default=None,
+              help='Write json report with result of every manifest entry')
+@download_context_options
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False), required=True)
+def download_manifest_command(sd_webui_root_dir,
+                              no_download: bool,
+                              disable_sec_checks: bool,
+                              no_check_hash_for_exist: bool,
+                              remove_incompleted_files: bool,
+                              ignore_ckpt: bool,
+                              model_type_filter: str,
+                              download_pics_from_desc: bool,
+                              write_json_and_desc_when_not_exists_only: bool,
+                              manifest_format: Optional[str],
+                              report: Optional[str],
+                              manifest: str,
+                              **context_options):
+    # all urls of manifest share one run: connections, caches and download queue
+    skip_download_file_ext_list = []
+    if ignore_ckpt:
+        skip_download_file_ext_list.append("ckpt")
+    entries = load_manifest(manifest, manifest_format)
+    click.echo(f"manifest entries = {len(entries)}")
+
+    with DownloadContext.from_options(sd_webui_root_dir, **context_options) as context:
+        manifest_models = resolve_manifest(entries, context.api_client, model_type_filter)
+        click.echo(f"models after dedupe = {len(manifest_models)}")
+        # models are scheduled by priority, so their files and images are queued in that order
+        for manifest_model in manifest_models:
+            click.echo(f"begin {manifest_model.url} priority = {manifest_model.priority}")
+            try:
+                manifest_model.jobs = download_model(
+                    sd_webui_root_dir=sd_webui_root_dir,
+                    no_download=no_download,
+                    disable_sec_checks=disable_sec_checks,
+                    remove_incompleted_files=remove_incompleted_files,
+                    no_check_hash_for_exist=no_check_hash_for_exist,
+                    url=manifest_model.url,
+                    download_pics_from_desc=download_pics_from_desc,
+                    write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only,
+                    skip_download_file_ext_list=skip_download_file_ext_list,
+                    context=context,
+                    model_version_ids=manifest_model.version_ids)
+            except CivitaiDownloadModelError as e:
+                manifest_model.error = str(e)
+                click.echo(Fore.RED + f"model {manifest_model.model_id} error: {e}" + Style.RESET_ALL)
+        retried_jobs = context.retry_busy_models()
+        for manifest_model in manifest_models:
+            manifest_model.jobs = retried_jobs.get(f"model:{manifest_model.model_id}", manifest_model.jobs)
+        context.scheduler.wait()
+
+    models_by_id = {manifest_model.model_id: manifest_model for manifest_model in manifest_models}
+    results = [entry_result(entry, models_by_id) for entry in entries]
+    for result in results:
+        color = Fore.GREEN if result["result"] == RESULT_OK else Fore.RED
+        details = result.get("error") or "; ".join(result["errors"]) or f"models = {result['models']}, jobs = {result['jobs']}, " \
+                                         f"failed jobs = {result['jobs_failed']}"
+        click.echo(color + f"{result['result']:7} {result['source']} {result['url']} ({details})" + Style.RESET_ALL)
+    if report is not None:
+        with open(report, 'w') as f:
+            dump({"entries": results}, f, indent=2)
+    if any(result["result"] != RESULT_OK for result in results):
+        exit(1)
 
 
-def download_pics(model_data_json: Any, path_for_pics_folder) -> str:
+@cli.command()
+@click.option('--sd-webui-root-dir', type=str, required=True)
+@click.option('--disable-sec-checks', is_flag=True)
+@click.option('--ignore-ckpt', is_flag=True, default=False)
+@click.option('--model-type-filter', type=click.Choice(['NONE', 'LORA', 'Model'], case_sensitive=False), default="NONE")
+@click.option('--download-pics-from-desc/--no-download-pics-from_desc', default=True)
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Plan urls of manifest, in addition to urls of arguments')
+@click.option('--manifest-format', type=click.Choice(MANIFEST_FORMATS), default=None)
+@click.option('--skip-unchanged-models', is_flag=True, default=False,
+              help='Leave out models with metadata not changed since last complete sync')
+@click.option('--incremental', is_flag=True, default=False,
+              help='Leave out versions synced yet, like --incremental of download commands')
+@click.option('--content-store', is_flag=True, default=False,
+              help='Files and images in content store are placed, not downloaded')
+@click.option('--bandwidth', type=click.FloatRange(min=0, min_open=True), default=None,
+              help='MB/s for eta. By default measured by previous downloads into sd-webui root')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Write plan as json. It is a manifest for download-manifest-command too')
+@click.option('--split', type=click.IntRange(min=1), default=1,
+              help='Also write plan in parts of about the same bytes, OUTPUT.partN.json, for several machines')
+@click.argument('urls', type=str, nargs=-1)
+def plan_command(sd_webui_root_dir: str,
+                 disable_sec_checks: bool,
+                 ignore_ckpt: bool,
+                 model_type_filter: str,
+                 download_pics_from_desc: bool,
+                 manifest: Optional[str],
+                 manifest_format: Optional[str],
+                 skip_unchanged_models: bool,
+                 incremental: bool,
+                 content_store: bool,
+                 bandwidth: Optional[float],
+                 output: Optional[str],
+                 split: int,
+                 urls: Tuple[str, ...]):
+    # dry run: only civitai api is requested, nothing is written into the library
+    if split > 1 and output is None:
+        raise click.UsageError("--split needs --output")
+    skip_download_file_ext_list = ["ckpt"] if ignore_ckpt else []
+    entries = [ManifestEntry(url, 0, f"argv[{index}]") for index, url in enumerate(urls)]
+    if manifest is not None:
+        entries += load_manifest(manifest, manifest_format)
+    if not entries:
+        raise click.UsageError("no urls to plan, pass URLS or --manifest")
+    for entry in entries:
+        if entry.error is not None:
+            click.echo(Fore.RED + f"{entry.source} {entry.url}: {entry.error}" + Style.RESET_ALL, err=True)
+
+    api_client = CivitaiApiClient.for_sd_webui_root(sd_webui_root_dir)
+    sync_state = SyncState(sd_webui_root_dir) if incremental else None
+    plan_content_store = ContentStore(sd_webui_root_dir) if content_store else None
+    model_plans = []
+    for manifest_model in resolve_manifest(entries, api_client, model_type_filter):
+        r = api_client.get_json(model_api_url(str(manifest_model.model_id)))
+        if r.status_code != 200:
+            click.echo(Fore.RED + f"model {manifest_model.model_id} error: get model info by civitai "
+                       f"status {r.status_code}" + Style.RESET_ALL, err=True)
+            continue
+        model_data_json = r.json()
+        if skip_unchanged_models and api_client.is_synced(f"model:{manifest_model.model_id}", model_data_json):
+            click.echo(f"model {manifest_model.model_id} metadata not changed since last complete sync. Skip",
+                       err=True)
+            continue
+        model_plans.append(plan_model(sd_webui_root_dir, model_data_json,
+                                      priority=manifest_model.priority,
+                                      model_version_ids=manifest_model.version_ids,
+                                      disable_sec_checks=disable_sec_checks,
+                                      skip_download_file_ext_list=skip_download_file_ext_list,
+                                      download_pics_from_desc=download_pics_from_desc,
+                                      content_store=plan_content_store,
+                                      sync_state=sync_state))
+    if sync_state is not None:
+        sync_state.close()
+
+    bandwidth_bytes_per_s = bandwidth * 1024 * 1024 if bandwidth is not None \
+        else load_measured_bandwidth(sd_webui_root_dir)
+    plan = build_plan(sd_webui_root_dir, model_plans, bandwidth_bytes_per_s)
+    click.echo(format_plan_summary(plan), err=True)
+    if output is None:
+        click.echo(json.dumps(plan, indent=2))
+        return
+    with open(output, 'w') as f:
+        dump(plan, f, indent=2)
+    click.echo(f"plan saved to {output}", err=True)
+    if split > 1:
+        output_base = output[:-len(".json")] if output.endswith(".json") else output
+        for index, part_plan in enumerate(split_plan(plan, split), start=1):
+            part_output = f"{output_base}.part{index}.json"
+            with open(part_output, 'w') as f:
+                dump(part_plan, f, indent=2)
+            click.echo(f"part {index}: {len(part_plan['entries'])} entries, "
+                       f"{part_plan['totals']['transfer_bytes'] / 1024 / 1024:.1f} MB -> {part_output}", err=True)
+
+
+@cli.command()
+@click.option('--sd-webui-root-dir', type=str, required=True)
+@click.argument('action', type=click.Choice(['stats', 'prune', 'rebuild', 'clear'], case_sensitive=False))
+def hash_cache_command(sd_webui_root_dir: str, action: str):
+    hash_cache = HashCache(sd_webui_root_dir)
+    click.echo(f"hash cache = {hash_cache.db_path}")
+    action = action.lower()
+    if action == "prune":
+        click.echo(f"removed {hash_cache.prune()} stale entries")
+    elif action == "rebuild":
+        click.echo(f"rehashed {hash_cache.rebuild()} files")
+    elif action == "clear":
+        hash_cache.clear()
+        click.echo("hash cache cleared")
+    click.echo(f"entries = {hash_cache.count()}")
+    hash_cache.close()
+
+
+@cli.command()
+@click.option('--sd-webui-root-dir', type=str, required=True)
+@click.argument('action', type=click.Choice(['stats', 'prune'], case_sensitive=False))
+def content_store_command(sd_webui_root_dir: str, action: str):
+    content_store = ContentStore(sd_webui_root_dir)
+    click.echo(f"content store = {content_store.store_dir}")
+    if action.lower() == "prune":
+        click.echo(f"removed {content_store.prune()} blobs without files in library")
+    for name, value in content_store.stats().items():
+        if name.endswith("_bytes"):
+            click.echo(f"{name[:-len('_bytes')]} = {value / 1024 / 1024:.1f} MB")
+        else:
+            click.echo(f"{name} = {value}")
+
+
+@cli.command()
+@click.option('--sd-webui-root-dir', type=str, required=True)
+@click.option('--keep-store', is_flag=True, default=False,
+              help='export: keep samples.jsonl, legacy files are a snapshot for other tools')
+@click.argument('action', type=click.Choice(['stats', 'migrate', 'export'], case_sensitive=False))
+def samples_store_command(sd_webui_root_dir: str, keep_store: bool, action: str):
+    # samples metadata of all versions: N.json and N.meta files <-> one samples.jsonl per folder
+    action = action.lower()
+    folders = 0
+    samples = 0
+    compact_folders = 0
+    for samples_folder in iter_samples_folders(sd_webui_root_dir):
+        folders += 1
+        if action == "migrate":
+            samples += migrate_samples_folder(samples_folder)
+        elif action == "export":
+            samples += export_samples_folder(samples_folder, keep_store=keep_store)
+        else:
+            sample_index = open_samples(samples_folder, save=False)
+            samples += len(sample_index.hash_to_name)
+        if path.isfile(path.join(samples_folder, SAMPLES_STORE_FILE_NAME)):
+            compact_folders += 1
+    if action == "migrate":
+        click.echo(f"migrated {samples} samples of {folders} folders into {SAMPLES_STORE_FILE_NAME}")
+    elif action == "export":
+        click.echo(f"exported {samples} samples into N.json and N.meta files")
+    click.echo(f"samples folders = {folders}, with {SAMPLES_STORE_FILE_NAME} = {compact_folders}, samples = {samples}")
+
+
+@cli.command()
+@click.option('--sd-webui-root-dir', type=str, required=True)
+@click.option('--max-image-downloads', type=click.IntRange(min=1), default=DEFAULT_MAX_IMAGE_DOWNLOADS)
+def upgrade_previews_command(sd_webui_root_dir: str, max_image_downloads: int):
+    # sample images and description pictures downloaded with --preview-width/--preview-format, at full size now
+    scheduler = DownloadScheduler(max_image_downloads=max_image_downloads)
+    opened_samples = []
+    pics_jobs = []
+    for samples_folder in iter_samples_folders(sd_webui_root_dir):
+        samples = open_samples(samples_folder)
+        opened_samples.append(samples)
+        for sample_name, sample_json in samples.iter_samples():
+            if VARIANT_KEY in sample_json:
+                path_for_image = path.join(samples_folder, sample_name + ".jpg")
+                scheduler.submit_image(path_for_image, upgrade_sample_image, path_for_image, samples, sample_name,
+                                       sample_json)
+    for model_folder in iter_model_folders(sd_webui_root_dir):
+        path_for_previews = path.join(model_folder, PICS_FOLDER_NAME, PREVIEWS_FILE_NAME)
+        path_for_model_original_json = path.join(model_folder, CIVITAI_MODEL_ORIGINAL_NAME_JSON)
+        if not path.isfile(path_for_previews) or not path.isfile(path_for_model_original_json):
+            continue
+        with open(path_for_model_original_json, 'r') as f:
+            description_html = json.load(f).get('description') or ""
+        previews = load_previews(path_for_previews)
+        for pic in rewrite_description_pics(description_html)[1]:
+            if pic.file_name in previews:
+                path_for_pic = path.join(model_folder, PICS_FOLDER_NAME, pic.file_name)
+                pics_jobs.append((path_for_previews, pic.file_name,
+                                  scheduler.submit_image(path_for_pic, upgrade_image, pic.url, path_for_pic,
+                                                         use_cloudscraper=True)))
+    scheduler.wait()
+    scheduler.shutdown()
+    for samples in opened_samples:
+        samples.save()
+    # pictures what failed stay in .previews.json for the next upgrade
+    upgraded_pics: Dict[str, List[str]] = {}
+    for path_for_previews, pic_name, pic_job in pics_jobs:
+        if pic_job.exception() is None:
+            upgraded_pics.setdefault(path_for_previews, []).append(pic_name)
+    for path_for_previews, pic_names in upgraded_pics.items():
+        previews = {pic_name: variant for pic_name, variant in load_previews(path_for_previews).items()
+                    if pic_name not in pic_names}
+        if previews:
+            write_json_atomic(path_for_previews, previews)
+        else:
+            os.remove(path_for_previews)
+    scheduler.print_summary()
+    if scheduler.failures:
+        exit(1)
+
+
+def upgrade_image(url: str, path_for_image: str, use_cloudscraper: bool = False) -> None:
+    # preview is replaced only by completely downloaded image
+    tmp_path_for_image = unique_tmp_path(path_for_image)
+    try:
+        simple_download(url, tmp_path_for_image, use_cloudscraper=use_cloudscraper)
+    except BaseException:
+        if Path(tmp_path_for_image).is_file():
+            os.remove(tmp_path_for_image)
+        raise
+    os.replace(tmp_path_for_image, path_for_image)
+
+
+def upgrade_sample_image(path_for_image: str, samples: Samples, sample_name: str, sample_json: Dict[str, Any]) -> None:
+    upgrade_image(sample_json['url'], path_for_image)
+    samples.record(sample_name, {key: value for key, value in sample_json.items() if key != VARIANT_KEY})
+
+
+@cli.command()
+@click.option('--sd-webui-root-dir', type=str, required=True)
+@click.option('--io-concurrency', type=click.IntRange(min=1), default=2,
+              help='Files hashed at the same time')
+@click.option('--executor', type=click.Choice([EXECUTOR_THREAD, EXECUTOR_PROCESS]), default=EXECUTOR_THREAD)
+@click.option('--use-hash-cache', is_flag=True, default=False,
+              help='Trust hash cache for unchanged files instead of full rehash')
+@click.option('--report', type=click.Path(dir_okay=False), default=None,
+              help='Write json report to file instead of stdout')
+@click.option('--disable-sec-checks', is_flag=True,
+              help='Files with failed scans were downloaded, same option as of download commands')
+@click.option('--ignore-ckpt', is_flag=True, default=False,
+              help='ckpt files were not downloaded, same option as of download commands')
+def verify_library_command(sd_webui_root_dir: str, io_concurrency: int, executor: str,
+                           use_hash_cache: bool, report: Optional[str], disable_sec_checks: bool, ignore_ckpt: bool):
+    # offline integrity check of all downloaded models, civitai api is not used
+    hash_cache = HashCache(sd_webui_root_dir) if use_hash_cache else None
+    skip_download_file_ext_list = ["ckpt"] if ignore_ckpt else []
+
+    def on_result(library_file):
+        color = Fore.GREEN if library_file.status == STATUS_OK \
+            else Fore.YELLOW if library_file.status == STATUS_NOT_SELECTED else Fore.RED
+        click.echo(color + f"{library_file.status}: {library_file.file_path}"
+                   + (f" ({library_file.skip_reason})" if library_file.status == STATUS_NOT_SELECTED else "")
+                   + Style.RESET_ALL, err=True)
+
+    library_files = verify_library(sd_webui_root_dir, io_concurrency=io_concurrency, executor=executor,
+                                   hash_cache=hash_cache, on_result=on_result, disable_sec_checks=disable_sec_checks,
+                                   skip_download_file_ext_list=skip_download_file_ext_list)
+    report_json = build_report(sd_webui_root_dir, library_files)
+    if report is not None:
+        with open(report, 'w') as f:
+            dump(report_json, f, indent=2)
+        click.echo(f"report saved to {report}", err=True)
+    else:
+        click.echo(json.dumps(report_json, indent=2))
+    click.echo(f"summary = {report_json['summary']}", err=True)
+    if hash_cache is not None:
+        hash_cache.close()
+    if report_json['summary'][STATUS_MISMATCHED] or report_json['summary'][STATUS_MISSING]:
+        exit(1)
+
+
+def download_pics(model_data_json: Any, path_for_pics_folder, scheduler: DownloadScheduler,
+                  image_variant: Optional[ImageVariant] = None,
+                  preview_savings: Optional[PreviewSavings] = None) -> Tuple[str, List[Future]]:
+    # pictures are image jobs of scheduler, description with rewritten src is returned at once
     description_html = model_data_json['description']
     if description_html is None:
-        return ""
-    soup = BeautifulSoup(description_html, 'html.parser')
-    for img_tag in soup.find_all('img'):
-        img_url = img_tag['src']
-        civitai_image_match: Optional[Match] = re.fullmatch(REGEX_CIVITAI_IMAGE_FROM_CACHE_PATTERN, img_url)
-        if civitai_image_match is None:
-            click.echo("Invalid cache url. go to next img")
+        return "", []
+    description_html, pics = rewrite_description_pics(description_html)
+    exists_pic_names = set(os.listdir(path_for_pics_folder))
+    pic_jobs = []
+    preview_pic_names = []
+    for pic in pics:
+        if pic.file_name in exists_pic_names:
+            click.echo(f"File {pic.file_name} exists yet")
             continue
-
-        uuid_image_name = civitai_image_match.group("uuid_image2")
-        image_width = civitai_image_match.group("image_width")
-        path_for_pic_in_pics_folder = path.join(path_for_pics_folder, uuid_image_name)
-        img_url_with_width_zero = img_url.replace("width=" + image_width, 'width=0')
-        if Path(path_for_pic_in_pics_folder).is_file():
-            click.echo(f"File {uuid_image_name} exists yet")
+        path_for_pic_in_pics_folder = path.join(path_for_pics_folder, pic.file_name)
+        pic_url = image_variant.url(pic.url) if image_variant is not None else pic.url
+        if scheduler.is_async:
+            pic_job = scheduler.submit_image_coroutine(path_for_pic_in_pics_folder, download_description_pic_async,
+                                                       pic_url, path_for_pic_in_pics_folder)
         else:
-            simple_download(img_url_with_width_zero, str(path_for_pic_in_pics_folder), use_cloudscraper=True)
-        img_tag['src'] = "pics/" + uuid_image_name
-    return str(soup)
+            pic_job = scheduler.submit_image(path_for_pic_in_pics_folder, download_description_pic,
+                                             pic_url, path_for_pic_in_pics_folder)
+        if pic_url != pic.url:
+            preview_pic_names.append(pic.file_name)
+            if preview_savings is not None:
+                pic_job.add_done_callback(functools.partial(count_preview, preview_savings,
+                                                            path_for_pic_in_pics_folder, None))
+        pic_jobs.append(pic_job)
+    if preview_pic_names:
+        # upgrade-previews-command downloads them at full size
+        path_for_previews = path.join(path_for_pics_folder, PREVIEWS_FILE_NAME)
+        previews = load_previews(path_for_previews)
+        previews.update({pic_name: str(image_variant) for pic_name in preview_pic_names})
+        write_json_atomic(path_for_previews, previews)
+    return description_html, pic_jobs
+
+
+def load_previews(path_for_previews: str) -> Dict[str, str]:
+    if not path.isfile(path_for_previews):
+        return {}
+    with open(path_for_previews, 'r') as f:
+        return json.load(f)
+
+
+def count_preview(preview_savings: PreviewSavings, path_for_image: str, full_size_ratio: Optional[float],
+                  image_job: Future) -> None:
+    if image_job.exception() is None and path.isfile(path_for_image):
+        preview_savings.add(path.getsize(path_for_image), full_size_ratio)
+
+
+def download_description_pic(url: str, path_for_pic: str) -> None:
+    try:
+        simple_download(url, path_for_pic, use_cloudscraper=True)
+    except BaseException:
+        # partial picture would be taken as existing by the next run
+        if Path(path_for_pic).is_file():
+            os.remove(path_for_pic)
+        raise
+
+
+async def download_description_pic_async(url: str, path_for_pic: str) -> None:
+    try:
+        await get_async_engine().download(url, path_for_pic, use_cloudscraper=True, progress=False)
+    except BaseException:
+        if Path(path_for_pic).is_file():
+            os.remove(path_for_pic)
+        raise
 
 def file_rename_to_name_with_past_mask(file_path: str, dest_begin_file_name: str) -> Optional[str]:
     file_path_Path = Path(file_path)
@@ -417,10 +858,10 @@ def file_rename_to_name_with_past_mask(file_path: str, dest_begin_file_name: str
 def download_or_update_json_model_info_with_pics(folder_for_current_model: str,
                                                  model_data_json: Any,
                                                  download_pics_from_desc: bool,
-                                                 write_json_and_desc_when_not_exists_only: bool) -> None:
-    CIVITAI_MODEL_ORIGINAL_NAME_JSON = "civitai_model.original.json"
-    CIVITAI_MODEL_DESC_NAME_HTML = "civitai_model_desc.html"
-
+                                                 write_json_and_desc_when_not_exists_only: bool,
+                                                 scheduler: DownloadScheduler,
+                                                 image_variant: Optional[ImageVariant] = None,
+                                                 preview_savings: Optional[PreviewSavings] = None) -> List[Future]:
     path_for_pics_folder = path.join(folder_for_current_model, "pics")
     Path(path_for_pics_folder).mkdir(parents=True, exist_ok=True)
 
@@ -431,7 +872,7 @@ def download_or_update_json_model_info_with_pics(folder_for_current_model: str,
     if write_json_and_desc_when_not_exists_only:
         if Path(path_for_model_original_json).is_file():
             click.echo(f"Enabled write_json_and_desc_when_not_exists_only option. Detected exists {CIVITAI_MODEL_ORIGINAL_NAME_JSON} file. skip desc and pics rename and download")
-            return
+            return []
 
     # TODO check, we need rename current exists json and write current?
     # if no, then write_model_and_original_data = False
@@ -441,20 +882,70 @@ def download_or_update_json_model_info_with_pics(folder_for_current_model: str,
         if Path(path_for_model_original_json).is_file():
             file_rename_to_name_with_past_mask(path_for_model_original_json, "civitai_model_orig")
 
-    with open(path_for_model_original_json, 'w') as f:
-        dump(model_data_json, f)
-    if download_pics_from_desc:
-        model_data_json_with_fixed_paths = download_pics(model_data_json, path_for_pics_folder)
-        with open(path_for_model_desc_json, 'w') as f:
-            dump(model_data_json_with_fixed_paths, f)
+    write_json_atomic(path_for_model_original_json, model_data_json)
+    if not download_pics_from_desc:
+        return []
+    model_data_json_with_fixed_paths, pic_jobs = download_pics(model_data_json, path_for_pics_folder, scheduler,
+                                                               image_variant, preview_savings)
+    write_json_atomic(path_for_model_desc_json, model_data_json_with_fixed_paths)
+    return pic_jobs
+
+
+def download_model_file(**download_file_kwargs) -> None:
+    # scheduler job: hash mismatch fails the job, so model is not marked as synced
+    if not download_file(**download_file_kwargs):
+        raise CivitaiDownloadModelError(f"hash check of {download_file_kwargs['file_save_path_str_path']} failed")
 
 
 # realisticVisionV20_v20.ckpt
-def skip_file_name_ext_by_skip_list(skip_download_file_exts: List[str], file_name_with_ext: str) -> bool:
-    for skip_download_file_ext in skip_download_file_exts:
-        if file_name_with_ext.endswith(f".{skip_download_file_ext}"):
-            return True
-    return False
+def download_sample_image(url: str, path_for_save_image: str, sample_name: str,
+                          sample_index: Samples, image_hash: str,
+                          content_store: Optional[ContentStore] = None) -> None:
+    try:
+        simple_download(url, path_for_save_image)
+    except BaseException:
+        release_sample_image(path_for_save_image, sample_name, sample_index, image_hash)
+        raise
+    if content_store is not None:
+        content_store.ingest(path_for_save_image, IMAGE_NAMESPACE, image_hash)
+
+
+async def download_sample_image_async(url: str, path_for_save_image: str, sample_name: str,
+                                      sample_index: Samples, image_hash: str,
+                                      content_store: Optional[ContentStore] = None) -> None:
+    try:
+        # thousands of parallel image bars are noise, only failed images are reported
+        await get_async_engine().download(url, path_for_save_image, progress=False)
+    except BaseException:
+        release_sample_image(path_for_save_image, sample_name, sample_index, image_hash)
+        raise
+    if content_store is not None:
+        content_store.ingest(path_for_save_image, IMAGE_NAMESPACE, image_hash)
+
+
+def release_sample_image(path_for_save_image: str, sample_name: str,
+                         sample_index: Samples, image_hash: str) -> None:
+    # release reserved name, so next run download image again
+    if Path(path_for_save_image).is_file():
+        os.remove(path_for_save_image)
+    sample_index.release(sample_name, image_hash)
+    sample_index.save()
+
+
+def print_disk_plan(disk_budget: DiskSpaceBudget, folder_for_current_model: str, model_versions_items: List[Any],
+                    disable_sec_checks: bool, skip_download_file_ext_list: List[str]) -> None:
+    # preflight: pending bytes of all files of the model against free space of their file system
+    files = []
+    for model_version_json_data in model_versions_items:
+        model_version_folder = get_model_version_folder(folder_for_current_model, model_version_json_data)
+        for current_file in model_version_json_data["files"]:
+            if file_skip_reason(current_file, disable_sec_checks, skip_download_file_ext_list) is None:
+                files.append((path.join(model_version_folder, current_file['name']),
+                              int(current_file['sizeKB'] * 1024)))
+    for row in disk_budget.plan(files):
+        color = Fore.GREEN if row.fits else Fore.RED
+        print(color + f"disk plan: {row}" + ("" if row.fits else ", files what do not fit are skipped"))
+        print(Style.RESET_ALL)
 
 
 def download_model(sd_webui_root_dir,
@@ -465,7 +956,26 @@ def download_model(sd_webui_root_dir,
                            url: str,
                            download_pics_from_desc: bool,
                            write_json_and_desc_when_not_exists_only: bool,
-                           skip_download_file_ext_list: List[str]):
+                           skip_download_file_ext_list: List[str],
+                           context: Optional[DownloadContext] = None,
+                           on_model_synced: Optional[Callable[[], Any]] = None,
+                           model_version_ids: Optional[Set[int]] = None) -> List[Future]:
+    # returns scheduled jobs of the model, a caller may wait them for per model result
+    if context is None:
+        with DownloadContext() as own_context:
+            return download_model(sd_webui_root_dir=sd_webui_root_dir,
+                           no_download=no_download,
+                           disable_sec_checks=disable_sec_checks,
+                           remove_incompleted_files=remove_incompleted_files,
+                           no_check_hash_for_exist=no_check_hash_for_exist,
+                           url=url,
+                           download_pics_from_desc=download_pics_from_desc,
+                           write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only,
+                           skip_download_file_ext_list=skip_download_file_ext_list,
+                           context=own_context,
+                           on_model_synced=on_model_synced,
+                           model_version_ids=model_version_ids)
+
     click.echo("Options:")
     click.echo(f"--sd-webui-root-dir = {sd_webui_root_dir}")
     click.echo(f"--no-download = {no_download}")
@@ -486,13 +996,60 @@ def download_model(sd_webui_root_dir,
     model_id_str = civitai_url_match.group("model_id")
     print(f"model_id_str = {model_id_str}")
 
-    r = get(f"https://civitai.com/api/v1/models/{model_id_str}")
+    model_url = model_api_url(model_id_str)
+    r = context.api_client.get_json(model_url)
     if r.status_code != 200:
         message_error = "Get model info by civitai error!"
         print(message_error)
         raise CivitaiDownloadModelError(message_error)
 
     model_data_json = r.json()
+    model_sync_key = f"model:{model_id_str}"
+    if context.skip_unchanged_models and context.api_client.is_synced(model_sync_key, model_data_json):
+        click.echo(f"Model {model_id_str} metadata not changed since last complete sync. Skip")
+        return []
+    model_jobs: List[Future] = []
+
+    def mark_model_synced():
+        context.api_client.mark_synced(model_sync_key, model_data_json)
+        if on_model_synced is not None:
+            on_model_synced()
+
+    model_versions_items = model_data_json["modelVersions"]
+    if model_version_ids is not None:
+        model_versions_items = [v for v in model_versions_items if v["id"] in model_version_ids]
+        if not model_versions_items:
+            raise CivitaiDownloadModelError(f"Model {model_id_str} has no versions {sorted(model_version_ids)}")
+    if context.sync_state is not None:
+        # incremental: only new or updated versions are touched, metadata files are not rewritten without them
+        model_versions_items = [v for v in model_versions_items if not context.sync_state.is_version_complete(v)]
+        if not model_versions_items:
+            click.echo(f"Model {model_id_str} all versions are synced yet. Skip")
+            if model_version_ids is None:
+                mark_model_synced()
+            return []
+
+    model_lease_key = f"model:{model_id_str}"
+    if context.leases is not None:
+        if context.leases.is_done(model_lease_key):
+            click.echo(f"Model {model_id_str} is synced by other worker of the run. Skip")
+            return []
+        if not context.leases.claim(model_lease_key):
+            click.echo(f"Model {model_id_str} is leased by other worker now. Try again after other models")
+            context.add_busy_model(model_lease_key, functools.partial(
+                download_model, sd_webui_root_dir=sd_webui_root_dir,
+                no_download=no_download,
+                disable_sec_checks=disable_sec_checks,
+                remove_incompleted_files=remove_incompleted_files,
+                no_check_hash_for_exist=no_check_hash_for_exist,
+                url=url,
+                download_pics_from_desc=download_pics_from_desc,
+                write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only,
+                skip_download_file_ext_list=skip_download_file_ext_list,
+                context=context,
+                on_model_synced=on_model_synced,
+                model_version_ids=model_version_ids))
+            return []
 
     type_of_model = model_data_json["type"]
     model_page_name = model_data_json['name']
@@ -506,23 +1063,30 @@ def download_model(sd_webui_root_dir,
     folder_for_model_type = get_web_ui_folder_by_type(sd_webui_root_dir, type_of_model)
     print(f"folder_for_model = {folder_for_model_type}")
 
-    folder_for_current_model = path.join(folder_for_model_type,
-                                         f"{model_data_json['id']}_" + model_page_name_procesed)
+    folder_for_current_model = get_model_folder(sd_webui_root_dir, model_data_json)
 
     Path(folder_for_current_model).mkdir(parents=True, exist_ok=True)
     print(f"Create folder {folder_for_current_model} or use exists ok")
 
-    download_or_update_json_model_info_with_pics(folder_for_current_model=folder_for_current_model,
+    model_jobs.extend(download_or_update_json_model_info_with_pics(folder_for_current_model=folder_for_current_model,
                                                  model_data_json=model_data_json,
                                                  download_pics_from_desc=download_pics_from_desc,
-                                                 write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only)
+                                                 write_json_and_desc_when_not_exists_only=write_json_and_desc_when_not_exists_only,
+                                                 scheduler=context.scheduler,
+                                                 image_variant=context.image_variant,
+                                                 preview_savings=context.preview_savings))
 
+    if context.scheduler.disk_budget is not None:
+        print_disk_plan(context.scheduler.disk_budget, folder_for_current_model, model_versions_items,
+                        disable_sec_checks, skip_download_file_ext_list)
 
-    model_versions_items = model_data_json["modelVersions"]
     for index, model_version_json_data in enumerate(model_versions_items):  # print(index, item)
+        version_jobs: List[Future] = []
+        # version with skipped or not downloaded files is never recorded as complete
+        version_can_be_complete = not no_download
+        version_date = version_timestamp(model_version_json_data)
         print(f"@model_version name raw = {model_version_json_data['name']}")
-        model_version_name_processed = process_str_string(model_version_json_data['name'], with_dots=True)
-        model_version_folder = path.join(folder_for_current_model, model_version_name_processed)
+        model_version_folder = get_model_version_folder(folder_for_current_model, model_version_json_data)
 
         Path(model_version_folder).mkdir(parents=True, exist_ok=True)
         print(f"Create folder {model_version_folder} or use exists ok")
@@ -557,11 +1121,8 @@ def download_model(sd_webui_root_dir,
             if current_file['pickleScanResult'] == "Success" and current_file['virusScanResult'] == "Success":
                 file_model_is_safe = True
 
-            file_hash_blake3 = None
-
-            try:
-                file_hash_blake3 = current_file['hashes']['BLAKE3']
-            except KeyError:
+            file_hashes = current_file.get('hashes')
+            if select_civitai_hash(file_hashes) is None:
                 print(Fore.RED + '\tNo hash in json from cilivai. Hash no calculated on servers of cilivai yet?')
                 print(Fore.RED + '\tHash check disabled now')
                 print(Style.RESET_ALL)
@@ -573,70 +1134,104 @@ def download_model(sd_webui_root_dir,
                           f"download_model_data_entry_path={download_model_data_entry_path})")
                 elif skip_file_name_ext_by_skip_list(skip_download_file_ext_list, current_file['name']):
                     print(f"skip download by skip_list")
+                    version_can_be_complete = False
                 else:
-                    download_file(url=current_file['downloadUrl'],
-                                  no_check_hash_for_exist=no_check_hash_for_exist,
-                                  file_save_path_str_path=download_model_data_entry_path,
-                                  remove_incompleted_files=remove_incompleted_files,
-                                  file_size_kb_from_civitai=current_file['sizeKB'],
-                                  blake3_hash_from_civitai=file_hash_blake3)
+                    file_size = int(current_file['sizeKB'] * 1024)
+                    file_job = context.scheduler.submit_model_file_when_fits(
+                        download_model_data_entry_path, file_size, download_model_file,
+                        transfer=TransferInfo(KIND_MODEL_FILE, size=file_size, version_timestamp=version_date),
+                        url=current_file['downloadUrl'],
+                        no_check_hash_for_exist=no_check_hash_for_exist,
+                        file_save_path_str_path=download_model_data_entry_path,
+                        remove_incompleted_files=remove_incompleted_files,
+                        file_size_kb_from_civitai=current_file['sizeKB'],
+                        hashes_from_civitai=file_hashes,
+                        download_segments=context.download_segments,
+                        hash_cache=context.hash_cache,
+                        content_store=context.content_store)
+                    version_jobs.append(file_job)
             else:
+                version_can_be_complete = False
                 print(Fore.RED + 'I will not download this!!Unsafe')
                 print(Style.RESET_ALL)
                 print("I will not download this!!Unsafe. You can disable it with --disable-sec-checks")
 
-            all_names_and_hashes = dict()
-            max_index_int_name = 0
-
-            for current_file in os.listdir(path=path_for_model_samples_folder):
-                if not current_file.endswith('.json'):
-                    continue
-                path_to_current_json = path.join(path_for_model_samples_folder, current_file)
-
-                current_file_name_without_ext = Path(current_file).stem
-                if current_file_name_without_ext.isdigit():
-                    current_num = int(current_file_name_without_ext)
-                    if current_num > max_index_int_name:
-                        max_index_int_name = current_num
-
-                with open(path_to_current_json, 'r') as fi:
-                    try:
-                        dict_current_json = json.load(fi)
-                    except JSONDecodeError as e:
-                        print(f"decode json error. {e} json file by path {path_to_current_json}")
-                        raise e
-                    all_names_and_hashes[current_file_name_without_ext] = dict_current_json["hash"]
-
-            print(f"max_index_int_name = {max_index_int_name}")
-
-            for index, image_json in enumerate(model_version_json_data["images"]):
-
-                image_name_by_hash = find_exist_image_name_by_hash(all_names_and_hashes_dict=all_names_and_hashes,
-                                                                   hash=image_json["hash"])
-
-                # json with hash was founded
-                if image_name_by_hash is not None:
-                    if not Path(path.join(path_for_model_samples_folder, image_name_by_hash + ".jpg")).is_file():
-                        print(Fore.RED + '\tJson file exists but jpg file no found!!')
-                        print(Style.RESET_ALL)
-                    continue
-
-                max_index_int_name += 1
-                sample_json_data_name = str(max_index_int_name) + ".json"
-                path_for_save_image = path.join(path_for_model_samples_folder, str(max_index_int_name) + ".jpg")
-                path_for_json = path.join(path_for_model_samples_folder, sample_json_data_name)
-                path_for_json_meta = path.join(path_for_model_samples_folder, str(max_index_int_name) + ".meta")
-                if no_download:
-                    print(f"simulate download(url={image_json['url']}, path_for_save_image={path_for_save_image}))")
+        # index is built once per version and updated as images are added
+        sample_index = open_samples(path_for_model_samples_folder, compact=context.compact_samples)
+        print(f"max_index_int_name = {sample_index.max_index}")
+
+        for index, image_json in enumerate(model_version_json_data["images"]):
+
+            image_name_by_hash = sample_index.find(image_json["hash"])
+
+            # json with hash was founded
+            if image_name_by_hash is not None:
+                print(f"Skip download exists image what located at name {image_name_by_hash}")
+                if not Path(path.join(path_for_model_samples_folder, image_name_by_hash + ".jpg")).is_file():
+                    print(Fore.RED + '\tJson file exists but jpg file no found!!')
+                    print(Style.RESET_ALL)
+                continue
+
+            sample_name = sample_index.add_next(image_json["hash"])
+            path_for_save_image = path.join(path_for_model_samples_folder, sample_name + ".jpg")
+            image_url = context.image_variant.url(image_json['url']) if context.image_variant is not None \
+                else image_json['url']
+            # content store keeps full size images only, placed image is not a preview
+            placed = not no_download and context.content_store is not None \
+                and context.content_store.place(IMAGE_NAMESPACE, image_json['hash'], path_for_save_image) is not None
+            is_preview = image_url != image_json['url'] and not placed
+
+            # metadata is recorded before the image download is scheduled: together with index it reserves the name
+            sample_index.record(sample_name, dict(image_json, **{VARIANT_KEY: str(context.image_variant)})
+                                if is_preview else image_json)
+            print(f"save {sample_name} metadata ok")
+
+            if no_download:
+                print(f"simulate download(url={image_url}, path_for_save_image={path_for_save_image}))")
+            elif placed:
+                print(f"image {sample_name} placed from content store. Skip download")
+            else:
+                # previews are not put into content store, it keeps full size images only
+                image_job_args = (image_url, path_for_save_image, sample_name,
+                                  sample_index, image_json['hash'], None if is_preview else context.content_store)
+                image_transfer = TransferInfo(KIND_IMAGE, version_timestamp=version_date)
+                if context.scheduler.is_async:
+                    image_job = context.scheduler.submit_image_coroutine(path_for_save_image,
+                                                                         download_sample_image_async,
+                                                                         *image_job_args, transfer=image_transfer)
                 else:
-                    simple_download(image_json['url'], path_for_save_image)
+                    image_job = context.scheduler.submit_image(path_for_save_image, download_sample_image,
+                                                               *image_job_args, transfer=image_transfer)
+                if is_preview:
+                    image_job.add_done_callback(functools.partial(
+                        count_preview, context.preview_savings, path_for_save_image,
+                        context.image_variant.full_size_ratio(image_json)))
+                version_jobs.append(image_job)
+        sample_index.save()
+
+        model_jobs.extend(version_jobs)
+        if context.sync_state is not None and version_can_be_complete:
+            context.scheduler.when_all_succeed(version_jobs, functools.partial(
+                context.sync_state.mark_version_complete, model_data_json['id'],
+                model_version_json_data, model_version_folder))
+
+    if context.leases is not None:
+        def finish_model_lease(succeeded: bool):
+            # failed model is released, so other worker of the run may try it again
+            if succeeded and not no_download:
+                context.leases.complete(model_lease_key)
+            else:
+                context.leases.release(model_lease_key)
+
+        context.scheduler.when_all_done(model_jobs, finish_model_lease)
 
-                with open(path_for_json, 'w') as f:
-                    dump(image_json, f)
-                    print(f"save {sample_json_data_name} ok")
+    if no_download:
+        return model_jobs
 
-                with open(path_for_json_meta, 'w') as f:
-                    dump(image_json['meta'], f)
+    # model is synced only when every file and image of it is downloaded
+    if model_version_ids is None:
+        context.scheduler.when_all_succeed(model_jobs, mark_model_synced)
+    return model_jobs
 
 
 if __name__ == '__main__':
@@ -0,0 +1,205 @@
+import csv
+import json
+import re
+from concurrent.futures import Future
+from os import path
+from typing import Optional, List, Dict, Set, Any
+from urllib.parse import urlsplit, parse_qs
+
+from civitai_api import CivitaiApiClient, ListingFilters, CIVITAI_MODEL_REGEX_PATTERN, CIVITAI_USER_REGEX_PATTERN, \
+    user_models_api_url, iter_listing_pages
+
+ENTRY_KIND_MODEL = "model"
+ENTRY_KIND_VERSION = "version"
+ENTRY_KIND_USER = "user"
+
+RESULT_OK = "ok"
+RESULT_FAILED = "failed"
+RESULT_ERROR = "error"
+RESULT_INVALID = "invalid"
+
+MANIFEST_FORMAT_TEXT = "text"
+MANIFEST_FORMAT_JSON = "json"
+MANIFEST_FORMAT_CSV = "csv"
+MANIFEST_FORMATS = [MANIFEST_FORMAT_TEXT, MANIFEST_FORMAT_JSON, MANIFEST_FORMAT_CSV]
+
+
+class ManifestEntry:
+    """One url of manifest: civitai model page, model version page (?modelVersionId=) or user page."""
+
+    def __init__(self, url: str, priority: int = 0, source: str = ""):
+        self.url = url.strip()
+        self.priority = priority
+        # position in manifest for messages, like "manifest.txt:12"
+        self.source = source
+        self.kind: Optional[str] = None
+        self.model_id: Optional[int] = None
+        self.version_id: Optional[int] = None
+        self.user_name: Optional[str] = None
+        self.error: Optional[str] = None
+        self.model_ids: List[int] = []
+        self._parse()
+
+    def _parse(self) -> None:
+        user_match = re.fullmatch(CIVITAI_USER_REGEX_PATTERN, self.url)
+        if user_match is not None:
+            self.kind = ENTRY_KIND_USER
+            self.user_name = user_match.group("user_name")
+            return
+        model_match = re.match(CIVITAI_MODEL_REGEX_PATTERN, self.url)
+        if model_match is None:
+            self.error = "not valid civitai model, model version or user page url"
+            return
+        self.model_id = int(model_match.group("model_id"))
+        version_ids = parse_qs(urlsplit(self.url).query).get("modelVersionId")
+        if version_ids and version_ids[0].isdigit():
+            self.kind = ENTRY_KIND_VERSION
+            self.version_id = int(version_ids[0])
+        else:
+            self.kind = ENTRY_KIND_MODEL
+
+
+class ManifestModel:
+    """Deduplicated model of whole manifest with versions requested by all entries."""
+
+    def __init__(self, model_id: int, priority: int):
+        self.model_id = model_id
+        self.priority = priority
+        # None means all versions
+        self.version_ids: Optional[Set[int]] = set()
+        self.entries: List[ManifestEntry] = []
+        self.jobs: List[Future] = []
+        self.error: Optional[str] = None
+
+    def add_entry(self, entry: ManifestEntry) -> None:
+        self.entries.append(entry)
+        self.priority = max(self.priority, entry.priority)
+        if entry.kind == ENTRY_KIND_VERSION:
+            if self.version_ids is not None:
+                self.version_ids.add(entry.version_id)
+        else:
+            self.version_ids = None
+
+    @property
+    def url(self) -> str:
+        return f"https://civitai.com/models/{self.model_id}"
+
+    @property
+    def failed_jobs(self) -> int:
+        return sum(1 for job in self.jobs if job.done() and job.exception() is not None)
+
+    @property
+    def result(self) -> str:
+        if self.error is not None:
+            return RESULT_ERROR
+        return RESULT_FAILED if self.failed_jobs else RESULT_OK
+
+
+def detect_manifest_format(manifest_path: str) -> str:
+    ext = path.splitext(manifest_path)[1].lower()
+    if ext == ".json":
+        return MANIFEST_FORMAT_JSON
+    if ext == ".csv":
+        return MANIFEST_FORMAT_CSV
+    return MANIFEST_FORMAT_TEXT
+
+
+def _parse_priority(value: Any) -> int:
+    if value is None or str(value).strip() == "":
+        return 0
+    return int(value)
+
+
+def load_manifest(manifest_path: str, manifest_format: Optional[str] = None) -> List[ManifestEntry]:
+    """
+    text: one url per line with optional priority after whitespace, # starts comment.
+    json: list of urls or objects {"url": ..., "priority": ...}, also inside {"entries": [...]}.
+    csv: columns url and optional priority, header row is optional.
+    Bigger priority is downloaded first.
+    """
+    manifest_format = manifest_format or detect_manifest_format(manifest_path)
+    name = path.basename(manifest_path)
+    entries: List[ManifestEntry] = []
+    with open(manifest_path, "r", encoding="utf-8", newline="") as f:
+        if manifest_format == MANIFEST_FORMAT_JSON:
+            manifest_json = json.load(f)
+            if isinstance(manifest_json, dict):
+                manifest_json = manifest_json.get("entries", [])
+            for index, item in enumerate(manifest_json):
+                if isinstance(item, str):
+                    item = {"url": item}
+                entries.append(ManifestEntry(item["url"], _parse_priority(item.get("priority")),
+                                             f"{name}[{index}]"))
+        elif manifest_format == MANIFEST_FORMAT_CSV:
+            for line_number, row in enumerate(csv.reader(f), start=1):
+                if not row or not row[0].strip() or row[0].strip().lower() == "url":
+                    continue
+                entries.append(ManifestEntry(row[0], _parse_priority(row[1] if len(row) > 1 else None),
+                                             f"{name}:{line_number}"))
+        else:
+            for line_number, line in enumerate(f, start=1):
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                fields = line.split()
+                entries.append(ManifestEntry(fields[0], _parse_priority(fields[1] if len(fields) > 1 else None),
+                                             f"{name}:{line_number}"))
+    return entries
+
+
+def list_user_model_ids(api_client: CivitaiApiClient, user_name: str, model_type_filter: str) -> List[int]:
+    model_ids = []
+    listing_filters = ListingFilters(model_type=model_type_filter)
+    for r in iter_listing_pages(api_client, user_models_api_url(user_name, listing_filters)):
+        if r.status_code != 200:
+            raise ValueError(f"get models of user {user_name} error, status {r.status_code}")
+        model_ids.extend(item["id"] for item in r.json()["items"] if listing_filters.skip_reason(item) is None)
+    return model_ids
+
+
+def resolve_manifest(entries: List[ManifestEntry], api_client: CivitaiApiClient,
+                     model_type_filter: str = "NONE") -> List[ManifestModel]:
+    """Expands users to their models and merges all entries of one model, ordered by priority."""
+    models: Dict[int, ManifestModel] = {}
+    for entry in entries:
+        if entry.error is not None:
+            continue
+        if entry.kind == ENTRY_KIND_USER:
+            try:
+                entry.model_ids = list_user_model_ids(api_client, entry.user_name, model_type_filter)
+            except (ValueError, KeyError) as e:
+                entry.error = str(e)
+                continue
+        else:
+            entry.model_ids = [entry.model_id]
+        for model_id in entry.model_ids:
+            if model_id not in models:
+                models[model_id] = ManifestModel(model_id, entry.priority)
+            models[model_id].add_entry(entry)
+    # stable sort keeps manifest order inside one priority
+    return sorted(models.values(), key=lambda manifest_model: -manifest_model.priority)
+
+
+def entry_result(entry: ManifestEntry, models: Dict[int, ManifestModel]) -> Dict[str, Any]:
+    if entry.error is not None:
+        return {"source": entry.source, "url": entry.url, "result": RESULT_INVALID if entry.kind is None
+                else RESULT_ERROR, "error": entry.error}
+    entry_models = [models[model_id] for model_id in entry.model_ids]
+    results = [manifest_model.result for manifest_model in entry_models]
+    if RESULT_ERROR in results:
+        result = RESULT_ERROR
+    elif RESULT_FAILED in results:
+        result = RESULT_FAILED
+    else:
+        result = RESULT_OK
+    return {"source": entry.source,
+            "url": entry.url,
+            "kind": entry.kind,
+            "priority": entry.priority,
+            "result": result,
+            "models": len(entry_models),
+            "models_failed": sum(1 for r in results if r != RESULT_OK),
+            "jobs": sum(len(manifest_model.jobs) for manifest_model in entry_models),
+            "jobs_failed": sum(manifest_model.failed_jobs for manifest_model in entry_models),
+            "errors": [f"{manifest_model.model_id}: {manifest_model.error}" for manifest_model in entry_models
+                       if manifest_model.error is not None]}
@@ -0,0 +1,196 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+# operation kinds
+OP_API_FETCH = "api_fetch"
+OP_DOWNLOAD = "download"
+OP_SEGMENTED_DOWNLOAD = "segmented_download"
+OP_HASH = "hash"
+OP_HASH_CACHE = "hash_cache"
+OP_SAMPLE_INDEX_BUILD = "sample_index_build"
+OP_HTTP_RETRY = "http_retry"
+
+PROMETHEUS_PREFIX = "civitai_downloader"
+
+
+class Operation:
+    """Timing and counters of one operation, filled by instrumented code inside Metrics.operation()."""
+
+    def __init__(self, kind: str, fields: Dict[str, Any]):
+        self.kind = kind
+        self.fields = fields
+        self.bytes = 0
+        self.cache_hit: Optional[bool] = None
+        self.retries = 0
+        self.error: Optional[str] = None
+        self.started = time.time()
+        self.seconds = 0.0
+
+
+class _KindStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds: List[float] = []
+        self.bytes = 0
+        self.cache_hits = 0
+        self.retries = 0
+        # wall clock span of all operations of the kind, for throughput of parallel transfers
+        self.first_started: Optional[float] = None
+        self.last_finished = 0.0
+
+
+class Metrics:
+    """
+    Per operation timings, bytes, retries and cache hits of one run.
+    Every operation is one json line in event log (when configured) and is aggregated for summary and prometheus.
+    """
+
+    def __init__(self, event_log_path: Optional[str] = None):
+        self.event_log_path = event_log_path
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, _KindStats] = {}
+        self._event_log: Optional[TextIO] = None
+        if event_log_path is not None:
+            self._event_log = open(event_log_path, "a", encoding="utf-8")
+
+    @contextmanager
+    def operation(self, kind: str, **fields) -> Iterator[Operation]:
+        op = Operation(kind, fields)
+        started = time.perf_counter()
+        try:
+            yield op
+        except BaseException as e:
+            op.error = repr(e)
+            raise
+        finally:
+            op.seconds = time.perf_counter() - started
+            self._record(op)
+
+    def event(self, kind: str, **fields) -> None:
+        # instant operation, like a retry
+        self._record(Operation(kind, fields))
+
+    def _record(self, op: Operation) -> None:
+        with self._lock:
+            stats = self._stats.get(op.kind)
+            if stats is None:
+                stats = self._stats[op.kind] = _KindStats()
+            stats.count += 1
+            stats.seconds.append(op.seconds)
+            stats.bytes += op.bytes
+            stats.retries += op.retries
+            if stats.first_started is None or op.started < stats.first_started:
+                stats.first_started = op.started
+            stats.last_finished = max(stats.last_finished, op.started + op.seconds)
+            if op.error is not None:
+                stats.errors += 1
+            if op.cache_hit:
+                stats.cache_hits += 1
+            if self._event_log is not None:
+                event = {"ts": round(op.started, 3), "op": op.kind, "seconds": round(op.seconds, 6)}
+                if op.bytes:
+                    event["bytes"] = op.bytes
+                if op.cache_hit is not None:
+                    event["cache_hit"] = op.cache_hit
+                if op.retries:
+                    event["retries"] = op.retries
+                if op.error is not None:
+                    event["error"] = op.error
+                event.update(op.fields)
+                self._event_log.write(json.dumps(event, default=str) + "\n")
+
+    def summary(self) -> List[Dict[str, Any]]:
+        rows = []
+        with self._lock:
+            for kind, stats in sorted(self._stats.items()):
+                seconds = sorted(stats.seconds)
+                total_seconds = sum(seconds)
+                rows.append({"op": kind,
+                             "count": stats.count,
+                             "errors": stats.errors,
+                             "seconds": total_seconds,
+                             "p50_ms": seconds[len(seconds) // 2] * 1000,
+                             "p95_ms": seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))] * 1000,
+                             "bytes": stats.bytes,
+                             "mb_per_s": stats.bytes / 1024 / 1024 / total_seconds if total_seconds > 0 else 0.0,
+                             "cache_hits": stats.cache_hits,
+                             "retries": stats.retries})
+        return rows
+
+    def throughput(self, kinds: List[str]) -> Tuple[int, float]:
+        """Bytes of operations of kinds and wall seconds from the first start to the last finish among them."""
+        with self._lock:
+            kind_stats = [self._stats[kind] for kind in kinds if kind in self._stats]
+            started = [stats.first_started for stats in kind_stats if stats.first_started is not None]
+            if not started:
+                return 0, 0.0
+            return (sum(stats.bytes for stats in kind_stats),
+                    max(stats.last_finished for stats in kind_stats) - min(started))
+
+    def format_summary(self) -> str:
+        lines = [f"metrics: run {time.time() - self.started:.1f} s",
+                 f"{'op':20} {'count':>7} {'errors':>6} {'sum s':>9} {'p50 ms':>9} {'p95 ms':>9} "
+                 f"{'MB':>10} {'MB/s':>8} {'cache':>6} {'retry':>6}"]
+        for row in self.summary():
+            lines.append(f"{row['op']:20} {row['count']:7} {row['errors']:6} {row['seconds']:9.2f} "
+                         f"{row['p50_ms']:9.1f} {row['p95_ms']:9.1f} {row['bytes'] / 1024 / 1024:10.1f} "
+                         f"{row['mb_per_s']:8.1f} {row['cache_hits']:6} {row['retries']:6}")
+        return "\n".join(lines)
+
+    def prometheus_text(self) -> str:
+        metrics = [
+            ("operations_total", "counter", "Finished operations", "count"),
+            ("operation_errors_total", "counter", "Failed operations", "errors"),
+            ("operation_seconds_total", "counter", "Seconds spent in operations", "seconds"),
+            ("operation_bytes_total", "counter", "Bytes transferred or hashed by operations", "bytes"),
+            ("operation_cache_hits_total", "counter", "Operations answered from cache", "cache_hits"),
+            ("operation_retries_total", "counter", "Retries inside operations", "retries"),
+        ]
+        rows = self.summary()
+        lines = []
+        for name, metric_type, help_text, key in metrics:
+            full_name = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            for row in rows:
+                lines.append(f'{full_name}{{op="{row["op"]}"}} {row[key]}')
+        full_name = f"{PROMETHEUS_PREFIX}_last_run_timestamp_seconds"
+        lines.append(f"# HELP {full_name} End time of the last run")
+        lines.append(f"# TYPE {full_name} gauge")
+        lines.append(f"{full_name} {time.time():.0f}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_path: str) -> None:
+        # atomic replace, node exporter textfile collector must not read half written file
+        tmp_file_path = file_path + ".tmp"
+        with open(tmp_file_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_file_path, file_path)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._event_log is not None:
+                self._event_log.close()
+                self._event_log = None
+
+
+_metrics = Metrics()
+_metrics_lock = threading.Lock()
+
+
+def configure_metrics(**kwargs) -> Metrics:
+    global _metrics
+    with _metrics_lock:
+        _metrics = Metrics(**kwargs)
+        return _metrics
+
+
+def get_metrics() -> Metrics:
+    with _metrics_lock:
+        return _metrics
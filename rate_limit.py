@@ -0,0 +1,168 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Iterator, Dict
+
+# answers which mean "too fast", they reduce concurrency of the host and pause it for Retry-After
+THROTTLE_STATUSES = (429, 503)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_MAX_BACKOFF = 120.0
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # delay seconds or http date
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    import email.utils
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def backoff_delay(attempt: int, backoff_factor: float, retry_after: Optional[float] = None,
+                  max_backoff: float = DEFAULT_MAX_BACKOFF) -> float:
+    # Retry-After of server wins, otherwise exponential backoff with full jitter
+    if retry_after is not None:
+        return min(retry_after, max_backoff)
+    return random.uniform(0, min(max_backoff, backoff_factor * (2 ** attempt)))
+
+
+class TokenBucket:
+    """rate tokens per second with burst capacity, rate <= 0 means unlimited."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1) -> float:
+        # takes tokens now or in the future, returns seconds to wait for them
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self.rate <= 0:
+                return wait
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            if self._tokens < 0:
+                wait = max(wait, -self._tokens / self.rate)
+            return wait
+
+    def pause(self, seconds: float) -> None:
+        # every request to the host waits, used for Retry-After
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveConcurrency:
+    """
+    Parallel requests limit of one host with AIMD: +1 after limit successful answers in a row,
+    halved on throttling answer. Without adaptation limit is fixed to max_limit.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, adaptive: bool = True):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.adaptive = adaptive
+        self.limit = self.max_limit
+        self._active = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def try_acquire(self) -> bool:
+        # without waiting, for coroutines which must not block the event loop
+        with self._condition:
+            if self._active >= self.limit:
+                return False
+            self._active += 1
+            return True
+
+    def release(self) -> None:
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def on_success(self) -> None:
+        if not self.adaptive:
+            return
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_limit:
+                self._successes = 0
+                self.limit += 1
+                self._condition.notify()
+
+    def on_throttle(self) -> None:
+        if not self.adaptive:
+            return
+        with self._condition:
+            self._successes = 0
+            self.limit = max(self.min_limit, self.limit // 2)
+
+
+class HostRateLimiter:
+    """Token bucket and adaptive concurrency of one host, shared by all threads of the run."""
+
+    def __init__(self, rate: float, burst: int, max_concurrency: int, adaptive: bool = True):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveConcurrency(max_concurrency, adaptive=adaptive)
+        self.throttled = 0
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        self.concurrency.acquire()
+        try:
+            wait = self.bucket.reserve()
+            if wait > 0:
+                time.sleep(wait)
+            yield
+        finally:
+            self.concurrency.release()
+
+    def on_answer(self, status_code: int, retry_after: Optional[float] = None) -> None:
+        if status_code in THROTTLE_STATUSES:
+            self.throttled += 1
+            self.concurrency.on_throttle()
+            if retry_after is not None:
+                self.bucket.pause(retry_after)
+        elif status_code < 500:
+            self.concurrency.on_success()
+
+
+class RateLimiterRegistry:
+    def __init__(self, rate: float = 0, burst: int = 1, max_concurrency: int = 8, adaptive: bool = True):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.adaptive = adaptive
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, HostRateLimiter] = {}
+
+    def for_host(self, host: str) -> HostRateLimiter:
+        with self._lock:
+            limiter = self._hosts.get(host)
+            if limiter is None:
+                limiter = HostRateLimiter(self.rate, self.burst, self.max_concurrency, adaptive=self.adaptive)
+                self._hosts[host] = limiter
+            return limiter
+
+    def summary(self) -> str:
+        with self._lock:
+            return ", ".join(f"{host}: throttled = {limiter.throttled}, concurrency = {limiter.concurrency.limit}"
+                             for host, limiter in self._hosts.items() if limiter.throttled)
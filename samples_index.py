@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+from json import JSONDecodeError
+from os import path
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from library_layout import unique_tmp_path, write_json_atomic
+from metrics import get_metrics, OP_SAMPLE_INDEX_BUILD
+
+SAMPLES_INDEX_FILE_NAME = "samples_index.json"
+SAMPLES_INDEX_VERSION = 2
+
+
+def list_sample_json_names(samples_folder: str):
+    return [file_name for file_name in os.listdir(samples_folder)
+            if file_name.endswith('.json') and file_name != SAMPLES_INDEX_FILE_NAME]
+
+
+def sample_jsons_mtime_ns(samples_folder: str, json_names) -> int:
+    # the latest change of N.json files, detects files edited or replaced by hand with the same count
+    mtime_ns = 0
+    for json_name in json_names:
+        try:
+            mtime_ns = max(mtime_ns, os.stat(path.join(samples_folder, json_name)).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+    return mtime_ns
+
+
+class SampleIndex:
+    """
+    hash -> sample name of one version samples folder, with max numeric name.
+    Persisted as one compact file, so N.json files are parsed only when index is missing or out of date.
+    """
+
+    def __init__(self, samples_folder: str):
+        self.samples_folder = samples_folder
+        self.index_path = path.join(samples_folder, SAMPLES_INDEX_FILE_NAME)
+        self.hash_to_name: Dict[str, str] = {}
+        self.max_index = 0
+        # number of N.json files described by index, detects files added or removed by hand
+        self.json_count = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, samples_folder: str, save: bool = True) -> "SampleIndex":
+        # save=False: rebuilt index is not written, for read only users like planner
+        sample_index = cls(samples_folder)
+        json_names = list_sample_json_names(samples_folder)
+        if not sample_index._load_index_file(len(json_names), sample_jsons_mtime_ns(samples_folder, json_names)):
+            sample_index._build(json_names)
+            if save:
+                sample_index.save()
+        return sample_index
+
+    def _load_index_file(self, json_count: int, json_mtime_ns: int) -> bool:
+        if not path.isfile(self.index_path):
+            return False
+        try:
+            with open(self.index_path, 'r') as f:
+                index_json = json.load(f)
+        except (OSError, JSONDecodeError):
+            return False
+        if index_json.get("version") != SAMPLES_INDEX_VERSION or index_json.get("json_count") != json_count \
+                or index_json.get("json_mtime_ns") != json_mtime_ns:
+            return False
+        self.hash_to_name = index_json["hashes"]
+        self.max_index = index_json["max_index"]
+        self.json_count = json_count
+        return True
+
+    def _build(self, json_names) -> None:
+        print(f"build samples index of {self.samples_folder}")
+        with get_metrics().operation(OP_SAMPLE_INDEX_BUILD, folder=self.samples_folder, json_files=len(json_names)):
+            self._read_sample_jsons(json_names)
+
+    def _read_sample_jsons(self, json_names) -> None:
+        self.json_count = len(json_names)
+        for current_file in json_names:
+            path_to_current_json = path.join(self.samples_folder, current_file)
+
+            current_file_name_without_ext = Path(current_file).stem
+            if current_file_name_without_ext.isdigit():
+                self.max_index = max(self.max_index, int(current_file_name_without_ext))
+
+            with open(path_to_current_json, 'r') as fi:
+                try:
+                    dict_current_json = json.load(fi)
+                except JSONDecodeError as e:
+                    print(f"decode json error. {e} json file by path {path_to_current_json}")
+                    raise e
+                self.hash_to_name[dict_current_json["hash"]] = current_file_name_without_ext
+
+    def find(self, image_hash: str) -> Optional[str]:
+        with self._lock:
+            return self.hash_to_name.get(image_hash)
+
+    def add_next(self, image_hash: str) -> str:
+        # reserves the next numeric name for the image
+        with self._lock:
+            self.max_index += 1
+            name = str(self.max_index)
+            self.hash_to_name[image_hash] = name
+            self.json_count += 1
+            return name
+
+    def remove(self, image_hash: str) -> None:
+        with self._lock:
+            if self.hash_to_name.pop(image_hash, None) is not None:
+                self.json_count -= 1
+
+    def record(self, name: str, image_json: Dict[str, Any]) -> None:
+        # N.json together with index reserves the name, N.meta is generation data for other tools
+        write_json_atomic(path.join(self.samples_folder, name + ".json"), image_json)
+        write_json_atomic(path.join(self.samples_folder, name + ".meta"), image_json['meta'])
+
+    def iter_samples(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            names = sorted(set(self.hash_to_name.values()))
+        for name in names:
+            with open(path.join(self.samples_folder, name + ".json"), 'r') as f:
+                yield name, json.load(f)
+
+    def release(self, name: str, image_hash: str) -> None:
+        for ext in (".json", ".meta"):
+            if path.isfile(path.join(self.samples_folder, name + ext)):
+                os.remove(path.join(self.samples_folder, name + ext))
+        self.remove(image_hash)
+
+    def save(self) -> None:
+        # N.json files are written before the index is saved, so their latest mtime is known here
+        json_mtime_ns = sample_jsons_mtime_ns(self.samples_folder, list_sample_json_names(self.samples_folder))
+        with self._lock:
+            index_json = {"version": SAMPLES_INDEX_VERSION,
+                          "max_index": self.max_index,
+                          "json_count": self.json_count,
+                          "json_mtime_ns": json_mtime_ns,
+                          "hashes": dict(self.hash_to_name)}
+        tmp_index_path = unique_tmp_path(self.index_path)
+        with open(tmp_index_path, 'w') as f:
+            json.dump(index_json, f)
+        os.replace(tmp_index_path, self.index_path)
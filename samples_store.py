@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+from json import JSONDecodeError
+from os import path
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from library_layout import unique_tmp_path, iter_model_folders, SAMPLES_FOLDER_NAME
+from samples_index import SampleIndex, SAMPLES_INDEX_FILE_NAME, list_sample_json_names
+
+SAMPLES_STORE_FILE_NAME = "samples.jsonl"
+
+
+class SampleStore:
+    """
+    Compact metadata of one version samples folder: a json line per sample in samples.jsonl
+    instead of N.json and N.meta files, only N.jpg files are kept beside it.
+    Lines are appended when images are reserved, a "removed" line releases the name of a failed image.
+    The file is read once per run and is the hash index itself.
+    It is library data, so it is a plain file like other files of the root: SQLite is kept for rebuildable
+    per-machine caches (hash cache, sync state), see worker_state_dir.
+    """
+
+    def __init__(self, samples_folder: str):
+        self.samples_folder = samples_folder
+        self.store_path = path.join(samples_folder, SAMPLES_STORE_FILE_NAME)
+        self.hash_to_name: Dict[str, str] = {}
+        # name -> image json of civitai
+        self.samples: Dict[str, Dict[str, Any]] = {}
+        self.max_index = 0
+        self.removed_lines = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, samples_folder: str, save: bool = True) -> "SampleStore":
+        # save=False: a damaged file is not repaired, for read only users like planner
+        sample_store = cls(samples_folder)
+        if not path.isfile(sample_store.store_path):
+            return sample_store
+        damaged_lines = 0
+        with open(sample_store.store_path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    sample_store._apply(json.loads(line))
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    # torn last line of an interrupted write, the image of it is downloaded again
+                    print(f"skip damaged line {line_number} of {sample_store.store_path}: {e}")
+                    damaged_lines += 1
+        if damaged_lines and save:
+            # rewritten at once: next append would continue the torn line
+            sample_store._rewrite()
+        return sample_store
+
+    def _apply(self, line_json: Dict[str, Any]) -> None:
+        name = line_json["name"]
+        if name.isdigit():
+            self.max_index = max(self.max_index, int(name))
+        if line_json.get("removed"):
+            self.removed_lines += 1
+            self.samples.pop(name, None)
+            if self.hash_to_name.get(line_json["hash"]) == name:
+                del self.hash_to_name[line_json["hash"]]
+        else:
+            self.samples[name] = line_json["image"]
+            self.hash_to_name[line_json["hash"]] = name
+
+    def _append(self, line_json: Dict[str, Any]) -> None:
+        # one write of O_APPEND file: lines of threads and processes are not mixed on local file systems.
+        # O_APPEND is not atomic on NFS/SMB, so --shared-run does not start compact folders (a model is
+        # written by its lease holder only)
+        line = (json.dumps(line_json) + "\n").encode("utf-8")
+        fd = os.open(self.store_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def find(self, image_hash: str) -> Optional[str]:
+        with self._lock:
+            return self.hash_to_name.get(image_hash)
+
+    def add_next(self, image_hash: str) -> str:
+        with self._lock:
+            self.max_index += 1
+            name = str(self.max_index)
+            self.hash_to_name[image_hash] = name
+            return name
+
+    def record(self, name: str, image_json: Dict[str, Any]) -> None:
+        with self._lock:
+            if name in self.samples:
+                # line of the old metadata is compacted away by save
+                self.removed_lines += 1
+            self.samples[name] = image_json
+            self._append({"name": name, "hash": image_json["hash"], "image": image_json})
+
+    def iter_samples(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            samples = sorted(self.samples.items(), key=lambda item: _sample_sort_key(item[0]))
+        return iter(samples)
+
+    def release(self, name: str, image_hash: str) -> None:
+        with self._lock:
+            self.samples.pop(name, None)
+            if self.hash_to_name.get(image_hash) == name:
+                del self.hash_to_name[image_hash]
+            self._append({"name": name, "hash": image_hash, "removed": True})
+            self.removed_lines += 1
+
+    def save(self) -> None:
+        # appends are written yet, only lines of removed samples are compacted away
+        with self._lock:
+            if self.removed_lines:
+                self._rewrite()
+
+    def _rewrite(self) -> None:
+        tmp_store_path = unique_tmp_path(self.store_path)
+        with open(tmp_store_path, "w", encoding="utf-8") as f:
+            for name, image_json in sorted(self.samples.items(), key=lambda item: _sample_sort_key(item[0])):
+                f.write(json.dumps({"name": name, "hash": image_json["hash"], "image": image_json}) + "\n")
+        os.replace(tmp_store_path, self.store_path)
+        self.removed_lines = 0
+
+
+Samples = Union[SampleIndex, SampleStore]
+
+
+def _sample_sort_key(name: str):
+    return (0, int(name), "") if name.isdigit() else (1, 0, name)
+
+
+def open_samples(samples_folder: str, compact: bool = False, save: bool = True) -> Samples:
+    """
+    Samples metadata of the folder: migrated folders always use the store,
+    compact=True starts new folders with it, legacy folders keep N.json files until migration.
+    """
+    if path.isfile(path.join(samples_folder, SAMPLES_STORE_FILE_NAME)):
+        return SampleStore.load(samples_folder, save=save)
+    if compact and not list_sample_json_names(samples_folder):
+        return SampleStore(samples_folder)
+    return SampleIndex.load(samples_folder, save=save)
+
+
+def iter_samples_folders(sd_webui_root_dir: str) -> Iterator[str]:
+    # <type folder>/<model>/<version>/samples
+    for model_folder in iter_model_folders(sd_webui_root_dir):
+        for version_folder in sorted(os.scandir(model_folder), key=lambda entry: entry.name):
+            samples_folder = path.join(version_folder.path, SAMPLES_FOLDER_NAME)
+            if version_folder.is_dir() and path.isdir(samples_folder):
+                yield samples_folder
+
+
+def _legacy_files(samples_folder: str) -> List[str]:
+    names = [file_name for file_name in os.listdir(samples_folder)
+             if file_name.endswith(".meta") or file_name == SAMPLES_INDEX_FILE_NAME]
+    return names + list_sample_json_names(samples_folder)
+
+
+def migrate_samples_folder(samples_folder: str) -> int:
+    """
+    N.json and N.meta files into samples.jsonl. The store is written before legacy files are removed,
+    an interrupted migration is finished by the next one. Returns migrated samples.
+    """
+    sample_store = SampleStore.load(samples_folder)
+    if not path.isfile(sample_store.store_path):
+        json_names = list_sample_json_names(samples_folder)
+        if not json_names:
+            # empty store would switch the folder to compact form for good
+            return 0
+        for json_name in json_names:
+            try:
+                with open(path.join(samples_folder, json_name), "r") as f:
+                    image_json = json.load(f)
+            except JSONDecodeError as e:
+                print(f"decode json error. {e} json file by path {path.join(samples_folder, json_name)}")
+                raise e
+            sample_store.samples[Path(json_name).stem] = image_json
+        sample_store._rewrite()
+    migrated = len(sample_store.samples)
+    for file_name in _legacy_files(samples_folder):
+        os.remove(path.join(samples_folder, file_name))
+    return migrated
+
+
+def export_samples_folder(samples_folder: str, keep_store: bool = False) -> int:
+    """samples.jsonl back to N.json, N.meta and samples index. Returns exported samples."""
+    store_path = path.join(samples_folder, SAMPLES_STORE_FILE_NAME)
+    if not path.isfile(store_path):
+        return 0
+    sample_store = SampleStore.load(samples_folder)
+    sample_index = SampleIndex(samples_folder)
+    for name, image_json in sample_store.samples.items():
+        sample_index.record(name, image_json)
+    sample_index = SampleIndex.load(samples_folder)
+    if not keep_store:
+        os.remove(store_path)
+    return len(sample_index.hash_to_name)
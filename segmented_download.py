@@ -0,0 +1,288 @@
+import errno
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, List, Dict, Any
+
+from hashing import StreamHasher
+from http_client import get_http_client
+from metrics import get_metrics, OP_SEGMENTED_DOWNLOAD
+from transfer_queue import file_progress_bar
+
+DEFAULT_SEGMENT_COUNT = 4
+# smaller files are faster with one stream than with a range handshake per segment
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_CHUNK_SIZE = 1024 * 1024
+SEGMENT_RETRIES = 3
+# journal is rewritten at most once per this amount of downloaded bytes
+JOURNAL_SAVE_EVERY_BYTES = 32 * 1024 * 1024
+HASH_FOLLOW_READ_SIZE = 8 * 1024 * 1024
+
+PART_SUFFIX = ".part"
+JOURNAL_SUFFIX = ".part.journal"
+
+CONTENT_RANGE_REGEX_PATTERN = re.compile(r"^bytes\s+(?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+)$")
+
+
+class RangeNotSupportedError(Exception):
+    pass
+
+
+class RangeProbe:
+    def __init__(self, final_url: str, total_size: int, etag: Optional[str]):
+        self.final_url = final_url
+        self.total_size = total_size
+        self.etag = etag
+
+
+class Segment:
+    def __init__(self, start: int, end: int, done: int):
+        # end is exclusive, done is absolute offset of the first not written byte
+        self.start = start
+        self.end = end
+        self.done = done
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.done
+
+    def to_json(self) -> Dict[str, int]:
+        return {"start": self.start, "end": self.end, "done": self.done}
+
+
+def probe_range_support(url: str) -> Optional[RangeProbe]:
+    # civitai download url is a redirect to signed cdn url, use the final one for all segments
+    with get_http_client().stream(url, headers={"Range": "bytes=0-0"}, allow_redirects=True) as resp:
+        if resp.status_code != 206:
+            return None
+        content_range_match = re.fullmatch(CONTENT_RANGE_REGEX_PATTERN,
+                                           resp.headers.get("content-range", "").strip())
+        if content_range_match is None:
+            return None
+        return RangeProbe(final_url=resp.url,
+                          total_size=int(content_range_match.group("total")),
+                          etag=resp.headers.get("etag"))
+
+
+def preallocate(file, size: int) -> None:
+    # real blocks on disk: segments written out of order do not fragment the file,
+    # and a full disk fails the download before any byte is transferred
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+            return
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+            # file system without fallocate
+    file.truncate(size)
+
+
+def split_segments(total_size: int, segment_count: int) -> List[Segment]:
+    segment_count = max(1, min(segment_count, total_size // MIN_SEGMENT_SIZE))
+    segment_size = total_size // segment_count
+    segments = []
+    for index in range(segment_count):
+        start = index * segment_size
+        end = total_size if index == segment_count - 1 else start + segment_size
+        segments.append(Segment(start, end, start))
+    return segments
+
+
+def journal_path_for(fname: str) -> str:
+    return fname + JOURNAL_SUFFIX
+
+
+def part_path_for(fname: str) -> str:
+    return fname + PART_SUFFIX
+
+
+def load_journal(fname: str, probe: RangeProbe) -> Optional[List[Segment]]:
+    journal_path = journal_path_for(fname)
+    if not Path(journal_path).is_file() or not Path(part_path_for(fname)).is_file():
+        return None
+    try:
+        with open(journal_path, "r") as f:
+            journal = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if journal.get("total_size") != probe.total_size:
+        return None
+    if journal.get("etag") is not None and probe.etag is not None and journal["etag"] != probe.etag:
+        return None
+    return [Segment(s["start"], s["end"], s["done"]) for s in journal["segments"]]
+
+
+def save_journal(fname: str, url: str, probe: RangeProbe, segments: List[Segment]) -> None:
+    journal_path = journal_path_for(fname)
+    tmp_journal_path = journal_path + ".tmp"
+    with open(tmp_journal_path, "w") as f:
+        json.dump({"url": url,
+                   "total_size": probe.total_size,
+                   "etag": probe.etag,
+                   "segments": [segment.to_json() for segment in segments]}, f)
+    os.replace(tmp_journal_path, journal_path)
+
+
+class _SegmentedTransfer:
+    def __init__(self, url: str, fname: str, probe: RangeProbe, segments: List[Segment], bar: Any):
+        self.url = url
+        self.fname = fname
+        self.part_path = part_path_for(fname)
+        self.probe = probe
+        self.segments = segments
+        self.bar = bar
+        self.lock = threading.Lock()
+        self.written = threading.Condition(self.lock)
+        self.bytes_since_journal = 0
+        self.retries = 0
+
+    def on_written(self, segment: Segment, size: int) -> None:
+        with self.lock:
+            segment.done += size
+            self.written.notify_all()
+            self.bar.update(size)
+            self.bytes_since_journal += size
+            if self.bytes_since_journal >= JOURNAL_SAVE_EVERY_BYTES:
+                self.bytes_since_journal = 0
+                save_journal(self.fname, self.url, self.probe, self.segments)
+
+    def follow_and_hash(self, hasher: StreamHasher, futures: List) -> None:
+        # segments are written out of order, so hash follows the contiguous written prefix of the file.
+        # it reads bytes right after they were written, they are still in os page cache
+        offset = 0
+        # unbuffered: buffered reader keeps read-ahead bytes of not yet written region
+        with open(self.part_path, "rb", buffering=0) as file:
+            for segment in sorted(self.segments, key=lambda s: s.start):
+                while offset < segment.end:
+                    with self.written:
+                        while segment.done <= offset:
+                            if all(future.done() for future in futures):
+                                # some segment failed, error is raised by caller
+                                return
+                            self.written.wait(timeout=0.5)
+                        available = segment.done
+                    file.seek(offset)
+                    while offset < available:
+                        data = file.read(min(HASH_FOLLOW_READ_SIZE, available - offset))
+                        if not data:
+                            return
+                        hasher.update(data)
+                        offset += len(data)
+
+    def download_segment(self, segment: Segment) -> None:
+        import requests
+        last_error: Optional[Exception] = None
+        failed_attempts = 0
+        attempts = 0
+        while segment.remaining > 0 and failed_attempts < SEGMENT_RETRIES:
+            if attempts:
+                with self.lock:
+                    self.retries += 1
+            attempts += 1
+            done_before = segment.done
+            try:
+                self._download_segment_once(segment)
+            except (requests.RequestException, RangeNotSupportedError) as e:
+                last_error = e
+            # connection dropped in the middle of segment is retried from the last written byte,
+            # only attempts without any progress are counted
+            if segment.done == done_before:
+                failed_attempts += 1
+        if segment.remaining > 0:
+            raise last_error or RangeNotSupportedError(f"segment {segment.start}-{segment.end} incomplete")
+
+    def _download_segment_once(self, segment: Segment) -> None:
+        headers = {"Range": f"bytes={segment.done}-{segment.end - 1}"}
+        with get_http_client().stream(self.probe.final_url, headers=headers) as resp:
+            if resp.status_code != 206:
+                raise RangeNotSupportedError(f"range request returned {resp.status_code}")
+            throttle = get_http_client().bandwidth.for_url(self.probe.final_url)
+            # unbuffered handle: bytes reported to journal are at least in os cache
+            with open(self.part_path, "r+b", buffering=0) as file:
+                file.seek(segment.done)
+                for data in resp.iter_content(chunk_size=SEGMENT_CHUNK_SIZE):
+                    data = data[:segment.remaining]
+                    if not data:
+                        break
+                    file.write(data)
+                    self.on_written(segment, len(data))
+                    throttle.throttle(len(data))
+
+
+def segmented_download(url: str, fname: str, segment_count: int = DEFAULT_SEGMENT_COUNT,
+                       hasher: Optional[StreamHasher] = None) -> bool:
+    """
+    Download url to fname with parallel http range requests.
+    Data goes to fname + ".part" with a sidecar journal, so interrupted download resumes on next call.
+    When hasher is passed, it is fed with the whole file content while segments are downloading.
+    Returns False when server does not support ranges, caller must use single stream download.
+    """
+    probe = probe_range_support(url)
+    if probe is None or probe.total_size == 0:
+        # interrupted download of such url can not be resumed
+        remove_partial_download(fname)
+        return False
+
+    part_path = part_path_for(fname)
+    segments = load_journal(fname, probe)
+    if segments is None:
+        segments = split_segments(probe.total_size, segment_count)
+        try:
+            with open(part_path, "wb") as f:
+                preallocate(f, probe.total_size)
+        except OSError:
+            os.remove(part_path)
+            raise
+        save_journal(fname, url, probe, segments)
+    else:
+        print(f"Resume download {Path(fname).name} from journal")
+
+    already_done = sum(segment.done - segment.start for segment in segments)
+    with get_metrics().operation(OP_SEGMENTED_DOWNLOAD, url=url, path=fname, segments=len(segments),
+                                 resumed_bytes=already_done) as op:
+        with file_progress_bar(fname, probe.total_size, initial=already_done) as bar:
+            transfer = _SegmentedTransfer(url, fname, probe, segments, bar)
+            try:
+                with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix="segment") as pool:
+                    futures = [pool.submit(transfer.download_segment, segment) for segment in segments]
+                    if hasher is not None:
+                        transfer.follow_and_hash(hasher, futures)
+                    for future in futures:
+                        future.result()
+            finally:
+                save_journal(fname, url, probe, segments)
+                op.bytes = sum(segment.done - segment.start for segment in segments) - already_done
+                op.retries = transfer.retries
+
+    if any(segment.remaining > 0 for segment in segments):
+        raise RangeNotSupportedError(f"segments of {fname} incomplete")
+
+    os.replace(part_path, fname)
+    os.remove(journal_path_for(fname))
+    return True
+
+
+def remove_partial_download(fname: str) -> None:
+    for partial_path in (part_path_for(fname), journal_path_for(fname)):
+        if Path(partial_path).is_file():
+            os.remove(partial_path)
+
+
+def journal_done_bytes(fname: str) -> Optional[int]:
+    # downloaded bytes of interrupted download, without range probe
+    if not has_resumable_journal(fname):
+        return None
+    try:
+        with open(journal_path_for(fname), "r") as f:
+            journal = json.load(f)
+        return sum(s["done"] - s["start"] for s in journal["segments"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def has_resumable_journal(fname: str) -> bool:
+    return Path(journal_path_for(fname)).is_file() and Path(part_path_for(fname)).is_file()
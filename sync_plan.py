@@ -0,0 +1,260 @@
+import json
+import math
+import os
+import time
+from os import path
+from typing import Any, Dict, List, Optional, Set
+
+from content_store import ContentStore, IMAGE_NAMESPACE
+from description_pics import rewrite_description_pics
+from hashing import select_civitai_hash
+from library_layout import get_model_folder, get_model_version_folder, write_json_atomic, SAMPLES_FOLDER_NAME, \
+    PICS_FOLDER_NAME
+from metrics import Metrics, OP_DOWNLOAD, OP_SEGMENTED_DOWNLOAD
+from samples_store import open_samples
+from segmented_download import journal_done_bytes
+from sync_state import SyncState
+
+PLAN_VERSION = 1
+# civitai api has no size of images, average sample jpeg
+ESTIMATED_IMAGE_BYTES = 512 * 1024
+TRANSFER_STATS_FILE_NAME = ".civitai_transfer_stats.json"
+# shorter runs say more about latency than about bandwidth
+MIN_MEASURED_BYTES = 32 * 1024 * 1024
+
+ACTION_DOWNLOAD = "download"
+# file size differs from civitai, file is downloaded again
+ACTION_REPLACE = "replace"
+ACTION_RESUME = "resume"
+# placed from content store
+ACTION_PLACE = "place"
+ACTION_EXISTS = "exists"
+ACTION_SKIP_UNSAFE = "skip_unsafe"
+ACTION_SKIP_EXT = "skip_ext"
+TRANSFER_ACTIONS = {ACTION_DOWNLOAD, ACTION_REPLACE, ACTION_RESUME}
+
+KIND_FILE = "file"
+KIND_IMAGE = "image"
+KIND_PIC = "pic"
+
+MB = 1024 * 1024
+
+
+def _plan_file(current_file: Dict[str, Any], model_version_folder: str, disable_sec_checks: bool,
+               skip_download_file_ext_list: List[str], content_store: Optional[ContentStore]) -> Dict[str, Any]:
+    # same decisions as download_model and download_file, without touching the disk
+    file_path = path.join(model_version_folder, current_file['name'])
+    size = int(current_file['sizeKB'] * 1024)
+    expected_hash = select_civitai_hash(current_file.get('hashes'))
+    transfer_bytes = 0
+    file_model_is_safe = current_file['pickleScanResult'] == "Success" \
+        and current_file['virusScanResult'] == "Success"
+    if not (file_model_is_safe or disable_sec_checks):
+        action = ACTION_SKIP_UNSAFE
+    elif any(current_file['name'].endswith(f".{ext}") for ext in skip_download_file_ext_list):
+        action = ACTION_SKIP_EXT
+    elif path.isfile(file_path):
+        if math.isclose(current_file['sizeKB'], path.getsize(file_path) / 1024):
+            action = ACTION_EXISTS
+        else:
+            action, transfer_bytes = ACTION_REPLACE, size
+    else:
+        done_bytes = journal_done_bytes(file_path)
+        if done_bytes is not None:
+            action, transfer_bytes = ACTION_RESUME, max(0, size - done_bytes)
+        elif content_store is not None and expected_hash is not None \
+                and content_store.has(expected_hash.algorithm, expected_hash.value):
+            action = ACTION_PLACE
+        else:
+            action, transfer_bytes = ACTION_DOWNLOAD, size
+    return {"name": current_file['name'],
+            "url": current_file['downloadUrl'],
+            "path": file_path,
+            "size": size,
+            "hashes": current_file.get('hashes') or {},
+            "action": action,
+            "bytes": transfer_bytes}
+
+
+def _plan_images(model_version_json_data: Dict[str, Any], samples_folder: str,
+                 content_store: Optional[ContentStore]) -> List[Dict[str, Any]]:
+    sample_index = open_samples(samples_folder, save=False) if path.isdir(samples_folder) else None
+    images = []
+    for image_json in model_version_json_data["images"]:
+        if sample_index is not None and sample_index.find(image_json["hash"]) is not None:
+            action, transfer_bytes = ACTION_EXISTS, 0
+        elif content_store is not None and content_store.has(IMAGE_NAMESPACE, image_json["hash"]):
+            action, transfer_bytes = ACTION_PLACE, 0
+        else:
+            action, transfer_bytes = ACTION_DOWNLOAD, ESTIMATED_IMAGE_BYTES
+        images.append({"url": image_json["url"], "hash": image_json["hash"], "action": action,
+                       "bytes": transfer_bytes})
+    return images
+
+
+def _plan_pics(model_data_json: Dict[str, Any], pics_folder: str) -> List[Dict[str, Any]]:
+    if not model_data_json.get('description'):
+        return []
+    _, description_pics = rewrite_description_pics(model_data_json['description'])
+    exists_pic_names = set(os.listdir(pics_folder)) if path.isdir(pics_folder) else set()
+    return [{"url": pic.url, "name": pic.file_name,
+             "action": ACTION_EXISTS if pic.file_name in exists_pic_names else ACTION_DOWNLOAD,
+             "bytes": 0 if pic.file_name in exists_pic_names else ESTIMATED_IMAGE_BYTES}
+            for pic in description_pics]
+
+
+def plan_model(sd_webui_root_dir: str, model_data_json: Dict[str, Any], priority: int = 0,
+               model_version_ids: Optional[Set[int]] = None, disable_sec_checks: bool = False,
+               skip_download_file_ext_list: Optional[List[str]] = None, download_pics_from_desc: bool = True,
+               content_store: Optional[ContentStore] = None,
+               sync_state: Optional[SyncState] = None) -> Dict[str, Any]:
+    """Transfers of one model what download_model would do with current local state. Nothing is written."""
+    folder_for_current_model = get_model_folder(path.abspath(sd_webui_root_dir), model_data_json)
+    versions = []
+    for model_version_json_data in model_data_json["modelVersions"]:
+        if model_version_ids is not None and model_version_json_data["id"] not in model_version_ids:
+            continue
+        version_plan = {"id": model_version_json_data["id"], "name": model_version_json_data["name"],
+                        "synced": False, "files": [], "images": []}
+        versions.append(version_plan)
+        if sync_state is not None and sync_state.is_version_complete(model_version_json_data):
+            version_plan["synced"] = True
+            continue
+        model_version_folder = get_model_version_folder(folder_for_current_model, model_version_json_data)
+        version_plan["files"] = [_plan_file(current_file, model_version_folder, disable_sec_checks,
+                                            skip_download_file_ext_list or [], content_store)
+                                 for current_file in model_version_json_data["files"]]
+        version_plan["images"] = _plan_images(model_version_json_data,
+                                              path.join(model_version_folder, SAMPLES_FOLDER_NAME), content_store)
+    pics = _plan_pics(model_data_json, path.join(folder_for_current_model, PICS_FOLDER_NAME)) \
+        if download_pics_from_desc else []
+    return {"model_id": model_data_json["id"],
+            "name": model_data_json["name"],
+            "type": model_data_json["type"],
+            "url": f"https://civitai.com/models/{model_data_json['id']}",
+            "priority": priority,
+            "versions_total": len(model_data_json["modelVersions"]),
+            "folder": folder_for_current_model,
+            "versions": versions,
+            "pics": pics}
+
+
+def _model_transfers(model_plan: Dict[str, Any]):
+    for version_plan in model_plan["versions"]:
+        for file_plan in version_plan["files"]:
+            yield KIND_FILE, version_plan, file_plan
+        for image_plan in version_plan["images"]:
+            yield KIND_IMAGE, version_plan, image_plan
+    for pic_plan in model_plan["pics"]:
+        yield KIND_PIC, None, pic_plan
+
+
+def model_transfer_bytes(model_plan: Dict[str, Any]) -> int:
+    return sum(item["bytes"] for _, _, item in _model_transfers(model_plan) if item["action"] in TRANSFER_ACTIONS)
+
+
+def _model_entries(model_plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # manifest entries of the model: whole model, or only versions with transfers
+    version_ids = sorted({version_plan["id"] for kind, version_plan, item in _model_transfers(model_plan)
+                          if version_plan is not None and item["action"] in TRANSFER_ACTIONS | {ACTION_PLACE}})
+    pics_pending = any(pic_plan["action"] in TRANSFER_ACTIONS for pic_plan in model_plan["pics"])
+    if not version_ids and not pics_pending:
+        return []
+    if not version_ids or len(version_ids) == model_plan["versions_total"]:
+        return [{"url": model_plan["url"], "priority": model_plan["priority"]}]
+    return [{"url": f"{model_plan['url']}?modelVersionId={version_id}", "priority": model_plan["priority"]}
+            for version_id in version_ids]
+
+
+def build_plan(sd_webui_root_dir: str, model_plans: List[Dict[str, Any]],
+               bandwidth_bytes_per_s: Optional[float]) -> Dict[str, Any]:
+    """
+    Plan of a run with totals and eta. "entries" is a manifest: download-manifest-command executes the plan.
+    """
+    actions: Dict[str, Dict[str, Dict[str, int]]] = {}
+    by_model_type: Dict[str, Dict[str, int]] = {}
+    transfers = 0
+    transfer_bytes = 0
+    estimated_bytes = 0
+    for model_plan in model_plans:
+        model_type = by_model_type.setdefault(model_plan["type"], {"models": 0, "transfers": 0, "bytes": 0})
+        model_type["models"] += 1
+        for kind, _, item in _model_transfers(model_plan):
+            action = actions.setdefault(kind, {}).setdefault(item["action"], {"count": 0, "bytes": 0})
+            action["count"] += 1
+            action["bytes"] += item["bytes"]
+            if item["action"] in TRANSFER_ACTIONS:
+                transfers += 1
+                transfer_bytes += item["bytes"]
+                model_type["transfers"] += 1
+                model_type["bytes"] += item["bytes"]
+                if kind != KIND_FILE:
+                    estimated_bytes += item["bytes"]
+    return {"version": PLAN_VERSION,
+            "created_at": time.time(),
+            "sd_webui_root_dir": path.abspath(sd_webui_root_dir),
+            "bandwidth_bytes_per_s": bandwidth_bytes_per_s,
+            "eta_seconds": transfer_bytes / bandwidth_bytes_per_s if bandwidth_bytes_per_s else None,
+            "totals": {"models": len(model_plans),
+                       "transfers": transfers,
+                       "transfer_bytes": transfer_bytes,
+                       "estimated_image_bytes": estimated_bytes,
+                       "actions": actions,
+                       "by_model_type": by_model_type},
+            "entries": [entry for model_plan in model_plans for entry in _model_entries(model_plan)],
+            "models": model_plans}
+
+
+def split_plan(plan: Dict[str, Any], parts: int) -> List[Dict[str, Any]]:
+    # biggest models first to the least loaded part, every part keeps priority order of its models
+    loads = [0] * parts
+    part_models: List[List[Dict[str, Any]]] = [[] for _ in range(parts)]
+    pending_models = [model_plan for model_plan in plan["models"] if _model_entries(model_plan)]
+    for model_plan in sorted(pending_models, key=model_transfer_bytes, reverse=True):
+        part_index = loads.index(min(loads))
+        loads[part_index] += model_transfer_bytes(model_plan)
+        part_models[part_index].append(model_plan)
+    order = {id(model_plan): index for index, model_plan in enumerate(plan["models"])}
+    return [build_plan(plan["sd_webui_root_dir"], sorted(models, key=lambda m: order[id(m)]),
+                       plan["bandwidth_bytes_per_s"])
+            for models in part_models]
+
+
+def format_plan_summary(plan: Dict[str, Any]) -> str:
+    totals = plan["totals"]
+    lines = [f"plan: {totals['models']} models, {totals['transfers']} transfers, "
+             f"{totals['transfer_bytes'] / MB:.1f} MB (images and pictures estimated "
+             f"{totals['estimated_image_bytes'] / MB:.1f} MB)"]
+    for kind, actions in sorted(totals["actions"].items()):
+        lines.append(f"\t{kind:6} " + ", ".join(f"{action} = {stats['count']} ({stats['bytes'] / MB:.1f} MB)"
+                                                  for action, stats in sorted(actions.items())))
+    for model_type, stats in sorted(totals["by_model_type"].items()):
+        lines.append(f"\t{model_type:16} models = {stats['models']}, transfers = {stats['transfers']}, "
+                     f"{stats['bytes'] / MB:.1f} MB")
+    if plan["eta_seconds"] is None:
+        lines.append("eta: unknown, no bandwidth measured by previous runs (use --bandwidth)")
+    else:
+        eta_seconds = plan["eta_seconds"]
+        eta = f"{eta_seconds:.0f} s" if eta_seconds < 120 else f"{eta_seconds / 60:.1f} min"
+        lines.append(f"eta: {eta} at {plan['bandwidth_bytes_per_s'] / MB:.1f} MB/s")
+    return "\n".join(lines)
+
+
+def record_transfer_stats(sd_webui_root_dir: str, metrics: Metrics) -> None:
+    """Keeps download throughput of this run for eta of plans."""
+    transferred, seconds = metrics.throughput([OP_DOWNLOAD, OP_SEGMENTED_DOWNLOAD])
+    if transferred < MIN_MEASURED_BYTES or seconds <= 0:
+        return
+    stats_path = path.join(path.abspath(sd_webui_root_dir), TRANSFER_STATS_FILE_NAME)
+    write_json_atomic(stats_path, {"bandwidth_bytes_per_s": transferred / seconds,
+                                   "bytes": transferred,
+                                   "seconds": seconds,
+                                   "measured_at": time.time()})
+
+
+def load_measured_bandwidth(sd_webui_root_dir: str) -> Optional[float]:
+    try:
+        with open(path.join(path.abspath(sd_webui_root_dir), TRANSFER_STATS_FILE_NAME), "r") as f:
+            return float(json.load(f)["bandwidth_bytes_per_s"])
+    except (OSError, ValueError, KeyError):
+        return None
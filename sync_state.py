@@ -0,0 +1,81 @@
+import sqlite3
+import threading
+import time
+from os import path
+from typing import Any, Dict, Optional
+
+from civitai_api import content_digest
+
+SYNC_STATE_FILE_NAME = ".civitai_sync_state.sqlite3"
+
+
+def version_stamp(model_version_json_data: Dict[str, Any]) -> str:
+    # updatedAt changes on every edit of version on civitai, digest is fallback for old api answers
+    updated_at = model_version_json_data.get("updatedAt")
+    if updated_at:
+        return str(updated_at)
+    return content_digest(model_version_json_data)
+
+
+class SyncState:
+    """
+    Persistent record of completely synced model versions.
+    Incremental sync skips versions whose stamp (updatedAt) is recorded as complete, files and sample images
+    of not complete versions are resumed by their own checks (existing file with size and hash, samples index).
+    Stored in sd-webui root or in db_dir (local folder of a shared root worker).
+    """
+
+    def __init__(self, sd_webui_root_dir: str, db_dir: Optional[str] = None):
+        self.db_path = path.join(db_dir or path.abspath(sd_webui_root_dir), SYNC_STATE_FILE_NAME)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS model_versions (
+                    version_id INTEGER PRIMARY KEY,
+                    model_id INTEGER NOT NULL,
+                    stamp TEXT NOT NULL,
+                    folder TEXT NOT NULL,
+                    synced_at REAL NOT NULL
+                );
+                -- per file and per image records of older versions, they were never read
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS images;
+                CREATE INDEX IF NOT EXISTS model_versions_model_id ON model_versions (model_id);
+            """)
+            self._conn.commit()
+
+    def _execute(self, sql: str, params=()) -> None:
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._conn.commit()
+
+    def is_version_complete(self, model_version_json_data: Dict[str, Any]) -> bool:
+        version_id = model_version_json_data.get("id")
+        if version_id is None:
+            return False
+        with self._lock:
+            row = self._conn.execute("SELECT stamp, folder FROM model_versions WHERE version_id = ?",
+                                     (version_id,)).fetchone()
+        if row is None or row[0] != version_stamp(model_version_json_data):
+            return False
+        # folder removed by hand means the version must be synced again
+        return path.isdir(row[1])
+
+    def is_model_complete(self, model_data_json: Dict[str, Any]) -> bool:
+        model_versions_items = model_data_json.get("modelVersions") or []
+        if not model_versions_items:
+            return False
+        return all(self.is_version_complete(v) for v in model_versions_items)
+
+    def mark_version_complete(self, model_id: Any, model_version_json_data: Dict[str, Any],
+                              model_version_folder: str) -> None:
+        self._execute("INSERT OR REPLACE INTO model_versions (version_id, model_id, stamp, folder, synced_at) "
+                      "VALUES (?, ?, ?, ?, ?)",
+                      (model_version_json_data["id"], model_id, version_stamp(model_version_json_data),
+                       path.abspath(model_version_folder), time.time()))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
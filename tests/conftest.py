@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+# modules of the downloader are in the repository root, synthetic civitai of benchmarks is reused by tests
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(1, os.path.join(ROOT_DIR, "benchmarks"))
+
+import civitai_api  # noqa: E402
+import http_client  # noqa: E402
+from http_stub import StubServer  # noqa: E402
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(handle) -> StubServer:
+        server = StubServer(handle)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def client():
+    # fresh client of every test: rate limiters keep state of answered 429/503
+    created = http_client.configure_http_client(retries=3, backoff_factor=0.01, max_backoff=1.0)
+    yield created
+    created.session.close()
+    http_client._http_client = None
+
+
+@pytest.fixture
+def civitai_library(monkeypatch):
+    # api urls of the run point to synthetic civitai, library.stats counts served requests
+    from civitai_stub import StubLibrary, start_stub_server
+    servers = []
+
+    def start(**library_options) -> StubLibrary:
+        library = StubLibrary(**dict({"file_size_mb": 0.0625, "image_size_kb": 4}, **library_options))
+        server, library.stats = start_stub_server(library)
+        servers.append(server)
+        monkeypatch.setattr(civitai_api, "CIVITAI_BASE_URL", library.base_url)
+        return library
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
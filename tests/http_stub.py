@@ -0,0 +1,90 @@
+import http.server
+import re
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+RANGE_REGEX_PATTERN = re.compile(r"^bytes=(?P<start>\d+)-(?P<end>\d*)$")
+
+
+class StubRequest:
+    def __init__(self, path: str, headers: Dict[str, str]):
+        self.path = path
+        self.headers = headers
+
+
+class StubServer:
+    """
+    Local http server of tests, every GET is answered by handle(handler, request).
+    Received requests are kept in requests, so tests check what client has sent.
+    """
+
+    def __init__(self, handle: Callable[[http.server.BaseHTTPRequestHandler, StubRequest], None]):
+        self.handle = handle
+        self.requests: List[StubRequest] = []
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                request = StubRequest(self.path, {key.lower(): value for key, value in self.headers.items()})
+                with stub._lock:
+                    stub.requests.append(request)
+                stub.handle(self, request)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def url(self, path: str) -> str:
+        return self.base_url + path
+
+    def requests_of(self, path: str) -> List[StubRequest]:
+        with self._lock:
+            return [request for request in self.requests if request.path == path]
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def send(handler: http.server.BaseHTTPRequestHandler, status: int, body: bytes = b"",
+         headers: Optional[Dict[str, str]] = None) -> None:
+    handler.send_response(status)
+    for key, value in (headers or {}).items():
+        handler.send_header(key, value)
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def requested_range(request: StubRequest, size: int) -> Optional[Tuple[int, int]]:
+    # [start, end) of Range header, None without the header
+    match = RANGE_REGEX_PATTERN.match(request.headers.get("range", ""))
+    if match is None:
+        return None
+    start = int(match.group("start"))
+    end = int(match.group("end")) + 1 if match.group("end") else size
+    return start, min(end, size)
+
+
+def send_content(handler: http.server.BaseHTTPRequestHandler, request: StubRequest, content: bytes,
+                 support_range: bool = True, max_bytes: Optional[int] = None) -> None:
+    # max_bytes cuts a range answer short, like a connection dropped in the middle of a segment
+    byte_range = requested_range(request, len(content)) if support_range else None
+    if byte_range is None:
+        send(handler, 200, content)
+        return
+    start, end = byte_range
+    if max_bytes is not None:
+        end = min(end, start + max_bytes)
+    send(handler, 206, content[start:end], {"Content-Range": f"bytes {start}-{end - 1}/{len(content)}"})
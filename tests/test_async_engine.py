@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from http_stub import send
+
+pytest.importorskip("aiohttp")
+
+from async_engine import AsyncDownloadEngine  # noqa: E402
+
+
+@pytest.fixture
+def engine():
+    created = AsyncDownloadEngine(retries=3, backoff_factor=0.01, per_host_limit=8)
+    yield created
+    created.close()
+
+
+def test_throttled_host_limits_parallel_coroutines(client, stub_server, engine):
+    state = {"throttle": 3, "active": 0, "max_active": 0}
+    lock = threading.Lock()
+
+    def handle(handler, request):
+        with lock:
+            if state["throttle"] > 0:
+                state["throttle"] -= 1
+                throttled = True
+            else:
+                throttled = False
+                state["active"] += 1
+                state["max_active"] = max(state["max_active"], state["active"])
+        if throttled:
+            send(handler, 429, b"slow down", {"Retry-After": "0"})
+            return
+        time.sleep(0.2)
+        with lock:
+            state["active"] -= 1
+        send(handler, 200, b"ok")
+
+    server = stub_server(handle)
+    url = server.url("/api/v1/models/1")
+    concurrency = client.limiter(url).concurrency
+
+    assert engine.run(engine.get(url)).content == b"ok"
+    # halved by every 429: 8, 4, 2, 1 and +1 after one success
+    assert concurrency.limit == 2
+    state["max_active"] = 0
+
+    async def parallel_gets():
+        return await engine._asyncio.gather(*[engine.get(url) for _ in range(6)])
+
+    answers = engine.run(parallel_gets())
+    assert [answer.status_code for answer in answers] == [200] * 6
+    # connector allows 8, adaptive slot of the host allows less
+    assert state["max_active"] <= 3
+    assert concurrency._active == 0
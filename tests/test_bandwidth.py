@@ -0,0 +1,91 @@
+from datetime import time as day_time
+
+import click
+import pytest
+
+import bandwidth
+from bandwidth import BandwidthLimiter, TimeWindow, parse_host_bandwidth, MB
+from download_context import DownloadContext
+
+
+def test_time_window_of_one_day():
+    window = TimeWindow.parse("09:30-17:00")
+    assert str(window) == "09:30-17:00"
+    assert window.contains(day_time(9, 30))
+    assert window.contains(day_time(16, 59))
+    assert not window.contains(day_time(17, 0))
+    assert not window.contains(day_time(3, 0))
+
+
+def test_time_window_wraps_midnight():
+    window = TimeWindow.parse(" 22:00 - 06:00 ")
+    assert window.contains(day_time(22, 0))
+    assert window.contains(day_time(23, 59))
+    assert window.contains(day_time(0, 0))
+    assert window.contains(day_time(5, 59))
+    assert not window.contains(day_time(6, 0))
+    assert not window.contains(day_time(12, 0))
+    assert not window.contains(day_time(21, 59))
+
+
+@pytest.mark.parametrize("text", ["22:00", "22:00-", "late-early", "25:00-06:00"])
+def test_bad_time_window(text):
+    with pytest.raises(ValueError):
+        TimeWindow.parse(text)
+    with pytest.raises(click.UsageError):
+        DownloadContext.from_options(".", full_speed_window=[text])
+
+
+def test_parse_host_bandwidth():
+    assert parse_host_bandwidth("2") == (None, 2.0)
+    assert parse_host_bandwidth("Image.CivitAI.com=0.5") == ("image.civitai.com", 0.5)
+    for text in ["fast", "host=-1"]:
+        with pytest.raises(ValueError):
+            parse_host_bandwidth(text)
+
+
+def test_global_and_host_buckets():
+    limiter = BandwidthLimiter.from_options(max_bandwidth=4, host_bandwidth=["1", "civitai.com=2"])
+    assert limiter.is_limited
+    # global bucket and the bucket of the host
+    assert len(limiter.for_url("https://civitai.com/api/download/models/1").buckets) == 2
+    # buckets of a host are shared by its transfers
+    image = limiter.for_url("https://image.civitai.com/a.jpeg")
+    assert image.buckets[1] is limiter.for_url("https://IMAGE.civitai.com/b.jpeg").buckets[1]
+
+    # one second of burst, then the slowest bucket sets the wait
+    assert image.wait_seconds(MB) == 0
+    assert image.wait_seconds(MB) == pytest.approx(1.0, abs=0.05)
+    assert limiter.throttled_seconds == pytest.approx(1.0, abs=0.05)
+    assert "every host 1 MB/s" in limiter.summary()
+
+
+def test_not_limited_transfer_does_not_wait():
+    limiter = BandwidthLimiter.from_options(host_bandwidth=["civitai.com=1"])
+    assert limiter.for_url("https://image.civitai.com/a.jpeg").wait_seconds(100 * MB) == 0
+    assert BandwidthLimiter().summary() is None
+
+
+def fixed_clock(moment: day_time):
+    # stands for datetime class in bandwidth module, datetime.now().time() is the moment
+    class Clock:
+        @staticmethod
+        def now():
+            return Clock()
+
+        @staticmethod
+        def time():
+            return moment
+
+    return Clock
+
+
+def test_caps_are_lifted_inside_full_speed_window(monkeypatch):
+    limiter = BandwidthLimiter.from_options(max_bandwidth=1, full_speed_windows=["22:00-06:00"])
+    throttle = limiter.for_url("https://civitai.com/file")
+
+    monkeypatch.setattr(bandwidth, "datetime", fixed_clock(day_time(1, 0)))
+    assert throttle.wait_seconds(10 * MB) == 0
+    monkeypatch.setattr(bandwidth, "datetime", fixed_clock(day_time(12, 0)))
+    assert throttle.wait_seconds(MB) == 0
+    assert throttle.wait_seconds(MB) > 0.9
@@ -0,0 +1,109 @@
+import copy
+import json
+
+import pytest
+
+import civitai_api
+from civitai_api import CivitaiApiClient, model_api_url
+from http_stub import send
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Wed, 01 Mar 2023 10:00:00 GMT"
+MODEL_JSON = {"id": 1001, "name": "model", "stats": {"downloadCount": 10, "rating": 4.5},
+              "modelVersions": [{"id": 2001, "files": [{"name": "model.safetensors"}],
+                                 "stats": {"downloadCount": 7}}]}
+
+
+@pytest.fixture
+def civitai(stub_server, monkeypatch):
+    # stub of /api/v1/models/<id>, answers 304 for matching conditional request
+    state = {"body": MODEL_JSON, "etag": ETAG}
+
+    def handle(handler, request):
+        if request.headers.get("if-none-match") == state["etag"]:
+            send(handler, 304, headers={"ETag": state["etag"]})
+            return
+        send(handler, 200, json.dumps(state["body"]).encode("utf-8"),
+             {"Content-Type": "application/json", "ETag": state["etag"], "Last-Modified": LAST_MODIFIED})
+
+    server = stub_server(handle)
+    server.state = state
+    monkeypatch.setattr(civitai_api, "CIVITAI_BASE_URL", server.base_url)
+    return server
+
+
+def test_fresh_entry_is_served_without_request(client, civitai, tmp_path):
+    api_client = CivitaiApiClient(cache_dir=str(tmp_path), ttl_seconds=3600)
+    url = model_api_url(1001)
+
+    first = api_client.get_json(url)
+    assert first.status_code == 200 and not first.from_cache
+    second = api_client.get_json(url)
+    assert second.from_cache
+    assert second.json() == MODEL_JSON
+    assert len(civitai.requests) == 1
+
+    # entries are on disk, next run is served from them also
+    assert CivitaiApiClient(cache_dir=str(tmp_path), ttl_seconds=3600).get_json(url).from_cache
+    assert len(civitai.requests) == 1
+
+
+def test_expired_entry_is_revalidated(client, civitai, tmp_path):
+    api_client = CivitaiApiClient(cache_dir=str(tmp_path), ttl_seconds=0)
+    url = model_api_url(1001)
+
+    assert api_client.get_json(url).json() == MODEL_JSON
+    assert "if-none-match" not in civitai.requests[0].headers
+
+    revalidated = api_client.get_json(url)
+    assert revalidated.not_modified and not revalidated.from_cache
+    assert revalidated.json() == MODEL_JSON
+    assert civitai.requests[1].headers["if-none-match"] == ETAG
+    assert civitai.requests[1].headers["if-modified-since"] == LAST_MODIFIED
+
+    # changed model is sent again and replaces the entry
+    changed = dict(MODEL_JSON, name="renamed")
+    civitai.state.update(body=changed, etag='"v2"')
+    refetched = api_client.get_json(url)
+    assert not refetched.not_modified
+    assert refetched.json() == changed
+    assert api_client.get_json(url).not_modified
+
+
+def test_error_answer_is_not_cached(client, stub_server, monkeypatch, tmp_path):
+    server = stub_server(lambda handler, request: send(handler, 404))
+    monkeypatch.setattr(civitai_api, "CIVITAI_BASE_URL", server.base_url)
+    api_client = CivitaiApiClient(cache_dir=str(tmp_path), ttl_seconds=3600)
+
+    assert api_client.get_json(model_api_url(1001)).status_code == 404
+    assert api_client.get_json(model_api_url(1001)).status_code == 404
+    assert len(server.requests) == 2
+
+
+def test_is_synced_ignores_stats(tmp_path):
+    api_client = CivitaiApiClient(cache_dir=str(tmp_path))
+    key = "model:1001"
+    assert not api_client.is_synced(key, MODEL_JSON)
+    api_client.mark_synced(key, MODEL_JSON)
+
+    counted = copy.deepcopy(MODEL_JSON)
+    counted["stats"]["downloadCount"] = 11
+    counted["modelVersions"][0]["stats"]["downloadCount"] = 8
+    assert api_client.is_synced(key, counted)
+    # digests are on disk, other runs and workers see them
+    assert CivitaiApiClient(cache_dir=str(tmp_path)).is_synced(key, counted)
+
+    renamed = copy.deepcopy(MODEL_JSON)
+    renamed["modelVersions"][0]["files"][0]["name"] = "model_v2.safetensors"
+    assert not api_client.is_synced(key, renamed)
+    assert not api_client.is_synced("model:1002", MODEL_JSON)
+
+
+def test_client_without_cache_dir_always_fetches(client, civitai):
+    api_client = CivitaiApiClient(ttl_seconds=3600)
+    url = model_api_url(1001)
+    assert api_client.get_json(url).json() == MODEL_JSON
+    assert not api_client.get_json(url).from_cache
+    assert len(civitai.requests) == 2
+    api_client.mark_synced("model:1001", MODEL_JSON)
+    assert not api_client.is_synced("model:1001", MODEL_JSON)
@@ -0,0 +1,120 @@
+import hashlib
+import os
+
+import content_store
+import hash_cache as hash_cache_module
+from content_store import ContentStore, IMAGE_NAMESPACE, LINK_COPY, LINK_HARDLINK
+from hash_cache import HashCache
+
+CONTENT = os.urandom(64 * 1024)
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+def write(file_path, content: bytes = CONTENT) -> str:
+    with open(file_path, "wb") as f:
+        f.write(content)
+    return str(file_path)
+
+
+def read(file_path) -> bytes:
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def fail_reflink(monkeypatch):
+    # tmp folder of tests may be on btrfs or xfs
+    def reflink(src, dst):
+        raise OSError("no reflink")
+
+    monkeypatch.setattr(content_store, "reflink", reflink)
+
+
+def test_place_falls_back_to_hardlink_and_copy(tmp_path, monkeypatch):
+    fail_reflink(monkeypatch)
+    store = ContentStore(str(tmp_path))
+    source = write(tmp_path / "a.safetensors")
+    assert store.ingest(source, "SHA256", SHA256)
+    # key is not case sensitive
+    assert store.has("SHA256", SHA256.upper())
+
+    hardlinked = str(tmp_path / "b.safetensors")
+    assert store.place("SHA256", SHA256, hardlinked) == LINK_HARDLINK
+    assert read(hardlinked) == CONTENT
+    assert os.stat(hardlinked).st_ino == os.stat(store.blob_path("SHA256", SHA256)).st_ino
+
+    def no_hardlink(src, dst):
+        raise OSError("cross-device link")
+
+    monkeypatch.setattr(content_store.os, "link", no_hardlink)
+    copied = str(tmp_path / "c.safetensors")
+    assert store.place("SHA256", SHA256, copied) == LINK_COPY
+    assert read(copied) == CONTENT
+    assert os.stat(copied).st_ino != os.stat(store.blob_path("SHA256", SHA256)).st_ino
+    # no tmp file of failed link methods is left
+    assert sorted(os.listdir(tmp_path)) == [content_store.CONTENT_STORE_FOLDER_NAME,
+                                            "a.safetensors", "b.safetensors", "c.safetensors"]
+
+    assert store.placed_by_method == {LINK_HARDLINK: 1, LINK_COPY: 1}
+    assert store.saved_download_bytes == 2 * len(CONTENT)
+    assert store.saved_disk_bytes == len(CONTENT)
+
+
+def test_absent_blob_is_not_placed(tmp_path):
+    store = ContentStore(str(tmp_path))
+    assert store.place("SHA256", SHA256, str(tmp_path / "a.safetensors")) is None
+    assert not os.path.exists(tmp_path / "a.safetensors")
+
+
+def test_prune_removes_blobs_without_links(tmp_path):
+    store = ContentStore(str(tmp_path))
+    kept = write(tmp_path / "kept.safetensors")
+    removed_content = os.urandom(1024)
+    removed = write(tmp_path / "removed.safetensors", removed_content)
+    removed_sha256 = hashlib.sha256(removed_content).hexdigest()
+    assert store.ingest(kept, "SHA256", SHA256)
+    assert store.ingest(removed, "SHA256", removed_sha256)
+    assert store.stats()["blobs"] == 2
+
+    os.remove(removed)
+    assert store.prune() == 1
+    assert store.has("SHA256", SHA256)
+    assert not store.has("SHA256", removed_sha256)
+    assert store.prune() == 0
+
+
+def test_blob_changed_in_place_is_refused(tmp_path):
+    store = ContentStore(str(tmp_path))
+    source = write(tmp_path / "a.safetensors")
+    assert store.ingest(source, "SHA256", SHA256)
+
+    # library file is edited in place, its blob is the same inode
+    with open(source, "r+b") as f:
+        f.write(b"edited")
+    assert store.place("SHA256", SHA256, str(tmp_path / "b.safetensors")) is None
+    assert not os.path.exists(tmp_path / "b.safetensors")
+    assert not store.has("SHA256", SHA256)
+    assert store.placed_files == 0
+
+
+def test_digest_of_ingested_blob_is_cached(tmp_path, monkeypatch):
+    store = ContentStore(str(tmp_path))
+    hash_cache = HashCache(str(tmp_path))
+    source = write(tmp_path / "a.safetensors")
+    assert store.ingest(source, "SHA256", SHA256, hash_cache=hash_cache)
+
+    def read_blob(*args):
+        raise AssertionError("blob of hash cache is read again")
+
+    monkeypatch.setattr(hash_cache_module, "compute_file_hash", read_blob)
+    monkeypatch.setattr(content_store, "compute_file_hash", read_blob)
+    placed = str(tmp_path / "b.safetensors")
+    assert store.place("SHA256", SHA256, placed, hash_cache=hash_cache) is not None
+    assert read(placed) == CONTENT
+
+
+def test_image_blob_is_placed_without_digest(tmp_path):
+    store = ContentStore(str(tmp_path))
+    image = write(tmp_path / "1.jpg", b"jpeg")
+    assert store.ingest(image, IMAGE_NAMESPACE, "UeKUpFxuo~R%0nW;WCnhF6RjaeRjoLn%j@kC")
+    assert store.place(IMAGE_NAMESPACE, "UeKUpFxuo~R%0nW;WCnhF6RjaeRjoLn%j@kC", str(tmp_path / "2.jpg")) is not None
+    assert read(tmp_path / "2.jpg") == b"jpeg"
@@ -0,0 +1,58 @@
+import pytest
+
+from description_pics import rewrite_description_pics
+
+UUID = "6d4c8a9e-2f5b-4a11-9b0e-1a2b3c4d5e6f"
+OTHER_UUID = "00c0ffee-0000-4000-8000-000000000001"
+
+
+def cache_url(uuid: str = UUID, width: int = 450) -> str:
+    return f"https://imagecache.civitai.com/xG1nkqKTMzGDvpLrqFT7WA/{uuid}/width={width}/{uuid}"
+
+
+@pytest.mark.parametrize("img_tag, expected", [
+    (f'<img src="{cache_url()}">', f'<img src="pics/{UUID}">'),
+    (f"<img src='{cache_url()}' alt='a'>", f"<img src=\"pics/{UUID}\" alt='a'>"),
+    (f'<img src={cache_url()} alt=a>', f'<img src="pics/{UUID}" alt=a>'),
+    (f'<img class="x" src = "{cache_url()}" />', f'<img class="x" src = "pics/{UUID}" />'),
+    (f'<IMG SRC="{cache_url()}">', f'<IMG SRC="pics/{UUID}">'),
+    (f'<Img Alt="1 > 0" Src="{cache_url()}">', f'<Img Alt="1 > 0" Src="pics/{UUID}">'),
+], ids=["double", "single", "unquoted", "spaces", "upper", "gt-in-value"])
+def test_src_is_rewritten(img_tag, expected):
+    description, pics = rewrite_description_pics(f"<p>before</p>{img_tag}<p>after</p>")
+    assert description == f"<p>before</p>{expected}<p>after</p>"
+    assert [(pic.url, pic.file_name) for pic in pics] == [(cache_url(width=0), UUID)]
+
+
+def test_only_src_attribute_is_rewritten():
+    img_tag = f'<img data-src="{cache_url(OTHER_UUID)}" srcset="{cache_url(OTHER_UUID)} 2x" src="{cache_url()}">'
+    description, pics = rewrite_description_pics(img_tag)
+    assert description == f'<img data-src="{cache_url(OTHER_UUID)}" srcset="{cache_url(OTHER_UUID)} 2x" ' \
+                          f'src="pics/{UUID}">'
+    assert [pic.file_name for pic in pics] == [UUID]
+
+    # srcset alone is not a src
+    only_srcset = f'<img srcset="{cache_url()} 1x">'
+    assert rewrite_description_pics(only_srcset) == (only_srcset, [])
+
+
+def test_escaped_url_and_duplicates():
+    escaped = cache_url().replace("/", "&#x2F;")
+    description, pics = rewrite_description_pics(f'<img src="{escaped}"><img src="{cache_url(width=1024)}">')
+    assert description == f'<img src="pics/{UUID}"><img src="pics/{UUID}">'
+    # one picture of both widths
+    assert [pic.url for pic in pics] == [cache_url(width=0)]
+
+
+def test_local_and_foreign_pictures_are_kept():
+    description_html = f'<img src="pics/{UUID}"><img src="https://example.com/a.png"><img alt="no src">'
+    assert rewrite_description_pics(description_html) == (description_html, [])
+
+    # second rewrite of a rewritten description changes nothing
+    rewritten, _ = rewrite_description_pics(f'<p><img src="{cache_url()}"></p>')
+    assert rewrite_description_pics(rewritten) == (rewritten, [])
+
+
+def test_html_around_pictures_is_kept_as_is():
+    description, _ = rewrite_description_pics(f'<p>a &amp; b<br>\n<img\nsrc="{cache_url()}"  width=450 ></p>')
+    assert description == f'<p>a &amp; b<br>\n<img\nsrc="pics/{UUID}"  width=450 ></p>'
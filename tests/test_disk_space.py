@@ -0,0 +1,66 @@
+import json
+import os
+
+from disk_space import DiskSpaceBudget, allocated_bytes
+from segmented_download import journal_path_for, part_path_for
+
+SIZE = 64 * 1024
+
+
+def write(file_path: str, size: int) -> None:
+    with open(file_path, "wb") as f:
+        f.write(os.urandom(size))
+
+
+def test_complete_file_needs_nothing(tmp_path):
+    file_path = str(tmp_path / "model.safetensors")
+    write(file_path, SIZE)
+    assert DiskSpaceBudget.pending_bytes(file_path, SIZE) == 0
+
+
+def test_file_of_other_size_is_downloaded_in_full(tmp_path):
+    # download_file renames it to .inc, which is kept, and downloads the whole file again
+    file_path = str(tmp_path / "model.safetensors")
+    write(file_path, SIZE // 2)
+    assert DiskSpaceBudget.pending_bytes(file_path, SIZE) == SIZE
+
+
+def test_only_part_with_journal_is_credited(tmp_path):
+    file_path = str(tmp_path / "model.safetensors")
+    write(part_path_for(file_path), SIZE // 4)
+    assert DiskSpaceBudget.pending_bytes(file_path, SIZE) == SIZE
+
+    with open(journal_path_for(file_path), "w") as f:
+        json.dump({"total_size": SIZE, "segments": []}, f)
+    assert DiskSpaceBudget.pending_bytes(file_path, SIZE) == SIZE - allocated_bytes(part_path_for(file_path))
+
+
+def test_reservation_of_replaced_file_shrinks_with_new_file(tmp_path):
+    file_path = str(tmp_path / "model.safetensors")
+    write(file_path, SIZE // 2)
+    budget = DiskSpaceBudget(min_free_bytes=0)
+    device = os.stat(str(tmp_path)).st_dev
+
+    assert budget.try_reserve(file_path, SIZE)
+    # old file is still there: it is not a part of the new one
+    assert budget._reserved_bytes(device) == SIZE
+
+    os.rename(file_path, file_path + ".inc")
+    assert budget._reserved_bytes(device) == SIZE
+    write(file_path, SIZE // 4)
+    assert budget._reserved_bytes(device) == SIZE - allocated_bytes(file_path)
+
+    budget.release(file_path)
+    assert budget._reserved_bytes(device) == 0
+
+
+def test_plan_counts_replaced_files(tmp_path):
+    replaced = str(tmp_path / "replaced.safetensors")
+    complete = str(tmp_path / "complete.safetensors")
+    new = str(tmp_path / "new.safetensors")
+    write(replaced, SIZE // 2)
+    write(complete, SIZE)
+
+    rows = DiskSpaceBudget(min_free_bytes=0).plan([(replaced, SIZE), (complete, SIZE), (new, SIZE)])
+    assert len(rows) == 1
+    assert rows[0].files == 2 and rows[0].need_bytes == 2 * SIZE
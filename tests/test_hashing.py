@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+import get_file_size_info
+from hashing import MultiHasher, StreamHasher, hash_file, compute_file_hash, ALL_HASH_ALGORITHMS, \
+    HASH_STRATEGY_BUFFERED, HASH_STRATEGY_MMAP
+
+# "123456789" is the check input of crc catalogues, "abc" of FIPS 180-2
+CHECK_INPUT = b"123456789"
+SHA256_OF_ABC = "BA7816BF8F01CFEA414140DE5DAE2223B00361A396177A9CB410FF61F20015AD"
+BLAKE3_OF_EMPTY = "AF1349B9F5F9A1A6A0404DEA36DCC9499BCB25C9ADC112B7CC9A93CAE41F3262"
+
+
+def digests(data: bytes):
+    hasher = MultiHasher(ALL_HASH_ALGORITHMS)
+    hasher.update(data)
+    return hasher.hexdigests()
+
+
+def test_known_vectors():
+    assert digests(CHECK_INPUT)["CRC32"] == "CBF43926"
+    assert digests(b"")["CRC32"] == "00000000"
+    assert digests(b"abc")["SHA256"] == SHA256_OF_ABC
+    # AutoV2 is the start of sha256
+    assert digests(b"abc")["AutoV2"] == SHA256_OF_ABC[:10]
+    assert digests(b"")["BLAKE3"] == BLAKE3_OF_EMPTY
+
+
+def test_stream_hasher_of_chunks():
+    hasher = StreamHasher("AutoV2")
+    for chunk in [b"a", b"", b"bc"]:
+        hasher.update(chunk)
+    assert hasher.hexdigest() == SHA256_OF_ABC[:10]
+    with pytest.raises(ValueError):
+        MultiHasher(["MD5"])
+
+
+@pytest.mark.parametrize("size", [0, 1, 1000, 4096 * 3 + 17])
+def test_mmap_and_buffered_strategies_agree(tmp_path, size):
+    file_path = str(tmp_path / "model.safetensors")
+    data = os.urandom(size)
+    with open(file_path, "wb") as f:
+        f.write(data)
+
+    # buffer smaller than the file, the last chunk is a part of the buffer
+    buffered = hash_file(file_path, ALL_HASH_ALGORITHMS, strategy=HASH_STRATEGY_BUFFERED, buffer_size=1000)
+    mapped = hash_file(file_path, ALL_HASH_ALGORITHMS, strategy=HASH_STRATEGY_MMAP, buffer_size=1000)
+    serial = hash_file(file_path, ALL_HASH_ALGORITHMS, strategy=HASH_STRATEGY_MMAP, parallel_algorithms=False)
+    assert buffered == mapped == serial == digests(data)
+    assert compute_file_hash(file_path, "CRC32") == digests(data)["CRC32"]
+
+
+def test_file_info_prints_lower_case_digests(tmp_path, monkeypatch, capsys):
+    file_path = str(tmp_path / "abc.bin")
+    with open(file_path, "wb") as f:
+        f.write(b"abc")
+    monkeypatch.setattr(sys, "argv", ["get_file_size_info.py", file_path, "--strategy", "mmap"])
+
+    get_file_size_info.main()
+    lines = capsys.readouterr().out.splitlines()
+    assert "file_size bytes = 3" in lines
+    assert f"sha256_hash = {SHA256_OF_ABC.lower()}" in lines
+    assert f"autov2_hash = {SHA256_OF_ABC[:10].lower()}" in lines
+    assert "crc32_hash = 352441c2" in lines
@@ -0,0 +1,129 @@
+import email.utils
+import threading
+import time
+
+import pytest
+import requests
+
+import http_client
+from http_stub import send
+from main import simple_download
+from rate_limit import AdaptiveConcurrency, backoff_delay, parse_retry_after
+
+
+def answers(*statuses, retry_after=None):
+    # stub answering given statuses in turn, then 200
+    remaining = list(statuses)
+
+    def handle(handler, request):
+        status = remaining.pop(0) if remaining else 200
+        headers = {"Retry-After": retry_after()} if retry_after is not None and status != 200 else {}
+        send(handler, status, b"ok" if status == 200 else b"slow down", headers)
+
+    return handle
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after(" 0 ") == 0.0
+    in_ten_seconds = email.utils.formatdate(time.time() + 10, usegmt=True)
+    assert 8 <= parse_retry_after(in_ten_seconds) <= 10
+    # date in the past means no wait
+    assert parse_retry_after(email.utils.formatdate(time.time() - 60, usegmt=True)) == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+
+
+def test_backoff_delay():
+    assert backoff_delay(0, 0.5, retry_after=7) == 7
+    assert backoff_delay(0, 0.5, retry_after=300, max_backoff=120) == 120
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt, 0.5, max_backoff=4) <= 4
+
+
+@pytest.mark.parametrize("retry_after", [lambda: "1", lambda: email.utils.formatdate(time.time() + 2, usegmt=True)],
+                         ids=["seconds", "http-date"])
+def test_retry_after_is_waited(client, stub_server, retry_after):
+    server = stub_server(answers(429, retry_after=retry_after))
+    started = time.monotonic()
+    resp = client.get(server.url("/api/v1/models/1"))
+    elapsed = time.monotonic() - started
+
+    assert resp.status_code == 200
+    assert len(server.requests) == 2
+    # client caps the delay at max_backoff of 1 s, the date has second resolution
+    assert 0.9 <= elapsed < 5
+    assert client.limiter(server.url("/")).throttled == 1
+
+
+def test_throttling_lowers_and_recovers_concurrency(client, stub_server):
+    server = stub_server(answers(503, 503))
+    url = server.url("/api/v1/models/1")
+    concurrency = client.limiter(url).concurrency
+    assert concurrency.limit == 8
+
+    assert client.get(url).status_code == 200
+    # halved by both 503
+    assert concurrency.limit == 2
+    # +1 after limit successful answers in a row
+    for _ in range(2 + 3 + 4 + 5 + 6 + 7 - 1):
+        client.get(url)
+    assert concurrency.limit == 8
+
+
+def test_aimd():
+    concurrency = AdaptiveConcurrency(max_limit=8)
+    concurrency.on_throttle()
+    concurrency.on_throttle()
+    concurrency.on_throttle()
+    concurrency.on_throttle()
+    assert concurrency.limit == 1
+    concurrency.on_success()
+    assert concurrency.limit == 2
+    concurrency.on_success()
+    concurrency.on_throttle()
+    # success streak is reset by throttling
+    assert concurrency.limit == 1
+
+    fixed = AdaptiveConcurrency(max_limit=8, adaptive=False)
+    fixed.on_throttle()
+    assert fixed.limit == 8
+
+
+def test_gives_up_after_retries(client, stub_server, tmp_path):
+    server = stub_server(answers(*[429] * 10))
+    url = server.url("/api/v1/models/1")
+
+    resp = client.get(url)
+    assert resp.status_code == 429
+    # first attempt and client.retries retries
+    assert len(server.requests) == 1 + client.retries
+
+    # downloads do not save the error page
+    fname = tmp_path / "model.safetensors"
+    with pytest.raises(requests.HTTPError):
+        simple_download(server.url("/file"), str(fname))
+    assert len(server.requests) == 2 * (1 + client.retries)
+
+
+def test_not_retried_answer_is_returned(client, stub_server):
+    server = stub_server(answers(404))
+    assert client.get(server.url("/api/v1/models/1")).status_code == 404
+    assert len(server.requests) == 1
+
+
+def test_stream_body_does_not_hold_host_slot(stub_server):
+    client = http_client.configure_http_client(per_host_limit=1)
+    server = stub_server(answers())
+    try:
+        with client.stream(server.url("/file")) as resp:
+            # api request of the same host while the body is not read yet
+            api_answer = []
+            thread = threading.Thread(target=lambda: api_answer.append(client.get(server.url("/api/v1/models/1"))))
+            thread.start()
+            thread.join(timeout=10)
+            assert api_answer and api_answer[0].status_code == 200
+            assert resp.content == b"ok"
+    finally:
+        client.session.close()
+        http_client._http_client = None
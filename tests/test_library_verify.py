@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+from os import path
+
+from library_layout import get_model_folder, get_model_version_folder, CIVITAI_MODEL_ORIGINAL_NAME_JSON
+from library_verify import verify_library, build_report, STATUS_MISSING, STATUS_NOT_SELECTED, STATUS_OK
+
+CONTENT = b"model bytes"
+
+
+def model_file(name: str, scanned: bool = True):
+    return {"name": name,
+            "pickleScanResult": "Success" if scanned else "Danger",
+            "virusScanResult": "Success",
+            "hashes": {"SHA256": hashlib.sha256(CONTENT).hexdigest().upper()}}
+
+
+def write_library(sd_webui_root_dir: str):
+    # version 1 is downloaded, version 2 was not selected by manifest and has no folder
+    model_json = {"id": 1001, "name": "model", "type": "LORA",
+                  "modelVersions": [{"id": 2001, "name": "v1",
+                                     "files": [model_file("model.safetensors"), model_file("model.ckpt"),
+                                               model_file("unsafe.safetensors", scanned=False)]},
+                                    {"id": 2002, "name": "v2", "files": [model_file("model_v2.safetensors")]}]}
+    model_folder = get_model_folder(sd_webui_root_dir, model_json)
+    version_folder = get_model_version_folder(model_folder, model_json["modelVersions"][0])
+    os.makedirs(version_folder)
+    with open(path.join(model_folder, CIVITAI_MODEL_ORIGINAL_NAME_JSON), "w") as f:
+        json.dump(model_json, f)
+    with open(path.join(version_folder, "model.safetensors"), "wb") as f:
+        f.write(CONTENT)
+    return version_folder
+
+
+def statuses(library_files):
+    return {path.basename(f.file_path): f.status for f in library_files}
+
+
+def test_files_skipped_by_download_rules_are_not_selected(tmp_path):
+    write_library(str(tmp_path))
+    library_files = verify_library(str(tmp_path), skip_download_file_ext_list=["ckpt"])
+    assert statuses(library_files) == {"model.safetensors": STATUS_OK,
+                                       "model.ckpt": STATUS_NOT_SELECTED,
+                                       "unsafe.safetensors": STATUS_NOT_SELECTED,
+                                       "model_v2.safetensors": STATUS_NOT_SELECTED}
+    summary = build_report(str(tmp_path), library_files)["summary"]
+    assert summary[STATUS_MISSING] == 0 and summary[STATUS_NOT_SELECTED] == 3
+
+
+def test_files_of_download_options_are_missing(tmp_path):
+    version_folder = write_library(str(tmp_path))
+    library_files = verify_library(str(tmp_path), disable_sec_checks=True)
+    assert statuses(library_files) == {"model.safetensors": STATUS_OK,
+                                       "model.ckpt": STATUS_MISSING,
+                                       "unsafe.safetensors": STATUS_MISSING,
+                                       "model_v2.safetensors": STATUS_NOT_SELECTED}
+
+    # skipped file what exists is verified anyway
+    with open(path.join(version_folder, "model.ckpt"), "wb") as f:
+        f.write(CONTENT)
+    library_files = verify_library(str(tmp_path), skip_download_file_ext_list=["ckpt"])
+    assert statuses(library_files)["model.ckpt"] == STATUS_OK
+
+
+def test_file_removed_during_verify_is_missing(tmp_path):
+    version_folder = write_library(str(tmp_path))
+    model_path = path.join(version_folder, "model.safetensors")
+
+    def remove_model(library_file):
+        # model.safetensors is scanned first, then it is removed before hashing starts
+        if path.isfile(model_path):
+            os.remove(model_path)
+
+    library_files = verify_library(str(tmp_path), on_result=remove_model)
+    removed = [f for f in library_files if f.file_path == model_path][0]
+    assert removed.status == STATUS_MISSING and removed.error is not None
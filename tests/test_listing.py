@@ -0,0 +1,128 @@
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+from civitai_api import CivitaiApiClient, ListingFilters, iter_listing_pages, user_models_api_url
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def page_requests(library) -> int:
+    return library.stats.to_json()["requests"].get("api_user_page", 0)
+
+
+def prefetch_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith("listing-prefetch")]
+
+
+def listing_ids(pages):
+    return [[item["id"] for item in r.json()["items"]] for r in pages]
+
+
+def test_next_page_is_fetched_while_page_is_processed(client, civitai_library):
+    library = civitai_library(models_per_user=5)
+    pages = iter_listing_pages(CivitaiApiClient(), user_models_api_url("user0", ListingFilters(limit=2)))
+
+    first = next(pages)
+    assert [item["id"] for item in first.json()["items"]] == [1001, 1002]
+    # second page is requested before the caller asks for it, the third one only after that
+    assert wait_for(lambda: page_requests(library) == 2)
+    time.sleep(0.1)
+    assert page_requests(library) == 2
+    assert listing_ids(pages) == [[1003, 1004], [1005]]
+    assert page_requests(library) == 3
+    assert prefetch_threads() == []
+
+
+def test_early_exit_stops_prefetch(client, civitai_library):
+    library = civitai_library(models_per_user=5)
+    pages = iter_listing_pages(CivitaiApiClient(), user_models_api_url("user0", ListingFilters(limit=2)))
+    next(pages)
+    pages.close()
+    # prefetched page is waited for, no page is requested after close
+    assert prefetch_threads() == []
+    time.sleep(0.1)
+    assert page_requests(library) == 2
+
+
+def test_error_of_prefetch_is_raised_to_caller(client, civitai_library):
+    civitai_library(models_per_user=5)
+
+    class FailingClient(CivitaiApiClient):
+        def get_json(self, url):
+            if "page=2" in url:
+                raise ConnectionError("connection reset")
+            return super().get_json(url)
+
+    pages = iter_listing_pages(FailingClient(), user_models_api_url("user0", ListingFilters(limit=2)))
+    next(pages)
+    with pytest.raises(ConnectionError):
+        next(pages)
+    assert prefetch_threads() == []
+
+
+def test_listing_stops_after_error_status(client, civitai_library):
+    library = civitai_library(models_per_user=5)
+
+    class ThrottledClient(CivitaiApiClient):
+        def get_json(self, url):
+            r = super().get_json(url)
+            if "page=2" in url:
+                r.status_code = 429
+            return r
+
+    pages = list(iter_listing_pages(ThrottledClient(), user_models_api_url("user0", ListingFilters(limit=2))))
+    assert [r.status_code for r in pages] == [200, 429]
+    assert page_requests(library) == 2
+
+
+def test_server_side_types_are_kept_by_next_page(client, civitai_library):
+    library = civitai_library(models_per_user=5)
+    library.models[1002]["type"] = "Checkpoint"
+    listing_filters = ListingFilters(model_type="LORA", limit=2)
+
+    pages = list(iter_listing_pages(CivitaiApiClient(), user_models_api_url("user0", listing_filters)))
+    assert listing_ids(pages) == [[1001, 1003], [1004, 1005]]
+    next_page = pages[0].json()["metadata"]["nextPage"]
+    assert parse_qs(urlsplit(next_page).query)["types"] == ["LORA"]
+
+
+def model_item(*version_dates, model_type: str = "LORA", nsfw: bool = False):
+    return {"type": model_type, "nsfw": nsfw,
+            "modelVersions": [{"baseModel": "SD 1.5", **dates} for dates in version_dates]}
+
+
+def test_updated_since_is_checked_on_client():
+    listing_filters = ListingFilters(updated_since=datetime(2023, 5, 1))
+    # no api parameter, so it is not sent
+    assert [name for name, _ in listing_filters.query_params()] == ["limit"]
+
+    assert listing_filters.skip_reason(model_item({"updatedAt": "2023-05-01T00:00:00.000Z"})) is None
+    # any date of any version is enough
+    assert listing_filters.skip_reason(model_item({"updatedAt": "2023-01-01T00:00:00.000Z"},
+                                                  {"createdAt": "2023-04-01T00:00:00.000Z",
+                                                   "publishedAt": "2023-06-01T10:00:00.000Z"})) is None
+    assert listing_filters.skip_reason(model_item({"updatedAt": "2023-04-30T23:59:59.999Z"})) \
+        == "no version updated since 2023-05-01T00:00:00"
+    assert listing_filters.skip_reason(model_item()) is not None
+    assert listing_filters.skip_reason(model_item({"updatedAt": None})) is not None
+
+
+def test_updated_since_of_synthetic_listing(client, civitai_library):
+    library = civitai_library(models_per_user=3)
+    library.models[1002]["modelVersions"][1]["updatedAt"] = "2023-07-01T00:00:00.000Z"
+    listing_filters = ListingFilters(model_type="LORA", updated_since=datetime(2023, 6, 1))
+
+    kept = [item["id"] for r in iter_listing_pages(CivitaiApiClient(), user_models_api_url("user0", listing_filters))
+            for item in r.json()["items"] if listing_filters.skip_reason(item) is None]
+    assert kept == [1002]
@@ -0,0 +1,132 @@
+import json
+from concurrent.futures import Future
+
+import pytest
+
+from civitai_api import CivitaiApiClient
+from manifest import ManifestEntry, ManifestModel, load_manifest, resolve_manifest, entry_result, \
+    ENTRY_KIND_MODEL, ENTRY_KIND_USER, ENTRY_KIND_VERSION, RESULT_ERROR, RESULT_FAILED, RESULT_INVALID, RESULT_OK
+
+MODEL_URL = "https://civitai.com/models/1001"
+VERSION_URL = "https://civitai.com/models/1002?modelVersionId=100201"
+
+
+def write(tmp_path, name: str, content: str) -> str:
+    manifest_path = tmp_path / name
+    manifest_path.write_text(content, encoding="utf-8")
+    return str(manifest_path)
+
+
+def summary(entries):
+    return [(entry.url, entry.priority, entry.source, entry.kind) for entry in entries]
+
+
+def test_text_manifest(tmp_path):
+    manifest_path = write(tmp_path, "manifest.txt", f"""# models of the week
+{MODEL_URL} 5
+   # indented comment
+
+{VERSION_URL}   # version of other model
+https://civitai.com/user/user0 -1
+""")
+    assert summary(load_manifest(manifest_path)) == [
+        (MODEL_URL, 5, "manifest.txt:2", ENTRY_KIND_MODEL),
+        (VERSION_URL, 0, "manifest.txt:5", ENTRY_KIND_VERSION),
+        ("https://civitai.com/user/user0", -1, "manifest.txt:6", ENTRY_KIND_USER)]
+
+
+def test_json_manifest(tmp_path):
+    entries = [MODEL_URL, {"url": VERSION_URL, "priority": 3}, {"url": MODEL_URL, "priority": ""}]
+    expected = [(MODEL_URL, 0, "manifest.json[0]", ENTRY_KIND_MODEL),
+                (VERSION_URL, 3, "manifest.json[1]", ENTRY_KIND_VERSION),
+                (MODEL_URL, 0, "manifest.json[2]", ENTRY_KIND_MODEL)]
+    assert summary(load_manifest(write(tmp_path, "manifest.json", json.dumps(entries)))) == expected
+    # entries inside an object, like plan.json
+    assert summary(load_manifest(write(tmp_path, "manifest.json", json.dumps({"entries": entries})))) == expected
+
+
+def test_csv_manifest(tmp_path):
+    manifest_path = write(tmp_path, "models.csv", f"url,priority\n{MODEL_URL},2\n\n{VERSION_URL}\n{MODEL_URL},\n")
+    assert summary(load_manifest(manifest_path)) == [
+        (MODEL_URL, 2, "models.csv:2", ENTRY_KIND_MODEL),
+        (VERSION_URL, 0, "models.csv:4", ENTRY_KIND_VERSION),
+        (MODEL_URL, 0, "models.csv:5", ENTRY_KIND_MODEL)]
+    # format of option wins over extension
+    assert len(load_manifest(write(tmp_path, "models.txt", f"{MODEL_URL},1\n"), "csv")) == 1
+
+
+def test_bad_priority_is_an_error(tmp_path):
+    with pytest.raises(ValueError):
+        load_manifest(write(tmp_path, "manifest.txt", f"{MODEL_URL} high\n"))
+
+
+def test_invalid_url():
+    entry = ManifestEntry("https://example.com/models/1")
+    assert entry.kind is None and entry.error is not None
+    assert entry_result(entry, {})["result"] == RESULT_INVALID
+
+
+def test_urls_of_one_model_are_merged(client, civitai_library):
+    civitai_library(models_per_user=3)
+    entries = [ManifestEntry("https://civitai.com/models/1002?modelVersionId=100200", source="a"),
+               ManifestEntry("https://civitai.com/models/1002?modelVersionId=100201", priority=1, source="b"),
+               ManifestEntry("https://civitai.com/models/1003?modelVersionId=100300", source="c"),
+               ManifestEntry("https://civitai.com/models/1003/some-name", priority=4, source="d")]
+
+    models = resolve_manifest(entries, CivitaiApiClient())
+    # ordered by priority, manifest order inside one priority
+    assert [(model.model_id, model.priority) for model in models] == [(1003, 4), (1002, 1)]
+    assert models[1].version_ids == {100200, 100201}
+    # page of model means all versions
+    assert models[0].version_ids is None
+    assert [entry.source for entry in models[1].entries] == ["a", "b"]
+
+    # models of user page are merged with models of other entries
+    entries.append(ManifestEntry("https://civitai.com/user/user0", source="e"))
+    models = resolve_manifest(entries, CivitaiApiClient())
+    assert entries[4].model_ids == [1001, 1002, 1003]
+    assert [(model.model_id, model.version_ids) for model in models] == [(1003, None), (1002, None), (1001, None)]
+    assert [entry.source for entry in models[1].entries] == ["a", "b", "e"]
+
+
+def test_unknown_user_has_no_models(client, civitai_library):
+    civitai_library()
+    entries = [ManifestEntry("https://civitai.com/user/nobody")]
+    assert resolve_manifest(entries, CivitaiApiClient()) == []
+    assert entries[0].error is None and entries[0].model_ids == []
+
+
+def finished(error=None) -> Future:
+    future = Future()
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+    return future
+
+
+def test_report_of_entries():
+    ok_model, failed_model, error_model = ManifestModel(1, 0), ManifestModel(2, 0), ManifestModel(3, 0)
+    ok_model.jobs = [finished(), finished()]
+    failed_model.jobs = [finished(), finished(OSError("disk full"))]
+    error_model.error = "model not found"
+    models = {1: ok_model, 2: failed_model, 3: error_model}
+
+    def entry(model_ids):
+        manifest_entry = ManifestEntry("https://civitai.com/user/user0", source="manifest.txt:1")
+        manifest_entry.model_ids = model_ids
+        return manifest_entry
+
+    assert entry_result(entry([1]), models) == {
+        "source": "manifest.txt:1", "url": "https://civitai.com/user/user0", "kind": ENTRY_KIND_USER,
+        "priority": 0, "result": RESULT_OK, "models": 1, "models_failed": 0, "jobs": 2, "jobs_failed": 0,
+        "errors": []}
+    report = entry_result(entry([1, 2]), models)
+    assert report["result"] == RESULT_FAILED
+    assert (report["models_failed"], report["jobs"], report["jobs_failed"]) == (1, 4, 1)
+    report = entry_result(entry([1, 2, 3]), models)
+    assert report["result"] == RESULT_ERROR and report["errors"] == ["3: model not found"]
+
+    listing_error = entry([])
+    listing_error.error = "get models of user user0 error, status 500"
+    assert entry_result(listing_error, models)["result"] == RESULT_ERROR
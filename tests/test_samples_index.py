@@ -0,0 +1,60 @@
+import json
+import os
+from os import path
+
+import samples_index
+from samples_index import SampleIndex
+
+
+def write_sample(samples_folder: str, name: str, image_hash: str) -> None:
+    with open(path.join(samples_folder, name + ".json"), "w") as f:
+        json.dump({"hash": image_hash, "meta": {}}, f)
+
+
+def count_builds(monkeypatch):
+    builds = []
+    build = SampleIndex._build
+    monkeypatch.setattr(SampleIndex, "_build", lambda self, json_names: (builds.append(1), build(self, json_names)))
+    return builds
+
+
+def test_index_is_reused_while_jsons_are_unchanged(tmp_path, monkeypatch):
+    samples_folder = str(tmp_path)
+    write_sample(samples_folder, "1", "hash1")
+    write_sample(samples_folder, "2", "hash2")
+    builds = count_builds(monkeypatch)
+
+    assert SampleIndex.load(samples_folder).find("hash2") == "2"
+    assert SampleIndex.load(samples_folder).max_index == 2
+    assert len(builds) == 1
+    assert path.isfile(path.join(samples_folder, samples_index.SAMPLES_INDEX_FILE_NAME))
+
+
+def test_json_replaced_by_hand_rebuilds_index(tmp_path, monkeypatch):
+    samples_folder = str(tmp_path)
+    write_sample(samples_folder, "1", "hash1")
+    SampleIndex.load(samples_folder)
+    builds = count_builds(monkeypatch)
+
+    # same count of N.json files, newer mtime
+    write_sample(samples_folder, "1", "other")
+    json_path = path.join(samples_folder, "1.json")
+    stat = os.stat(json_path)
+    os.utime(json_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    sample_index = SampleIndex.load(samples_folder)
+    assert len(builds) == 1
+    assert sample_index.find("other") == "1"
+    assert sample_index.find("hash1") is None
+
+
+def test_added_json_rebuilds_index(tmp_path, monkeypatch):
+    samples_folder = str(tmp_path)
+    write_sample(samples_folder, "1", "hash1")
+    SampleIndex.load(samples_folder)
+    builds = count_builds(monkeypatch)
+
+    write_sample(samples_folder, "7", "hash7")
+    sample_index = SampleIndex.load(samples_folder)
+    assert len(builds) == 1
+    assert sample_index.max_index == 7
@@ -0,0 +1,107 @@
+import json
+import os
+from os import path
+
+import click
+import pytest
+
+from download_context import DownloadContext
+from samples_index import SampleIndex, SAMPLES_INDEX_FILE_NAME
+from samples_store import SampleStore, open_samples, migrate_samples_folder, export_samples_folder, \
+    SAMPLES_STORE_FILE_NAME
+
+
+def image_json(image_hash: str):
+    return {"hash": image_hash, "url": f"https://image.civitai.com/{image_hash}.jpeg", "meta": {"seed": 1}}
+
+
+def store_lines(samples_folder: str):
+    with open(path.join(samples_folder, SAMPLES_STORE_FILE_NAME), "r", encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+def write_legacy_folder(samples_folder: str):
+    sample_index = SampleIndex.load(samples_folder)
+    for image_hash in ["a", "b", "c"]:
+        sample_index.record(sample_index.add_next(image_hash), image_json(image_hash))
+    sample_index.save()
+
+
+def test_torn_last_line_is_dropped(tmp_path, capsys):
+    samples_folder = str(tmp_path)
+    sample_store = SampleStore(samples_folder)
+    for image_hash in ["a", "b"]:
+        sample_store.record(sample_store.add_next(image_hash), image_json(image_hash))
+    with open(sample_store.store_path, "a", encoding="utf-8") as f:
+        f.write('{"name": "3", "hash": "c", "ima')
+
+    sample_store = SampleStore.load(samples_folder)
+    assert "skip damaged line 3" in capsys.readouterr().out
+    assert sample_store.find("a") == "1" and sample_store.find("b") == "2" and sample_store.find("c") is None
+    # torn tail is gone before the next append
+    assert len(store_lines(samples_folder)) == 2
+    sample_store.record(sample_store.add_next("c"), image_json("c"))
+    assert SampleStore.load(samples_folder).find("c") == "3"
+
+
+def test_read_only_load_does_not_repair(tmp_path):
+    samples_folder = str(tmp_path)
+    with open(path.join(samples_folder, SAMPLES_STORE_FILE_NAME), "w", encoding="utf-8") as f:
+        f.write(json.dumps({"name": "1", "hash": "a", "image": image_json("a")}) + "\n{broken")
+    sample_store = open_samples(samples_folder, save=False)
+    assert isinstance(sample_store, SampleStore) and sample_store.find("a") == "1"
+    assert store_lines(samples_folder)[-1] == "{broken"
+
+
+def test_release_and_save_compact_removed_lines(tmp_path):
+    samples_folder = str(tmp_path)
+    sample_store = SampleStore(samples_folder)
+    for image_hash in ["a", "b", "c"]:
+        sample_store.record(sample_store.add_next(image_hash), image_json(image_hash))
+    # failed download of image b releases its name
+    sample_store.release("2", "b")
+    assert len(store_lines(samples_folder)) == 4
+
+    sample_store.save()
+    assert [json.loads(line)["name"] for line in store_lines(samples_folder)] == ["1", "3"]
+    reloaded = SampleStore.load(samples_folder)
+    assert reloaded.removed_lines == 0
+    assert reloaded.find("b") is None and reloaded.find("c") == "3"
+    assert reloaded.max_index == 3
+
+
+def test_migrate_and_export_round_trip(tmp_path):
+    samples_folder = str(tmp_path)
+    write_legacy_folder(samples_folder)
+    with open(path.join(samples_folder, "2.json"), "r") as f:
+        legacy_json = json.load(f)
+
+    assert migrate_samples_folder(samples_folder) == 3
+    assert sorted(os.listdir(samples_folder)) == [SAMPLES_STORE_FILE_NAME]
+    sample_store = open_samples(samples_folder)
+    assert isinstance(sample_store, SampleStore)
+    assert [sample_store.find(image_hash) for image_hash in ["a", "b", "c"]] == ["1", "2", "3"]
+    # migration of a migrated folder is a no-op
+    assert migrate_samples_folder(samples_folder) == 3
+
+    assert export_samples_folder(samples_folder) == 3
+    assert SAMPLES_STORE_FILE_NAME not in os.listdir(samples_folder)
+    assert SAMPLES_INDEX_FILE_NAME in os.listdir(samples_folder)
+    with open(path.join(samples_folder, "2.json"), "r") as f:
+        assert json.load(f) == legacy_json
+    with open(path.join(samples_folder, "2.meta"), "r") as f:
+        assert json.load(f) == legacy_json["meta"]
+    sample_index = open_samples(samples_folder)
+    assert isinstance(sample_index, SampleIndex) and sample_index.find("c") == "3"
+
+
+def test_migrate_of_folder_without_samples_keeps_legacy_form(tmp_path):
+    samples_folder = str(tmp_path)
+    assert migrate_samples_folder(samples_folder) == 0
+    assert os.listdir(samples_folder) == []
+    assert isinstance(open_samples(samples_folder), SampleIndex)
+
+
+def test_compact_samples_is_rejected_with_shared_run(tmp_path):
+    with pytest.raises(click.UsageError):
+        DownloadContext.from_options(str(tmp_path), compact_samples=True, shared_run="run")
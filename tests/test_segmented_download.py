@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+import segmented_download
+from hashing import ExpectedHash, StreamHasher
+from http_stub import requested_range, send, send_content
+from main import download_and_check_hash, download_large_file
+from segmented_download import journal_path_for, part_path_for
+
+SEGMENT_SIZE = 64 * 1024
+CONTENT = os.urandom(4 * SEGMENT_SIZE)
+CONTENT_SHA256 = hashlib.sha256(CONTENT).hexdigest().upper()
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(segmented_download, "MIN_SEGMENT_SIZE", SEGMENT_SIZE)
+
+
+def test_probe_fallback_when_range_is_ignored(client, stub_server, tmp_path):
+    server = stub_server(lambda handler, request: send_content(handler, request, CONTENT, support_range=False))
+    fname = str(tmp_path / "model.safetensors")
+
+    assert segmented_download.probe_range_support(server.url("/file")) is None
+    assert not segmented_download.segmented_download(server.url("/file"), fname, segment_count=4)
+    assert not os.path.exists(part_path_for(fname))
+    assert not os.path.exists(journal_path_for(fname))
+
+    # caller downloads the file with one stream
+    download_large_file(server.url("/file"), fname, download_segments=4)
+    with open(fname, "rb") as f:
+        assert f.read() == CONTENT
+
+
+def test_segments_are_downloaded_with_ranges(client, stub_server, tmp_path):
+    server = stub_server(lambda handler, request: send_content(handler, request, CONTENT))
+    fname = str(tmp_path / "model.safetensors")
+
+    assert segmented_download.segmented_download(server.url("/file"), fname, segment_count=4)
+    with open(fname, "rb") as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(journal_path_for(fname))
+    ranges = sorted(requested_range(request, len(CONTENT)) for request in server.requests)
+    # probe and one request per segment
+    assert ranges == [(0, 1), (0, SEGMENT_SIZE), (SEGMENT_SIZE, 2 * SEGMENT_SIZE),
+                      (2 * SEGMENT_SIZE, 3 * SEGMENT_SIZE), (3 * SEGMENT_SIZE, len(CONTENT))]
+
+
+def test_resume_from_journal_after_partial_segment(client, stub_server, tmp_path):
+    state = {"broken": True}
+    cut_start = 2 * SEGMENT_SIZE
+
+    def handle(handler, request):
+        byte_range = requested_range(request, len(CONTENT))
+        if state["broken"] and byte_range is not None and byte_range[0] >= cut_start:
+            if byte_range[0] == cut_start:
+                # third segment is cut after 1000 bytes, then the server fails
+                send_content(handler, request, CONTENT, max_bytes=1000)
+            else:
+                send(handler, 404)
+            return
+        send_content(handler, request, CONTENT)
+
+    server = stub_server(handle)
+    fname = str(tmp_path / "model.safetensors")
+
+    with pytest.raises(segmented_download.RangeNotSupportedError):
+        segmented_download.segmented_download(server.url("/file"), fname, segment_count=4)
+    assert not os.path.exists(fname)
+    with open(journal_path_for(fname)) as f:
+        journal = json.load(f)
+    done = {segment["start"]: segment["done"] for segment in journal["segments"]}
+    assert done[0] == SEGMENT_SIZE
+    assert done[cut_start] == cut_start + 1000
+    assert done[3 * SEGMENT_SIZE] == 3 * SEGMENT_SIZE
+
+    state["broken"] = False
+    server.requests.clear()
+    hasher = StreamHasher("SHA256")
+    assert segmented_download.segmented_download(server.url("/file"), fname, segment_count=4, hasher=hasher)
+    with open(fname, "rb") as f:
+        assert f.read() == CONTENT
+    # the whole file is hashed, also bytes written by the interrupted run
+    assert hasher.hexdigest() == CONTENT_SHA256
+    assert not os.path.exists(journal_path_for(fname))
+    assert not os.path.exists(part_path_for(fname))
+    # finished segments are not downloaded again
+    ranges = sorted(requested_range(request, len(CONTENT)) for request in server.requests)
+    assert ranges == [(0, 1), (cut_start + 1000, 3 * SEGMENT_SIZE), (3 * SEGMENT_SIZE, len(CONTENT))]
+
+
+def test_journal_of_other_file_size_is_not_resumed(client, stub_server, tmp_path):
+    server = stub_server(lambda handler, request: send_content(handler, request, CONTENT))
+    fname = str(tmp_path / "model.safetensors")
+    with open(part_path_for(fname), "wb") as f:
+        f.write(b"x" * 100)
+    with open(journal_path_for(fname), "w") as f:
+        json.dump({"url": server.url("/file"), "total_size": 100, "etag": None,
+                   "segments": [{"start": 0, "end": 100, "done": 50}]}, f)
+
+    assert segmented_download.segmented_download(server.url("/file"), fname, segment_count=4)
+    with open(fname, "rb") as f:
+        assert f.read() == CONTENT
+
+
+@pytest.mark.parametrize("download_segments", [0, 4])
+def test_hash_of_downloaded_file_is_verified(client, stub_server, tmp_path, download_segments):
+    server = stub_server(lambda handler, request: send_content(handler, request, CONTENT))
+    fname = str(tmp_path / "model.safetensors")
+
+    assert download_and_check_hash(server.url("/file"), fname, download_segments,
+                                   ExpectedHash("SHA256", CONTENT_SHA256))
+    assert not download_and_check_hash(server.url("/file"), fname, download_segments,
+                                       ExpectedHash("SHA256", "0" * 64))
+    assert download_and_check_hash(server.url("/file"), fname, download_segments, None) is None
+
+
+def write_half_done_journal(url: str, fname: str) -> None:
+    half = len(CONTENT) // 2
+    with open(part_path_for(fname), "wb") as f:
+        f.write(CONTENT[:half] + b"\0" * (len(CONTENT) - half))
+    with open(journal_path_for(fname), "w") as f:
+        json.dump({"url": url, "total_size": len(CONTENT), "etag": None,
+                   "segments": [{"start": 0, "end": len(CONTENT), "done": half}]}, f)
+
+
+def test_journal_is_resumed_without_segments(client, stub_server, tmp_path):
+    server = stub_server(lambda handler, request: send_content(handler, request, CONTENT))
+    fname = str(tmp_path / "model.safetensors")
+    write_half_done_journal(server.url("/file"), fname)
+
+    download_large_file(server.url("/file"), fname, download_segments=0)
+    with open(fname, "rb") as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(journal_path_for(fname))
+    ranges = sorted(requested_range(request, len(CONTENT)) for request in server.requests)
+    assert ranges == [(0, 1), (len(CONTENT) // 2, len(CONTENT))]
+
+
+def test_journal_is_removed_when_range_is_ignored(client, stub_server, tmp_path):
+    server = stub_server(lambda handler, request: send_content(handler, request, CONTENT, support_range=False))
+    fname = str(tmp_path / "model.safetensors")
+    write_half_done_journal(server.url("/file"), fname)
+
+    download_large_file(server.url("/file"), fname, download_segments=0)
+    with open(fname, "rb") as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(journal_path_for(fname))
+    assert not os.path.exists(part_path_for(fname))
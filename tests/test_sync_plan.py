@@ -0,0 +1,117 @@
+import json
+import os
+from os import path
+
+from click.testing import CliRunner
+
+from content_store import ContentStore
+from library_layout import get_model_folder, get_model_version_folder, SAMPLES_FOLDER_NAME
+from main import cli
+from manifest import load_manifest, ENTRY_KIND_MODEL, ENTRY_KIND_VERSION
+from samples_store import SampleStore
+from segmented_download import journal_path_for, part_path_for
+from sync_plan import build_plan, split_plan, MB
+
+FILE_SIZE = 64 * 1024
+
+
+def version_file_path(sd_webui_root_dir: str, model_json: dict, version_index: int) -> str:
+    version_json = model_json["modelVersions"][version_index]
+    version_folder = get_model_version_folder(get_model_folder(sd_webui_root_dir, model_json), version_json)
+    os.makedirs(version_folder, exist_ok=True)
+    return path.join(version_folder, version_json["files"][0]["name"])
+
+
+def write(file_path: str, size: int) -> None:
+    with open(file_path, "wb") as f:
+        f.write(b"\0" * size)
+
+
+def prepare_library(library, sd_webui_root_dir: str, tmp_path) -> None:
+    # 1001: v0 complete with its sample, v1 of other size
+    model_json = library.model_json(1001)
+    complete_path = version_file_path(sd_webui_root_dir, model_json, 0)
+    write(complete_path, FILE_SIZE)
+    samples_folder = path.join(path.dirname(complete_path), SAMPLES_FOLDER_NAME)
+    os.makedirs(samples_folder)
+    sample_store = SampleStore(samples_folder)
+    image_json = model_json["modelVersions"][0]["images"][0]
+    sample_store.record(sample_store.add_next(image_json["hash"]), image_json)
+    write(version_file_path(sd_webui_root_dir, model_json, 1), FILE_SIZE // 2)
+
+    # 1002: v0 interrupted with a quarter done, v1 in content store
+    model_json = library.model_json(1002)
+    resumed_path = version_file_path(sd_webui_root_dir, model_json, 0)
+    write(part_path_for(resumed_path), FILE_SIZE)
+    with open(journal_path_for(resumed_path), "w") as f:
+        json.dump({"url": "", "total_size": FILE_SIZE, "etag": None,
+                   "segments": [{"start": 0, "end": FILE_SIZE, "done": FILE_SIZE // 4}]}, f)
+    blob_source = str(tmp_path / "blob")
+    write(blob_source, FILE_SIZE)
+    blake3 = model_json["modelVersions"][1]["files"][0]["hashes"]["BLAKE3"]
+    assert ContentStore(sd_webui_root_dir).ingest(blob_source, "BLAKE3", blake3)
+
+
+def test_plan_against_synthetic_civitai(client, civitai_library, tmp_path):
+    library = civitai_library(models_per_user=3, images_per_version=1, file_size_mb=FILE_SIZE / MB)
+    library.compute_hashes()
+    # 1003: v0 failed security scan, v1 is new
+    library.models[1003]["modelVersions"][0]["files"][0]["pickleScanResult"] = "Danger"
+    sd_webui_root_dir = str(tmp_path / "root")
+    prepare_library(library, sd_webui_root_dir, tmp_path)
+    plan_path = str(tmp_path / "plan.json")
+
+    result = CliRunner().invoke(cli, ["plan-command", "--sd-webui-root-dir", sd_webui_root_dir, "--content-store",
+                                      "--bandwidth", "1", "--output", plan_path, "https://civitai.com/user/user0"])
+    assert result.exit_code == 0, result.output
+    with open(plan_path) as f:
+        plan = json.load(f)
+
+    actions = {(model_plan["model_id"], version_plan["id"]): (version_plan["files"][0]["action"],
+                                                               version_plan["files"][0]["bytes"],
+                                                               version_plan["images"][0]["action"])
+               for model_plan in plan["models"] for version_plan in model_plan["versions"]}
+    assert actions == {(1001, 100100): ("exists", 0, "exists"),
+                       (1001, 100101): ("replace", FILE_SIZE, "download"),
+                       (1002, 100200): ("resume", FILE_SIZE * 3 // 4, "download"),
+                       (1002, 100201): ("place", 0, "download"),
+                       (1003, 100300): ("skip_unsafe", 0, "download"),
+                       (1003, 100301): ("download", FILE_SIZE, "download")}
+    totals = plan["totals"]
+    assert totals["actions"]["file"]["replace"] == {"count": 1, "bytes": FILE_SIZE}
+    assert totals["transfers"] == 3 + 5
+    assert plan["eta_seconds"] == totals["transfer_bytes"] / MB
+    # nothing is written into the library by a plan
+    assert not path.exists(version_file_path(sd_webui_root_dir, library.model_json(1003), 1))
+
+    # plan.json is a manifest: only versions with transfers, whole model when all versions have them
+    entries = load_manifest(plan_path)
+    assert [(entry.url, entry.kind) for entry in entries] == [
+        ("https://civitai.com/models/1001?modelVersionId=100101", ENTRY_KIND_VERSION),
+        ("https://civitai.com/models/1002", ENTRY_KIND_MODEL),
+        ("https://civitai.com/models/1003", ENTRY_KIND_MODEL)]
+    assert entries[0].source == "plan.json[0]"
+
+
+def model_plan(model_id: int, priority: int, mb: int) -> dict:
+    file_plan = {"name": f"{model_id}.safetensors", "action": "download", "bytes": mb * MB}
+    return {"model_id": model_id, "type": "LORA", "url": f"https://civitai.com/models/{model_id}",
+            "priority": priority, "versions_total": 1, "pics": [],
+            "versions": [{"id": model_id * 100, "files": [file_plan], "images": []}]}
+
+
+def test_split_balances_bytes(tmp_path):
+    done = model_plan(6, 0, 0)
+    done["versions"][0]["files"][0].update(action="exists")
+    model_plans = [model_plan(1, 9, 30), model_plan(2, 8, 70), model_plan(3, 7, 10), model_plan(4, 6, 50),
+                   model_plan(5, 5, 40), done]
+    plan = build_plan(str(tmp_path), model_plans, None)
+
+    parts = split_plan(plan, 2)
+    assert [part["totals"]["transfer_bytes"] for part in parts] == [100 * MB, 100 * MB]
+    # every part keeps priority order, models without transfers are left out
+    assert [[model["model_id"] for model in part["models"]] for part in parts] == [[1, 2], [3, 4, 5]]
+    assert sum(len(part["entries"]) for part in parts) == len(plan["entries"]) == 5
+
+    # more parts than models
+    assert [part["totals"]["models"] for part in split_plan(plan, 7)] == [1, 1, 1, 1, 1, 0, 0]
@@ -0,0 +1,103 @@
+import os
+import shutil
+
+import pytest
+
+from sync_plan import plan_model
+from sync_state import SyncState, version_stamp
+
+UPDATED_AT = "2023-04-01T00:00:00.000Z"
+
+
+def version_json(version_id: int, updated_at=UPDATED_AT):
+    version = {"id": version_id, "name": f"v{version_id}", "files": [], "images": []}
+    if updated_at is not None:
+        version["updatedAt"] = updated_at
+    return version
+
+
+@pytest.fixture
+def sync_state(tmp_path):
+    created = SyncState(str(tmp_path))
+    yield created
+    created.close()
+
+
+def test_version_is_complete_while_updated_at_is_the_same(sync_state, tmp_path):
+    folder = str(tmp_path / "v1")
+    os.makedirs(folder)
+    assert not sync_state.is_version_complete(version_json(1))
+
+    sync_state.mark_version_complete(1001, version_json(1), folder)
+    assert sync_state.is_version_complete(version_json(1))
+    # other version with the same stamp is not complete
+    assert not sync_state.is_version_complete(version_json(2))
+    # version edited on civitai
+    assert not sync_state.is_version_complete(version_json(1, "2023-05-01T00:00:00.000Z"))
+    assert not sync_state.is_version_complete({"name": "no id"})
+
+
+def test_version_without_updated_at_is_stamped_by_content(sync_state, tmp_path):
+    folder = str(tmp_path / "v1")
+    os.makedirs(folder)
+    old_answer = version_json(1, updated_at=None)
+    assert version_stamp(old_answer) != version_stamp(dict(old_answer, name="renamed"))
+
+    sync_state.mark_version_complete(1001, old_answer, folder)
+    assert sync_state.is_version_complete(old_answer)
+    assert not sync_state.is_version_complete(dict(old_answer, name="renamed"))
+
+
+def test_removed_folder_is_synced_again(sync_state, tmp_path):
+    folder = str(tmp_path / "v1")
+    os.makedirs(folder)
+    sync_state.mark_version_complete(1001, version_json(1), folder)
+    shutil.rmtree(folder)
+    assert not sync_state.is_version_complete(version_json(1))
+
+
+def test_model_is_complete_when_all_versions_are(sync_state, tmp_path):
+    model_json = {"id": 1001, "modelVersions": [version_json(1), version_json(2)]}
+    for version_id in [1, 2]:
+        os.makedirs(str(tmp_path / f"v{version_id}"))
+    sync_state.mark_version_complete(1001, version_json(1), str(tmp_path / "v1"))
+    assert not sync_state.is_model_complete(model_json)
+    sync_state.mark_version_complete(1001, version_json(2), str(tmp_path / "v2"))
+    assert sync_state.is_model_complete(model_json)
+    # model without versions is never complete
+    assert not sync_state.is_model_complete({"id": 1002, "modelVersions": []})
+
+
+def test_state_is_kept_between_runs(tmp_path):
+    folder = str(tmp_path / "v1")
+    os.makedirs(folder)
+    first_run = SyncState(str(tmp_path))
+    first_run.mark_version_complete(1001, version_json(1), folder)
+    first_run.close()
+
+    db_dir = tmp_path / "worker"
+    db_dir.mkdir()
+    next_run, worker = SyncState(str(tmp_path)), SyncState(str(tmp_path), db_dir=str(db_dir))
+    try:
+        assert next_run.is_version_complete(version_json(1))
+        # state of a shared root worker is its own
+        assert not worker.is_version_complete(version_json(1))
+    finally:
+        next_run.close()
+        worker.close()
+
+
+def test_incremental_plan_skips_complete_versions(sync_state, tmp_path):
+    file_json = {"name": "model.safetensors", "sizeKB": 1.0, "pickleScanResult": "Success",
+                 "virusScanResult": "Success", "downloadUrl": "https://civitai.com/api/download/models/1"}
+    model_json = {"id": 1001, "name": "model", "type": "LORA", "description": None,
+                  "modelVersions": [dict(version_json(1), files=[file_json]),
+                                    dict(version_json(2), files=[dict(file_json, name="model_v2.safetensors")])]}
+    first_plan = plan_model(str(tmp_path), model_json, sync_state=sync_state)
+    version_folder = os.path.dirname(first_plan["versions"][0]["files"][0]["path"])
+    os.makedirs(version_folder)
+    sync_state.mark_version_complete(1001, model_json["modelVersions"][0], version_folder)
+
+    model_plan = plan_model(str(tmp_path), model_json, sync_state=sync_state)
+    assert [(version["id"], version["synced"], len(version["files"])) for version in model_plan["versions"]] \
+        == [(1, True, 0), (2, False, 1)]
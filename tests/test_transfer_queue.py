@@ -0,0 +1,113 @@
+import asyncio
+import threading
+
+import pytest
+
+from download_scheduler import DownloadScheduler
+from transfer_queue import AsyncPrioritySlots, PriorityExecutor, TransferInfo, policy_key, KIND_IMAGE, \
+    KIND_MODEL_FILE, POLICY_DISCOVERY, POLICY_METADATA_FIRST, POLICY_NEWEST_VERSION_FIRST, POLICY_SMALLEST_FIRST
+
+
+def test_policy_keys():
+    small = TransferInfo(KIND_MODEL_FILE, size=10, version_timestamp=100)
+    large = TransferInfo(KIND_MODEL_FILE, size=1000, version_timestamp=200)
+    image = TransferInfo(KIND_IMAGE)
+
+    def order(policy):
+        transfers = [large, small, image]
+        keys = {id(transfer): policy_key(policy, transfer, sequence) for sequence, transfer in enumerate(transfers)}
+        return sorted(transfers, key=lambda transfer: keys[id(transfer)])
+
+    assert order(POLICY_DISCOVERY) == [large, small, image]
+    assert order(POLICY_SMALLEST_FIRST) == [image, small, large]
+    assert order(POLICY_NEWEST_VERSION_FIRST) == [large, small, image]
+    assert order(POLICY_METADATA_FIRST) == [image, large, small]
+    with pytest.raises(ValueError):
+        policy_key("largest-first", small, 0)
+
+
+def test_priority_executor_starts_queued_jobs_by_key():
+    executor = PriorityExecutor(1, "test")
+    started = []
+    running = threading.Event()
+    blocker = threading.Event()
+    try:
+        # the only worker is busy, the others are queued
+        first = executor.submit((0,), lambda: (running.set(), blocker.wait()))
+        assert running.wait(timeout=10)
+        futures = [executor.submit((key,), started.append, key) for key in [5, 1, 3, 2]]
+        assert executor.queued == 4
+        blocker.set()
+        first.result(timeout=10)
+        for future in futures:
+            future.result(timeout=10)
+        assert started == [1, 2, 3, 5]
+    finally:
+        blocker.set()
+        executor.shutdown()
+
+
+def test_priority_executor_hold_runs_at_shutdown():
+    held = {"hold": True}
+    executor = PriorityExecutor(2, "test", hold=lambda: held["hold"])
+    future = executor.submit((0,), lambda: "done")
+    assert not future.done()
+    held["hold"] = False
+    executor.wake()
+    assert future.result(timeout=10) == "done"
+
+    held["hold"] = True
+    future = executor.submit((0,), lambda: "at shutdown")
+    executor.shutdown()
+    assert future.result(timeout=10) == "at shutdown"
+
+
+def test_async_slots_start_waiting_coroutines_by_key():
+    started = []
+
+    async def job(slots, key, release):
+        async with slots.slot((key,)):
+            started.append(key)
+            await release.wait()
+
+    async def run():
+        slots = AsyncPrioritySlots(1)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(job(slots, key, release)) for key in [0, 5, 1, 3, 2]]
+        await asyncio.sleep(0.01)
+        assert started == [0] and slots.queued == 4
+        # cancelled waiter does not take a slot
+        tasks[3].cancel()
+        release.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return slots
+
+    slots = asyncio.run(run())
+    assert started == [0, 1, 2, 5]
+    assert slots._active == 0 and slots.queued == 0
+
+
+def test_async_image_jobs_follow_transfer_policy():
+    pytest.importorskip("aiohttp")
+    from async_engine import AsyncDownloadEngine
+
+    engine = AsyncDownloadEngine()
+    started = []
+    release = threading.Event()
+
+    async def download(name):
+        started.append(name)
+        await asyncio.get_running_loop().run_in_executor(None, release.wait)
+
+    try:
+        with DownloadScheduler(max_image_downloads=1, async_engine=engine,
+                               policy=POLICY_NEWEST_VERSION_FIRST) as scheduler:
+            scheduler.submit_image_coroutine("first", download, "first")
+            for name, version_timestamp in [("old", 100), ("newest", 300), ("new", 200)]:
+                scheduler.submit_image_coroutine(name, download, name,
+                                                 transfer=TransferInfo(KIND_IMAGE, version_timestamp=version_timestamp))
+            release.set()
+        assert started == ["first", "newest", "new", "old"]
+    finally:
+        release.set()
+        engine.close()
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+
+import pytest
+
+from download_context import DownloadContext
+from work_leases import LeaseManager, DONE_EXT, LEASE_EXT
+
+KEY = "model:1001"
+
+
+@pytest.fixture
+def managers(tmp_path):
+    created = []
+
+    def create(worker_id: str, ttl_seconds: float = 600) -> LeaseManager:
+        manager = LeaseManager(str(tmp_path), "run", worker_id=worker_id, ttl_seconds=ttl_seconds)
+        created.append(manager)
+        return manager
+
+    yield create
+    for manager in created:
+        manager.close()
+
+
+def expire(manager: LeaseManager, key: str) -> str:
+    # lease not renewed for a long time, like one of a crashed worker
+    lease_path = manager._key_path(key, LEASE_EXT)
+    old = time.time() - 3600
+    os.utime(lease_path, (old, old))
+    return lease_path
+
+
+def test_only_one_of_racing_workers_gets_the_model(managers):
+    workers = [managers(f"worker{index}") for index in range(8)]
+    barrier = threading.Barrier(len(workers))
+    results = {}
+
+    def claim(manager):
+        barrier.wait()
+        results[manager.worker_id] = manager.claim(KEY)
+
+    threads = [threading.Thread(target=claim, args=(manager,)) for manager in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [worker_id for worker_id, claimed in results.items() if claimed]
+    assert len(winners) == 1
+    assert workers[0]._lease_worker(workers[0]._key_path(KEY, LEASE_EXT)) == winners[0]
+    assert sum(manager.busy for manager in workers) == len(workers) - 1
+
+
+def test_live_lease_is_not_reclaimed(managers):
+    first, second = managers("first"), managers("second", ttl_seconds=60)
+    assert first.claim(KEY)
+    assert not second.claim(KEY)
+    assert second.busy == 1 and second.reclaimed == 0
+
+
+def test_expired_lease_is_reclaimed(managers):
+    crashed, second = managers("crashed"), managers("second", ttl_seconds=60)
+    assert crashed.claim(KEY)
+    lease_path = expire(crashed, KEY)
+
+    assert second.claim(KEY)
+    assert second.reclaimed == 1
+    assert second._lease_worker(lease_path) == "second"
+    assert [name for name in os.listdir(second.leases_dir) if name.endswith(".stale")] == []
+
+
+def test_heartbeat_after_reclaim_drops_the_lease(managers):
+    late, second = managers("late"), managers("second", ttl_seconds=60)
+    assert late.claim(KEY)
+    lease_path = expire(late, KEY)
+    assert second.claim(KEY)
+
+    # late heartbeat does not renew or take over the lease of other worker
+    assert not late._renew(KEY, lease_path)
+    assert late._lease_worker(lease_path) == "second"
+    # and release of the lost key keeps the lease of other worker
+    late.release(KEY)
+    assert os.path.isfile(lease_path)
+    assert second._lease_worker(lease_path) == "second"
+
+
+def test_heartbeat_loop_counts_lost_lease(managers):
+    late = managers("late", ttl_seconds=0.3)
+    assert late.claim(KEY)
+    lease_path = late._key_path(KEY, LEASE_EXT)
+    # lease reclaimed and created again by other worker between two heartbeats
+    os.remove(lease_path)
+    other = managers("other")
+    assert other.claim(KEY)
+
+    deadline = time.monotonic() + 5
+    while late.lost == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert late.lost == 1
+    assert late._lease_worker(lease_path) == "other"
+
+
+def test_model_finished_by_other_worker_is_skipped(managers):
+    first, second = managers("first"), managers("second")
+    assert first.claim(KEY)
+    first.complete(KEY)
+    assert os.path.isfile(first._key_path(KEY, DONE_EXT))
+    assert not os.path.exists(first._key_path(KEY, LEASE_EXT))
+
+    assert not second.claim(KEY)
+    assert second.done == 1 and second.busy == 0 and second.claimed == 0
+
+
+def test_busy_model_is_claimed_again_after_walk(managers):
+    other, own = managers("other"), managers("own")
+    context = DownloadContext(leases=own)
+    assert other.claim(KEY)
+    calls = []
+
+    def retry():
+        calls.append(KEY)
+        return [] if not own.claim(KEY) else ["job"]
+
+    try:
+        assert not own.claim(KEY)
+        context.add_busy_model(KEY, retry)
+        # other worker is alive and holds it: one pass, nothing claimed
+        assert context.retry_busy_models() == {}
+        assert calls == [KEY] and context.busy_models == []
+
+        # other worker failed the model and released it
+        context.add_busy_model(KEY, retry)
+        other.release(KEY)
+        assert context.retry_busy_models() == {KEY: ["job"]}
+        assert own.claimed == 1
+    finally:
+        context.scheduler.shutdown()
@@ -0,0 +1,295 @@
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional, Tuple
+
+# order of queued transfers
+POLICY_DISCOVERY = "discovery"
+POLICY_SMALLEST_FIRST = "smallest-first"
+POLICY_METADATA_FIRST = "metadata-first"
+POLICY_NEWEST_VERSION_FIRST = "newest-version-first"
+POLICIES = [POLICY_DISCOVERY, POLICY_SMALLEST_FIRST, POLICY_METADATA_FIRST, POLICY_NEWEST_VERSION_FIRST]
+
+KIND_MODEL_FILE = "model_file"
+KIND_IMAGE = "image"
+
+PROGRESS_AGGREGATE = "aggregate"
+PROGRESS_PER_FILE = "per-file"
+PROGRESS_NONE = "none"
+PROGRESS_MODES = [PROGRESS_AGGREGATE, PROGRESS_PER_FILE, PROGRESS_NONE]
+
+
+class TransferInfo:
+    """What scheduler knows about a job before it runs, used by ordering policy."""
+
+    def __init__(self, kind: str, size: Optional[int] = None, version_timestamp: Optional[float] = None):
+        self.kind = kind
+        self.size = size
+        self.version_timestamp = version_timestamp
+
+
+def policy_key(policy: str, transfer: Optional[TransferInfo], sequence: int) -> Tuple:
+    # lower key starts first, jobs of equal key keep submit order
+    if transfer is None or policy == POLICY_DISCOVERY:
+        return 0, sequence
+    if policy == POLICY_SMALLEST_FIRST:
+        # images have no size in civitai api, they are small
+        return transfer.size or 0, sequence
+    if policy == POLICY_METADATA_FIRST:
+        return 0 if transfer.kind == KIND_IMAGE else 1, sequence
+    if policy == POLICY_NEWEST_VERSION_FIRST:
+        return -(transfer.version_timestamp or 0), sequence
+    raise ValueError(f"unknown transfer policy {policy}")
+
+
+class PriorityExecutor:
+    """
+    Thread pool what starts queued jobs by priority key instead of submit order.
+    While hold() is true queued jobs wait, wake() is called when it may have changed.
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str, hold: Optional[Callable[[], bool]] = None):
+        self.max_workers = max(1, max_workers)
+        self.thread_name_prefix = thread_name_prefix
+        self._hold = hold
+        self._queue: List[Tuple[Tuple, int, Future, Callable[..., Any], Tuple, dict]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._idle = 0
+        self._shutdown = False
+
+    def submit(self, key: Tuple, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new jobs after shutdown")
+            heapq.heappush(self._queue, (key, next(self._sequence), future, fn, args, kwargs))
+            # threads are started on demand, like ThreadPoolExecutor
+            if self._idle == 0 and len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name=f"{self.thread_name_prefix}_{len(self._threads)}")
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify()
+        return future
+
+    @property
+    def queued(self) -> int:
+        with self._condition:
+            return len(self._queue)
+
+    def wake(self) -> None:
+        with self._condition:
+            self._condition.notify_all()
+
+    def _held(self) -> bool:
+        # queued jobs are run at shutdown also when held
+        return not self._shutdown and self._hold is not None and self._hold()
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                self._idle += 1
+                while not self._shutdown and (not self._queue or self._held()):
+                    self._condition.wait()
+                self._idle -= 1
+                if not self._queue:
+                    return
+                _, _, future, fn, args, kwargs = heapq.heappop(self._queue)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for thread in list(self._threads):
+                thread.join()
+
+
+class AsyncPrioritySlots:
+    """
+    Semaphore of coroutines of one event loop, like PriorityExecutor waiting coroutines
+    get a free slot by priority key instead of arrival order. Used from the loop only, so no lock.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self._active = 0
+        self._waiters: List[Tuple[Tuple, int, Any]] = []
+        self._sequence = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, waiter in self._waiters if not waiter.done())
+
+    @asynccontextmanager
+    async def slot(self, key: Tuple) -> AsyncIterator[None]:
+        await self._acquire(key)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, key: Tuple) -> None:
+        if self._active < self.limit and not self.queued:
+            self._active += 1
+            return
+        import asyncio
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (key, next(self._sequence), waiter))
+        try:
+            # slot is handed over by _release, _active stays counted
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            # waiter of cancelled coroutine is skipped
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+
+class TransferProgress:
+    """One progress bar of all transfers of the run instead of a bar per file."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bar = None
+        self.jobs = 0
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.running_transfers = 0
+
+    def _get_bar(self):
+        # tqdm is imported by the first transfer
+        if self._bar is None:
+            from tqdm import tqdm
+            self._bar = tqdm(desc="transfers", total=0, unit='iB', unit_scale=True, unit_divisor=1024)
+        return self._bar
+
+    def _refresh_postfix(self) -> None:
+        if self._bar is not None:
+            self._bar.set_postfix_str(f"jobs {self.jobs_done}/{self.jobs} done, {self.running_transfers} running"
+                                      + (f", {self.jobs_failed} failed" if self.jobs_failed else ""), refresh=False)
+
+    def add_job(self) -> None:
+        with self._lock:
+            self.jobs += 1
+            self._refresh_postfix()
+
+    def finish_job(self, failed: bool) -> None:
+        with self._lock:
+            self.jobs_done += 1
+            if failed:
+                self.jobs_failed += 1
+            self._refresh_postfix()
+
+    def start_transfer(self, expected_bytes: int) -> None:
+        with self._lock:
+            bar = self._get_bar()
+            self.running_transfers += 1
+            bar.total += expected_bytes
+            self._refresh_postfix()
+            bar.refresh()
+
+    def update(self, size: int) -> None:
+        with self._lock:
+            self._get_bar().update(size)
+
+    def finish_transfer(self, expected_bytes: int, transferred_bytes: int) -> None:
+        # total follows bytes really transferred, also of failed and unknown size transfers
+        with self._lock:
+            bar = self._get_bar()
+            self.running_transfers -= 1
+            bar.total += transferred_bytes - expected_bytes
+            self._refresh_postfix()
+            bar.refresh()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._bar is not None:
+                self._bar.close()
+                self._bar = None
+
+
+class _AggregateFileBar:
+    def __init__(self, progress: TransferProgress, expected_bytes: int):
+        self.progress = progress
+        self.expected_bytes = expected_bytes
+        self.transferred_bytes = 0
+
+    def update(self, size: int) -> None:
+        self.transferred_bytes += size
+        self.progress.update(size)
+
+
+_transfer_progress: Optional[TransferProgress] = None
+_progress_mode = PROGRESS_PER_FILE
+_transfer_progress_lock = threading.Lock()
+
+
+def configure_transfer_progress(progress_mode: str) -> Optional[TransferProgress]:
+    global _transfer_progress, _progress_mode
+    with _transfer_progress_lock:
+        _progress_mode = progress_mode
+        _transfer_progress = TransferProgress() if progress_mode == PROGRESS_AGGREGATE else None
+        return _transfer_progress
+
+
+def get_transfer_progress() -> Optional[TransferProgress]:
+    # None means a bar per file
+    with _transfer_progress_lock:
+        return _transfer_progress
+
+
+def close_transfer_progress() -> None:
+    global _transfer_progress, _progress_mode
+    with _transfer_progress_lock:
+        progress = _transfer_progress
+        _transfer_progress = None
+        _progress_mode = PROGRESS_PER_FILE
+    if progress is not None:
+        progress.close()
+
+
+@contextmanager
+def file_progress_bar(fname: str, total: int, initial: int = 0, enabled: bool = True) -> Iterator[Any]:
+    """Progress of one transfer: part of aggregated bar when it is configured, own tqdm bar otherwise."""
+    with _transfer_progress_lock:
+        progress = _transfer_progress
+        enabled = enabled and _progress_mode != PROGRESS_NONE
+    if progress is not None:
+        bar = _AggregateFileBar(progress, max(0, total - initial))
+        progress.start_transfer(bar.expected_bytes)
+        try:
+            yield bar
+        finally:
+            progress.finish_transfer(bar.expected_bytes, bar.transferred_bytes)
+        return
+    from tqdm import tqdm
+    with tqdm(desc=Path(fname).name,
+              total=total,
+              initial=initial,
+              unit='iB',
+              unit_scale=True,
+              unit_divisor=1024,
+              disable=not enabled) as bar:
+        yield bar
@@ -0,0 +1,192 @@
+import json
+import os
+import re
+import platform
+import threading
+import time
+from os import path
+from typing import Dict, Optional
+
+import click
+
+from library_layout import write_json_atomic
+
+LEASES_FOLDER_NAME = ".civitai_leases"
+DEFAULT_LEASE_TTL_SECONDS = 600
+LEASE_EXT = ".lease"
+DONE_EXT = ".done"
+
+
+def default_worker_id() -> str:
+    return f"{platform.node()}-{os.getpid()}"
+
+
+def _safe_name(text: str) -> str:
+    return re.sub(r"[^\w.-]", "_", text)
+
+
+class LeaseManager:
+    """
+    Work claiming of several workers (hosts or processes) syncing into one shared sd-webui root.
+    A lease is a file created with O_EXCL in .civitai_leases/<run>, so only one worker gets a model.
+    The holder renews mtime of its leases by heartbeat; a lease not renewed for ttl seconds is expired
+    and reclaimed by the next worker. Expiry is checked against mtime of a just touched file of the same
+    storage, so clocks of hosts do not have to agree.
+    Completed work leaves a done marker, other workers of the same run skip it.
+    """
+
+    def __init__(self, sd_webui_root_dir: str, run_name: str, worker_id: Optional[str] = None,
+                 ttl_seconds: float = DEFAULT_LEASE_TTL_SECONDS):
+        self.leases_dir = path.join(path.abspath(sd_webui_root_dir), LEASES_FOLDER_NAME, _safe_name(run_name))
+        os.makedirs(self.leases_dir, exist_ok=True)
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl_seconds = ttl_seconds
+        self._clock_path = path.join(self.leases_dir, f".clock.{_safe_name(self.worker_id)}")
+        self._lock = threading.Lock()
+        # key -> lease path
+        self._held: Dict[str, str] = {}
+        self.claimed = 0
+        self.busy = 0
+        self.done = 0
+        self.reclaimed = 0
+        self.lost = 0
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_loop, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def _key_path(self, key: str, ext: str) -> str:
+        return path.join(self.leases_dir, _safe_name(key) + ext)
+
+    def _storage_now(self) -> float:
+        with open(self._clock_path, "a"):
+            pass
+        os.utime(self._clock_path, None)
+        return os.stat(self._clock_path).st_mtime
+
+    def is_done(self, key: str) -> bool:
+        return path.isfile(self._key_path(key, DONE_EXT))
+
+    def claim(self, key: str) -> bool:
+        """False when the key is done in this run or leased by a live worker."""
+        if self.is_done(key):
+            with self._lock:
+                self.done += 1
+            return False
+        lease_path = self._key_path(key, LEASE_EXT)
+        for _ in range(2):
+            if not self._create(key, lease_path):
+                if not self._reclaim_expired(key, lease_path):
+                    break
+                continue
+            with self._lock:
+                self._held[key] = lease_path
+                self.claimed += 1
+            return True
+        with self._lock:
+            self.busy += 1
+        return False
+
+    def _is_expired(self, lease_path: str) -> bool:
+        return os.stat(lease_path).st_mtime + self.ttl_seconds < self._storage_now()
+
+    def _reclaim_expired(self, key: str, lease_path: str) -> bool:
+        try:
+            if not self._is_expired(lease_path):
+                return False
+        except FileNotFoundError:
+            return True
+        stale_path = f"{lease_path}.{_safe_name(self.worker_id)}.stale"
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            # other worker reclaimed it first
+            return True
+        # between stat and rename the lease may be reclaimed and claimed again by other worker
+        if not self._is_expired(stale_path):
+            try:
+                os.link(stale_path, lease_path)
+            except FileExistsError:
+                # a third worker created the lease after the rename, it is the holder now;
+                # the previous holder finds a lease of other worker by heartbeat and drops the key
+                click.echo(f"lease of {key} was claimed by {self._lease_worker(lease_path)} while it was restored")
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        click.echo(f"reclaimed expired lease of {key}")
+        with self._lock:
+            self.reclaimed += 1
+        return True
+
+    @staticmethod
+    def _lease_worker(lease_path: str) -> Optional[str]:
+        try:
+            with open(lease_path, "r") as f:
+                return json.load(f).get("worker")
+        except (OSError, ValueError):
+            return None
+
+    def _owned(self, lease_path: str) -> bool:
+        return self._lease_worker(lease_path) == self.worker_id
+
+    def _create(self, key: str, lease_path: str) -> bool:
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"key": key, "worker": self.worker_id, "claimed_at": time.time()}, f)
+        return True
+
+    def _renew(self, key: str, lease_path: str) -> bool:
+        # False when the lease belongs to other worker now
+        if not path.exists(lease_path):
+            # renamed away by a reclaim what may restore it, or removed: created again while nobody has it
+            if self._create(key, lease_path):
+                return True
+        if not self._owned(lease_path):
+            return False
+        try:
+            os.utime(lease_path, None)
+        except FileNotFoundError:
+            return self._create(key, lease_path)
+        return True
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            lease_path = self._held.pop(key, None)
+        # expired lease may be claimed by other worker yet
+        if lease_path is not None and self._owned(lease_path):
+            os.remove(lease_path)
+
+    def complete(self, key: str) -> None:
+        write_json_atomic(self._key_path(key, DONE_EXT), {"key": key, "worker": self.worker_id,
+                                                          "completed_at": time.time()})
+        self.release(key)
+
+    def _renew_loop(self) -> None:
+        while not self._stop.wait(self.ttl_seconds / 3):
+            with self._lock:
+                held = list(self._held.items())
+            for key, lease_path in held:
+                # heartbeat was late for ttl and other worker reclaimed the lease and created it again
+                if self._renew(key, lease_path):
+                    continue
+                click.echo(f"lease of {key} is lost, other worker may sync it too")
+                with self._lock:
+                    if self._held.pop(key, None) is not None:
+                        self.lost += 1
+
+    def close(self) -> None:
+        self._stop.set()
+        self._heartbeat.join()
+        with self._lock:
+            keys = list(self._held)
+        for key in keys:
+            self.release(key)
+        if path.exists(self._clock_path):
+            os.remove(self._clock_path)
+
+    def summary(self) -> str:
+        with self._lock:
+            return (f"leases of {self.worker_id}: claimed = {self.claimed}, busy by other workers = {self.busy}, "
+                    f"done by run = {self.done}, reclaimed expired = {self.reclaimed}, lost = {self.lost}")